@@ -0,0 +1,71 @@
+"""
+Reading of members of tar and zip archives without extraction, so hashes of the members are calculated in one sequential pass over the archive.
+
+Members are identified by names like `archive.tar!/folder/member.txt`: archive file name, `member_separator` and member name
+with separators of the platform. Such names are stored in hash files as names of regular files.
+
+Tar archives, including compressed ones, are read in stream mode, so the archive is read once from the start to the end.
+Members of zip archives are read in order of their location in the archive.
+
+Ref: https://docs.python.org/3/library/tarfile.html
+Ref: https://docs.python.org/3/library/zipfile.html
+"""
+import os
+import tarfile
+import zipfile
+import zlib
+
+member_separator = "!"
+
+tar_extensions = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+zip_extensions = (".zip",)
+
+class ArchiveError(Exception):
+    pass
+
+def is_archive_file(file_name):
+    return file_name.lower().endswith(tar_extensions + zip_extensions)
+
+def get_member_file_name(archive_file_name, member_name):
+    """
+    Return name of the member to store in hash file. ValueError is raised for unsafe member names with "..",
+    otherwise such member may get the name of the file outside of the archive
+    """
+    parts = [part for part in member_name.replace("\\", "/").split("/") if part not in ("", ".")]
+    if not parts or ".." in parts:
+        raise ValueError(f"Unsafe name of archive member: '{member_name}'")
+    return archive_file_name + member_separator + os.sep + os.path.join(*parts)
+
+def iter_members(archive_file_name):
+    """
+    Iterate over triples (member name, member size, binary file object) for regular files in the archive.
+    File object can be read till the next iteration only. ArchiveError is raised if the archive is damaged or a member can't be read
+    """
+    try:
+        if archive_file_name.lower().endswith(zip_extensions):
+            yield from _iter_zip_members(archive_file_name)
+        else:
+            yield from _iter_tar_members(archive_file_name)
+    except (tarfile.TarError, zipfile.BadZipFile, zlib.error, EOFError) as err:
+        raise ArchiveError(f"Archive is damaged or has unsupported format: '{archive_file_name}'. {err}") from err
+
+def _iter_tar_members(archive_file_name):
+    # Mode "r|*" is stream mode with transparent compression, members are accessible in order of the archive only
+    with tarfile.open(archive_file_name, mode="r|*") as tar:
+        for tar_info in tar:
+            if not tar_info.isreg():
+                continue
+            yield tar_info.name, tar_info.size, tar.extractfile(tar_info)
+
+def _iter_zip_members(archive_file_name):
+    with zipfile.ZipFile(archive_file_name) as zip_file:
+        for zip_info in sorted(zip_file.infolist(), key=lambda zip_info: zip_info.header_offset):
+            if zip_info.is_dir():
+                continue
+            try:
+                f = zip_file.open(zip_info)
+            except (NotImplementedError, RuntimeError) as err:
+                # Unsupported compression method or encrypted member, the rest of the archive is not read like for damaged archive
+                raise ArchiveError(f"Member '{zip_info.filename}' can't be read. {err}") from err
+            with f:
+                yield zip_info.filename, zip_info.file_size, f
@@ -0,0 +1,66 @@
+"""
+Benchmark of lookups in large hash file (catalog): text hash file loaded into memory vs binary catalog queried by memory mapping.
+
+Run from the folder with smart_hasher.py:
+    python benchmarks/bench_binary_catalog.py [--record-count 1000000] [--lookup-count 1000]
+"""
+import argparse
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Ref: https://stackoverflow.com/questions/4383571/importing-files-from-different-folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import hash_storages
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of lookups in text hash file and binary catalog")
+    parser.add_argument("--record-count", type=int, default=1000000)
+    parser.add_argument("--lookup-count", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_folder:
+        # Names look like real tree: several levels of folders with many files
+        hash_data = {}
+        for i in range(args.record_count):
+            data_file_name = os.path.join(work_folder, f"archive{i // 100000:02d}", f"folder{i // 1000:05d}", f"document_{i:08d}.pdf")
+            hash_data[data_file_name] = (hashlib.sha256(str(i).encode()).hexdigest(), True)
+        lookup_file_names = random.Random(0).sample(sorted(hash_data), min(args.lookup_count, args.record_count))
+
+        text_storage = hash_storages.SingleFileHashesStorage()
+        text_storage.single_hash_file_name_base = os.path.join(work_folder, "catalog.sha256")
+        text_storage.preserve_unused_hash_records = True
+        text_storage.suppress_hash_file_comments = True
+        text_storage.hash_data = hash_data
+        text_storage.save_hashes_info()
+
+        binary_storage = hash_storages.BinaryCatalogHashesStorage()
+        binary_storage.binary_catalog_file_name_base = os.path.join(work_folder, "catalog.sha256.shcat")
+        binary_storage.hash_algo = "sha256"
+        start = time.perf_counter()
+        binary_storage.import_hashes(text_storage.iter_hashes())
+        binary_storage.save_hashes_info()
+        binary_save_duration = time.perf_counter() - start
+
+        print(f"Records: {args.record_count}, lookups: {len(lookup_file_names)}, binary catalog is saved in {binary_save_duration:.2f} sec")
+        print(f"{'Format':<8} {'Size, MiB':>10} {'Load, sec':>10} {'Lookups, sec':>13}")
+        for name, storage in [("text", text_storage), ("binary", binary_storage)]:
+            start = time.perf_counter()
+            storage.load_hashes_info()
+            load_duration = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for data_file_name in lookup_file_names:
+                if storage.get_hash(data_file_name) != hash_data[data_file_name][0]:
+                    raise Exception(f"Wrong hash for '{data_file_name}'")
+            lookup_duration = time.perf_counter() - start
+
+            size = os.path.getsize(storage.get_hash_file_name(None))
+            print(f"{name:<8} {size / 1024 / 1024:>10.1f} {load_duration:>10.2f} {lookup_duration:>13.3f}")
+        binary_storage.save_hashes_info()
+
+if __name__ == '__main__':
+    main()
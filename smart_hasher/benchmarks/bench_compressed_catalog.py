@@ -0,0 +1,67 @@
+"""
+Benchmark of loading and saving of large hash file (catalog) with different compressions.
+
+Run from the folder with smart_hasher.py:
+    python benchmarks/bench_compressed_catalog.py [--record-count 1000000] [--json]
+"""
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+# Ref: https://stackoverflow.com/questions/4383571/importing-files-from-different-folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import hash_storages
+
+def create_storage(hash_file_name, compression, json_format):
+    ret = hash_storages.SingleFileHashesStorage()
+    ret.single_hash_file_name_base = hash_file_name
+    ret.compression = compression
+    ret.json_format = json_format
+    ret.preserve_unused_hash_records = True
+    ret.hash_file_header_comments = ["Synthetic catalog for benchmark"]
+    return ret
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of loading and saving compressed hash files")
+    parser.add_argument("--record-count", type=int, default=1000000)
+    parser.add_argument("--json", action="store_true", help="Use JSON format of hash file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_folder:
+        # Names look like real tree: several levels of folders with many files
+        hash_data = {}
+        for i in range(args.record_count):
+            data_file_name = os.path.join(work_folder, f"archive{i // 100000:02d}", f"folder{i // 1000:05d}", f"document_{i:08d}.pdf")
+            hash_data[data_file_name] = (hashlib.sha256(str(i).encode()).hexdigest(), True)
+
+        print(f"Records: {args.record_count}, format: {'JSON' if args.json else 'text'}")
+        print(f"{'Compression':<12} {'Size, MiB':>10} {'Ratio':>7} {'Save, sec':>10} {'Load, sec':>10}")
+        raw_size = None
+        for compression in ["none"] + list(hash_storages.compression_formats):
+            extension = hash_storages.compression_formats[compression][0] if compression != "none" else ""
+            hash_file_name = os.path.join(work_folder, "catalog.sha256" + extension)
+
+            storage = create_storage(hash_file_name, compression, args.json)
+            storage.hash_data = hash_data
+            start = time.perf_counter()
+            storage.save_hashes_info()
+            save_duration = time.perf_counter() - start
+
+            storage = create_storage(hash_file_name, "auto", args.json)
+            start = time.perf_counter()
+            storage.load_hashes_info()
+            load_duration = time.perf_counter() - start
+            if len(storage.hash_data) != args.record_count:
+                raise Exception(f"Unexpected count of loaded records: {len(storage.hash_data)}")
+
+            size = os.path.getsize(hash_file_name)
+            if raw_size is None:
+                raw_size = size
+            print(f"{compression:<12} {size / 1024 / 1024:>10.1f} {raw_size / size:>7.1f} {save_duration:>10.2f} {load_duration:>10.2f}")
+            os.remove(hash_file_name)
+
+if __name__ == '__main__':
+    main()
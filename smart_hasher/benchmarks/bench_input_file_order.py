@@ -0,0 +1,80 @@
+"""
+Benchmark of hashing many small files in order of names, inodes and physical location on the disk.
+
+Files are created in shuffled order of names, so order of names differs from order of location, like in folder filled over years.
+The difference is visible on rotational disk, or on loop device backed by file on rotational disk, when page cache is dropped before every run.
+Dropping of page cache requires root permissions, otherwise files are read from the cache and the difference is small.
+
+Run from the folder with smart_hasher.py:
+    python benchmarks/bench_input_file_order.py [--folder /mnt/hdd/bench] [--file-count 20000] [--file-size 16384]
+
+Loop device with file system may be created for the benchmark as follows:
+    truncate -s 2G /mnt/hdd/bench.img && mkfs.ext4 -q /mnt/hdd/bench.img && mount -o loop /mnt/hdd/bench.img /mnt/bench
+
+Ref: https://www.kernel.org/doc/Documentation/sysctl/vm.txt (drop_caches)
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# Ref: https://stackoverflow.com/questions/4383571/importing-files-from-different-folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cmd_line
+
+def drop_page_cache():
+    """
+    Return True if page cache is dropped, so files are read from the disk
+    """
+    try:
+        os.sync()
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3\n")
+        return True
+    except (OSError, AttributeError):
+        return False
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of hashing many small files in different orders")
+    parser.add_argument("--folder", help="Folder on the disk to test, e.g. on rotational disk or loop device. Temporary folder is used by default")
+    parser.add_argument("--file-count", type=int, default=20000)
+    parser.add_argument("--file-size", type=int, default=16 * 1024)
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    work_folder = tempfile.mkdtemp(dir=args.folder)
+    try:
+        data_folder = os.path.join(work_folder, "data")
+        os.mkdir(data_folder)
+        rnd = random.Random(0)
+        indexes = list(range(args.file_count))
+        rnd.shuffle(indexes)
+        for i in indexes:
+            with open(os.path.join(data_folder, f"file_{i:08d}.bin"), "wb") as f:
+                f.write(rnd.randbytes(args.file_size))
+
+        page_cache_dropped = drop_page_cache()
+        print(f"Files: {args.file_count} of {args.file_size} bytes in '{data_folder}'")
+        if not page_cache_dropped:
+            print("Page cache can't be dropped (root permissions required), files may be read from the cache")
+
+        print(f"{'Order':<10} {'Time, sec':>10} {'MiB/sec':>10}")
+        for input_file_order in ["name", "inode", "physical"] * args.repeat:
+            drop_page_cache()
+            hash_file_base = os.path.join(work_folder, f"hashes_{input_file_order}")
+            cl = f"--input-folder {data_folder} --single-hash-file-name-base {hash_file_base} --suppress-console-reporting-output " \
+                 f"--force-calc-hash --input-file-order {input_file_order}"
+            start = time.perf_counter()
+            exit_code = cmd_line.CommandLineAdapter().run_cmd_line(cl)
+            duration = time.perf_counter() - start
+            if exit_code != cmd_line.ExitCode.OK:
+                raise Exception(f"Hashing failed with exit code {exit_code}")
+            print(f"{input_file_order:<10} {duration:>10.2f} {args.file_count * args.file_size / 1024 / 1024 / duration:>10.1f}")
+    finally:
+        shutil.rmtree(work_folder)
+
+if __name__ == '__main__':
+    main()
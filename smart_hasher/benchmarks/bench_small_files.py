@@ -0,0 +1,73 @@
+"""
+Benchmark of handling many small files: regular path vs fast path for small files.
+
+Run from the folder with smart_hasher.py:
+    python benchmarks/bench_small_files.py [--file-count 20000] [--file-size 4096]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# Ref: https://stackoverflow.com/questions/4383571/importing-files-from-different-folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cmd_line
+
+def create_files(folder, file_count, file_size):
+    for i in range(file_count):
+        sub_folder = os.path.join(folder, f"dir{i // 1000:04d}")
+        os.makedirs(sub_folder, exist_ok=True)
+        with open(os.path.join(sub_folder, f"file{i:07d}.bin"), "wb") as f:
+            f.write(os.urandom(file_size))
+
+def run_once(data_folder, hash_file_name, small_file_threshold, quiet):
+    cl = [f"--input-folder={data_folder}", f"--single-hash-file-name-base={hash_file_name}", "--force-calc-hash",
+          f"--small-file-threshold={small_file_threshold}", "--autosave-timeout=-1"]
+    if quiet:
+        cl.append("--suppress-console-reporting-output")
+
+    # Console output is a part of per-file overhead, so it is written to devnull rather than suppressed.
+    # File descriptor is redirected, because sys.stdout is bound as default argument of the output functions
+    sys.stdout.flush()
+    stdout_fd = os.dup(1)
+    devnull_fd = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull_fd, 1)
+    try:
+        start = time.perf_counter()
+        exit_code = cmd_line.CommandLineAdapter().run(cl)
+        duration = time.perf_counter() - start
+        sys.stdout.flush()
+    finally:
+        os.dup2(stdout_fd, 1)
+        os.close(stdout_fd)
+        os.close(devnull_fd)
+    if exit_code != cmd_line.ExitCode.OK:
+        raise Exception(f"Unexpected exit code: {exit_code}")
+    return duration
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the fast path for small files")
+    parser.add_argument("--file-count", type=int, default=20000)
+    parser.add_argument("--file-size", type=int, default=4096)
+    parser.add_argument("--quiet", action="store_true", help="Pass --suppress-console-reporting-output to smart_hasher")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_folder:
+        data_folder = os.path.join(work_folder, "data")
+        hash_file_name = os.path.join(work_folder, "hashes")
+        create_files(data_folder, args.file_count, args.file_size)
+
+        # Warm up file system cache, so both runs read data from memory
+        run_once(data_folder, hash_file_name, 0, True)
+
+        regular = run_once(data_folder, hash_file_name, 0, args.quiet)
+        fast = run_once(data_folder, hash_file_name, 64 * 1024, args.quiet)
+
+    print(f"Files: {args.file_count}, file size: {args.file_size} bytes")
+    print(f"Regular path: {regular:.2f} sec, {args.file_count / regular:,.0f} files/sec")
+    print(f"Fast path:    {fast:.2f} sec, {args.file_count / fast:,.0f} files/sec")
+    print(f"Speedup: {regular / fast:.1f}x")
+
+if __name__ == '__main__':
+    main()
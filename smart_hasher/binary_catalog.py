@@ -0,0 +1,199 @@
+"""
+Binary catalog is a compact file format for many hashes, it is queried without loading the whole file into memory.
+
+Layout of the file, all numbers are little-endian:
+    Header, 64 bytes:
+        magic (8 bytes), format version (uint32), flags (uint32), hash size in bytes (uint32), reserved (uint32),
+        entry count (uint64), string table offset (uint64), entries offset (uint64), hash algorithm name (16 bytes, zero padded)
+    String table: UTF-8 encoded file names one after another without separators
+    Entries: fixed width records sorted by key. Record contains
+        key (uint64), offset of file name in string table (uint64), file name length (uint32), hash (hash size bytes)
+
+Key is 64-bit BLAKE2b hash of the file name, so entries have fixed width and lookup is a binary search over the memory mapped file.
+File names of the entries with equal keys are compared to resolve collisions.
+
+Ref: https://docs.python.org/3/library/mmap.html
+Ref: https://docs.python.org/3/library/struct.html
+"""
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import uuid
+
+import util
+
+file_extension = ".shcat"
+magic = b"SHCATLG\n"
+format_version = 1
+
+FLAG_ABSOLUTE_FILE_NAMES = 0x1 # File names are absolute, otherwise they are relative to the folder of the catalog
+FLAG_NORM_CASE_FILE_NAMES = 0x2 # Case of file names is normalized
+
+header_struct = struct.Struct("<8sIIIIQQQ16s")
+key_struct = struct.Struct("<Q")
+
+def get_key(file_name):
+    # Ref: https://docs.python.org/3/library/hashlib.html#blake2
+    return int.from_bytes(hashlib.blake2b(file_name.encode("utf-8", "surrogateescape"), digest_size=8).digest(), "big")
+
+def get_entry_struct(hash_size):
+    return struct.Struct(f"<QQI{hash_size}s")
+
+def sort_records(records):
+    """
+    Sort pairs (file name, hash) into the order of catalog entries. Result contains triples (key, file name, hash)
+    """
+    return sorted((get_key(file_name), file_name, hash_value) for file_name, hash_value in records)
+
+class CatalogFormatError(Exception):
+    pass
+
+class BinaryCatalog(object):
+    """
+    Read only access to the binary catalog with memory mapping, so the file is not loaded into memory
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.__file = open(file_name, "rb")
+        try:
+            header = self.__file.read(header_struct.size)
+            if len(header) < header_struct.size:
+                raise CatalogFormatError(f"File is too short to be binary catalog: '{file_name}'")
+            (file_magic, version, self.flags, self.hash_size, _, self.entry_count,
+             self.__strings_offset, self.__entries_offset, hash_algo) = header_struct.unpack(header)
+            if file_magic != magic:
+                raise CatalogFormatError(f"File is not binary catalog: '{file_name}'")
+            if version != format_version:
+                raise CatalogFormatError(f"Unsupported version {version} of binary catalog: '{file_name}'")
+            self.hash_algo = hash_algo.rstrip(b"\0").decode("ascii")
+            self.__entry_struct = get_entry_struct(self.hash_size)
+            if self.__entries_offset + self.entry_count * self.__entry_struct.size > os.path.getsize(file_name):
+                raise CatalogFormatError(f"Binary catalog is truncated: '{file_name}'")
+            # Empty file can't be mapped, but catalog is not empty because it has header at least
+            self.__mmap = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self.__file.close()
+            raise
+
+    def close(self):
+        self.__mmap.close()
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self.entry_count
+
+    def __get_entry(self, index):
+        key, name_offset, name_length, hash_bytes = self.__entry_struct.unpack_from(self.__mmap, self.__entries_offset + index * self.__entry_struct.size)
+        name_start = self.__strings_offset + name_offset
+        return key, self.__mmap[name_start:name_start + name_length], hash_bytes
+
+    def __get_key(self, index):
+        return key_struct.unpack_from(self.__mmap, self.__entries_offset + index * self.__entry_struct.size)[0]
+
+    def lookup(self, file_name):
+        """
+        Return hash of the file as hex string, or None if the file is not in the catalog
+        """
+        key = get_key(file_name)
+        # Ref: https://docs.python.org/3/library/bisect.html, this is `bisect_left` over keys in the file
+        lo, hi = 0, self.entry_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__get_key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        name_bytes = file_name.encode("utf-8", "surrogateescape")
+        while lo < self.entry_count:
+            entry_key, entry_name_bytes, hash_bytes = self.__get_entry(lo)
+            if entry_key != key:
+                break
+            if entry_name_bytes == name_bytes:
+                return hash_bytes.hex()
+            lo += 1
+        return None
+
+    def __iter__(self):
+        """
+        Iterate over triples (key, file name, hash) in order of entries
+        """
+        for index in range(self.entry_count):
+            key, name_bytes, hash_bytes = self.__get_entry(index)
+            yield key, name_bytes.decode("utf-8", "surrogateescape"), hash_bytes.hex()
+
+class BinaryCatalogWriter(object):
+    """
+    Write binary catalog from the entries added in order of keys, see `sort_records()`.
+
+    File names are written directly into the string table of the output file and entries are accumulated in temporary file,
+    so memory usage does not depend on the count of entries. Catalog is written to temporary file which replaces `file_name` on `close()`.
+    `fsync_policy` is one of `util.fsync_policies`.
+    """
+
+    def __init__(self, file_name, hash_algo, hash_size, flags = 0, fsync_policy = "file"):
+        self.file_name = file_name
+        self.fsync_policy = fsync_policy
+        self.hash_algo = hash_algo
+        self.hash_size = hash_size
+        self.flags = flags
+        self.entry_count = 0
+        self.__entry_struct = get_entry_struct(hash_size)
+        self.__tmp_file_name = f"{file_name}.tmp.{uuid.uuid1()}"
+        self.__file = open(self.__tmp_file_name, "wb")
+        self.__entries_file = tempfile.TemporaryFile()
+        self.__strings_size = 0
+        self.__last_entry = None
+        self.__file.write(b"\0" * header_struct.size) # Header is written on close, when offsets are known
+
+    def add(self, key, file_name, hash_value):
+        if self.__last_entry is not None and (key, file_name) <= self.__last_entry:
+            raise ValueError(f"Entries of binary catalog should be added in order of keys without duplicates: '{file_name}'")
+        self.__last_entry = (key, file_name)
+        hash_bytes = bytes.fromhex(hash_value)
+        if len(hash_bytes) != self.hash_size:
+            raise ValueError(f"Hash of file '{file_name}' has {len(hash_bytes)} bytes, {self.hash_size} bytes expected")
+        name_bytes = file_name.encode("utf-8", "surrogateescape")
+        self.__file.write(name_bytes)
+        self.__entries_file.write(self.__entry_struct.pack(key, self.__strings_size, len(name_bytes), hash_bytes))
+        self.__strings_size += len(name_bytes)
+        self.entry_count += 1
+
+    def close(self):
+        # Entries are aligned to 8 bytes
+        padding = -(header_struct.size + self.__strings_size) % 8
+        self.__file.write(b"\0" * padding)
+        entries_offset = header_struct.size + self.__strings_size + padding
+        self.__entries_file.seek(0)
+        shutil.copyfileobj(self.__entries_file, self.__file)
+        self.__entries_file.close()
+        self.__file.seek(0)
+        self.__file.write(header_struct.pack(magic, format_version, self.flags, self.hash_size, 0, self.entry_count,
+                                             header_struct.size, entries_offset, self.hash_algo.encode("ascii")))
+        self.__file.close()
+        util.replace_file(self.__tmp_file_name, self.file_name, self.fsync_policy)
+
+    def abort(self):
+        self.__entries_file.close()
+        self.__file.close()
+        os.remove(self.__tmp_file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
@@ -0,0 +1,183 @@
+"""
+Content-defined chunking to estimate how much storage block-level deduplication saves across files.
+
+Data of files is split to chunks by content with Gear rolling hash, like in FastCDC, so the boundaries of chunks
+don't shift when data is inserted into the file. Chunks are hashed and their digests are kept in `ChunkIndex`,
+which counts total and unique bytes. Chunking is done on the data read for hash calculation, so data is not read again.
+
+Chunking is done in Python byte by byte, so it is much slower than hash calculation. It is intended for analysis rather than regular runs.
+
+Ref: https://www.usenix.org/conference/atc16/technical-sessions/presentation/xia (FastCDC)
+Ref: https://en.wikipedia.org/wiki/Rolling_hash
+"""
+import array
+import bisect
+import copy
+import hashlib
+import heapq
+
+import util
+
+_hash_mask = (1 << 64) - 1
+
+# Table of pseudorandom values for every byte. It is derived from the byte values, so chunk boundaries are the same on every run
+_gear = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "little") for i in range(256)]
+
+def _get_mask(bit_count):
+    """
+    Mask with `bit_count` bits spread over the upper part of 64-bit hash, upper bits of Gear hash depend on more bytes
+    """
+    ret = 0
+    for i in range(bit_count):
+        ret |= 1 << (63 - i * 2)
+    return ret
+
+class ChunkIndex(object):
+    """
+    Set of digests of the chunks of all files with counters of total and unique chunks.
+
+    Digests are 64-bit values, they are kept in sorted array of 8 bytes per digest, which is searched with binary search.
+    New digests are collected in the set which is merged into the array when it grows, so the index takes several times less memory than set of all digests.
+    Probability of collision of 64-bit digests is negligible for the estimation, e.g. less than 0.03 for a billion of chunks
+    """
+
+    merge_threshold = 64 * 1024 # Minimal count of new digests to merge into sorted array
+
+    def __init__(self):
+        self.total_size = 0
+        self.total_count = 0
+        self.unique_size = 0
+        self.unique_count = 0
+        self.__sorted_digests = array.array("Q")
+        self.__new_digests = set()
+
+    def __contains(self, digest):
+        if digest in self.__new_digests:
+            return True
+        sorted_digests = self.__sorted_digests
+        index = bisect.bisect_left(sorted_digests, digest)
+        return index < len(sorted_digests) and sorted_digests[index] == digest
+
+    def __merge(self):
+        # Merge is amortized: the set is merged when it is a quarter of the array, so every digest is copied a few times on average
+        self.__sorted_digests = array.array("Q", heapq.merge(self.__sorted_digests, sorted(self.__new_digests)))
+        self.__new_digests = set()
+
+    def add(self, digest, size):
+        self.total_size += size
+        self.total_count += 1
+        if self.__contains(digest):
+            return
+        self.unique_size += size
+        self.unique_count += 1
+        self.__new_digests.add(digest)
+        if len(self.__new_digests) >= max(self.merge_threshold, len(self.__sorted_digests) // 4):
+            self.__merge()
+
+    def get_report(self):
+        saved_size = self.total_size - self.unique_size
+        saved_percent = 100 * saved_size / self.total_size if self.total_size > 0 else 0
+        return (f"Deduplication analysis: total {util.convert_size_to_display(self.total_size)} in {self.total_count:,d} chunk(s), "
+                f"unique {util.convert_size_to_display(self.unique_size)} in {self.unique_count:,d} chunk(s). "
+                f"Deduplication saves {util.convert_size_to_display(saved_size)} ({saved_percent:.1f}%)")
+
+class Chunker(object):
+    """
+    Split data of one file to chunks by content. Data is passed with `update()` in pieces of any size, chunks may span several pieces.
+    Digests of completed chunks are pending until `finish()` passes them to the index, so chunks of the file which can't be read are not counted,
+    and data read again after error is not counted twice, see `copy()` to save the state on checkpoint.
+    Pending chunks are kept in arrays of 12 bytes per chunk, this is less than the index takes for unique chunks of the file
+    """
+
+    def __init__(self, chunk_index: ChunkIndex, average_size = 8 * 1024):
+        self.chunk_index = chunk_index
+        self.average_size = average_size
+        # Sizes and masks are chosen like in FastCDC: smaller chunks are unlikely with stricter mask, chunks longer than average are likely with weaker mask
+        self.min_size = average_size // 4
+        self.max_size = average_size * 8
+        bit_count = average_size.bit_length() - 1
+        self.__strict_mask = _get_mask(bit_count + 2)
+        self.__weak_mask = _get_mask(bit_count - 2)
+        self.__chunk = bytearray()
+        self.__hash = 0
+        # Arrays of pending chunks are append-only and they are shared by copies, every copy knows count of its pending chunks
+        self.__pending_digests = array.array("Q")
+        self.__pending_sizes = array.array("L")
+        self.__pending_count = 0
+
+    def copy(self):
+        """
+        Copy the state, e.g. to save it on checkpoint and to continue from it on retry. Pending chunks added after the copy is made
+        are dropped when the copy is copied again, so the copy should be copied before it is used
+        """
+        del self.__pending_digests[self.__pending_count:]
+        del self.__pending_sizes[self.__pending_count:]
+        ret = copy.copy(self)
+        ret.__chunk = bytearray(self.__chunk)
+        return ret
+
+    def __add_chunk(self, chunk):
+        digest = int.from_bytes(hashlib.blake2b(chunk, digest_size=8).digest(), "little")
+        self.__pending_digests.append(digest)
+        self.__pending_sizes.append(len(chunk))
+        self.__pending_count += 1
+
+    def update(self, data):
+        gear = _gear
+        hash_mask = _hash_mask
+        data_size = len(data)
+        pos = 0
+        while pos < data_size:
+            chunk_size = len(self.__chunk)
+            if chunk_size < self.min_size:
+                # Boundary is not searched within minimal size of the chunk, so these bytes are not hashed
+                size = min(self.min_size - chunk_size, data_size - pos)
+                self.__chunk += data[pos:pos + size]
+                pos += size
+                continue
+
+            h = self.__hash
+            end = min(data_size, pos + self.max_size - chunk_size)
+            normal_end = max(pos, min(end, pos + self.average_size - chunk_size))
+            cut = -1
+            mask = self.__strict_mask
+            # Iteration over slice is faster than indexing of every byte
+            for i, byte in enumerate(data[pos:normal_end], pos):
+                h = ((h << 1) + gear[byte]) & hash_mask
+                if not h & mask:
+                    cut = i + 1
+                    break
+            if cut < 0:
+                mask = self.__weak_mask
+                for i, byte in enumerate(data[normal_end:end], normal_end):
+                    h = ((h << 1) + gear[byte]) & hash_mask
+                    if not h & mask:
+                        cut = i + 1
+                        break
+            if cut < 0 and chunk_size + end - pos >= self.max_size:
+                cut = end
+
+            if cut < 0:
+                self.__chunk += data[pos:end]
+                self.__hash = h
+                pos = end
+            else:
+                self.__chunk += data[pos:cut]
+                self.__add_chunk(self.__chunk)
+                self.__chunk = bytearray()
+                self.__hash = 0
+                pos = cut
+
+    def finish(self):
+        """
+        Complete the last chunk at the end of the file and pass all chunks to the index
+        """
+        if self.__chunk:
+            self.__add_chunk(self.__chunk)
+            self.__chunk = bytearray()
+            self.__hash = 0
+        for digest, size in zip(self.__pending_digests[:self.__pending_count], self.__pending_sizes[:self.__pending_count]):
+            self.chunk_index.add(digest, size)
+        self.__pending_digests = array.array("Q")
+        self.__pending_sizes = array.array("L")
+        self.__pending_count = 0
@@ -4,16 +4,30 @@ import functools
 import util
 import traceback
 import sys
-import fnmatch
 import time
 import locale
 import os.path
 from datetime import datetime
 import shlex
+import socket
+import threading
 import platform
-
+import contextlib
+import itertools
+import stat
+import cProfile
+import tracemalloc
+
+import archive_members
+import chunking
 import hash_calc
+import hash_file_diff
+import hash_file_merge
 import hash_storages
+import metrics
+import profiling
+import server
+import watcher
 
 @enum.unique
 @functools.total_ordering
@@ -44,6 +58,7 @@ exit_code_descriptions = {
     ExitCode.OK:                                "everthing fine. Program executed successfully",
     ExitCode.OK_SKIPPED_ALREADY_CALCULATED:     "everything fine. OK may be returned anyway\n     if file(s) is skipped because the hash is already calculated.",
     ExitCode.FAILED:                            "general failure, more specific information is not available.",
+    ExitCode.PROGRAM_INTERRUPTED_BY_USER:       "program interrupted with Ctrl+C or SIGTERM signal. Hashes calculated before interruption are saved",
     ExitCode.DATA_READ_ERROR:                   "there was error(s) when reading some file(s). It is likely that hashes are not calculated for all input files",
     ExitCode.APP_USAGE_ERROR:                   "incorrect usage of the application",
 }
@@ -52,11 +67,26 @@ exit_code_descriptions = {
 
 class CommandLineAdapter(object):
 
+    small_file_batch_size = 1000 # Count of small files which hashes are passed to the storage at once
+
     def __init__(self):
         self._input_args = None # This should be specified by caller
         self._parser = None
         self._cmd_line_args = None
         self._start_time_dict = None
+        self._read_rate_limiter = None
+        self._metrics = None
+        self._profiler = None
+        self._hardlink_hashes = {} # Key of physical file (see `_get_hardlink_key`) -> hash calculated in this run
+        self._hardlink_saved_file_count = 0
+        self._hardlink_saved_size = 0
+        self._copy_sources = {} # Normalized name of the copy in --copy-to folder -> name of the source file in this run
+        self._chunk_index = None # chunking.ChunkIndex for --dedup-analysis
+        # Masks compiled by `util.compile_file_masks()`
+        self._file_mask_include = None
+        self._file_mask_exclude = None
+        self._dir_mask_include = None
+        self._dir_mask_exclude = None
 
     def _fill_start_time_dict(self):
         """
@@ -82,7 +112,12 @@ class CommandLineAdapter(object):
     def _info(self, *objects, sep=' ', end='\n', file=sys.stdout, flush=False):
         if self._cmd_line_args is not None and self._cmd_line_args.suppress_console_reporting_output:
             return
+        if self._profiler is None:
+            print(*objects, sep=sep, end=end, file=file, flush=flush)
+            return
+        moment = self._profiler.start()
         print(*objects, sep=sep, end=end, file=file, flush=flush)
+        self._profiler.add_since("console_output", moment)
 
     def _configure_parser(self):
         """    
@@ -108,13 +143,57 @@ class CommandLineAdapter(object):
         calc = hash_calc.FileHashCalc()
 
         autosave_timeout_default = 300
+        small_file_threshold_default = 64 * 1024
 
         # Ref: https://www.programcreek.com/python/example/6706/argparse.RawDescriptionHelpFormatter
         self._parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
         self._parser.add_argument('--input-file', '-i', action="append", help="Specify input files. Key can be specified multiple times")
         self._parser.add_argument('--input-folder', action="append", help="Specify input folders. All files in folder are handled recursively. Key can be specified multiple times")
+        self._parser.add_argument('--input-file-list', metavar="FILE_NAME",
+                                  help="Specify file with list of input files, one file name per line, or '-' to read the list from standard input. "
+                                  "The list is read while files are handled, so it may be very large, e.g. output of 'find'. "
+                                  "Files of the list are handled in order of the list after other input files, duplicates are not removed")
+        self._parser.add_argument('--input-file-list-null', action="store_true",
+                                  help="File names in the list specified with --input-file-list are separated with null character instead of new line, e.g. output of 'find -print0'")
         self._parser.add_argument('--input-folder-file-mask-include', help="Specify file mask to include for input folder. All files in the folder considered if not specified. Separate multiple masks with semicolon (;)")
         self._parser.add_argument('--input-folder-file-mask-exclude', help="Specify file mask to exclude for input folder. It is applied after --input-folder-file-mask-include. Separate multiple masks with semicolon (;)")
+        self._parser.add_argument('--input-folder-dir-mask-include',
+                                  help="Specify mask of subfolder names to include for input folder, e.g. 'src;docs'. It is matched with names of subfolders of input folder, "
+                                  "other subfolders are not walked, subfolders of included ones are included. Files of input folder itself are handled. "
+                                  "All subfolders considered if not specified. Separate multiple masks with semicolon (;)")
+        self._parser.add_argument('--input-folder-dir-mask-exclude',
+                                  help="Specify mask of subfolder names to exclude for input folder on any level, e.g. '.git;node_modules'. Excluded subfolders are not walked at all. "
+                                  "It is applied after --input-folder-dir-mask-include. Separate multiple masks with semicolon (;)")
+        self._parser.add_argument('--shard', metavar="I/N", type=util.parse_shard,
+                                  help="Handle only the files of shard I of N (I is from 1 to N), e.g. '3/20'. Files are assigned to shards by hash of the path "
+                                  "relative to input folder, or of absolute path for other input files, so instances run with the same input on different nodes "
+                                  "handle disjoint sets of files. Every instance should store hashes in its own hash file, hash files may be merged with --merge-hash-files. "
+                                  "Not allowed with --folder-hashes")
+        self._parser.add_argument('--hash-archive-members', action="store_true",
+                                  help="Calculate hashes of the members of tar and zip archives instead of archives themselves, archives are not extracted. "
+                                  f"Archives are recognized by extensions: {', '.join(archive_members.tar_extensions + archive_members.zip_extensions)}. "
+                                  f"Hashes are stored for names like 'archive.tar{archive_members.member_separator}/folder/member.txt'. Archives are read on every run. "
+                                  "This requires --single-hash-file-name-base, --single-hash-file-name-base-json or --single-hash-file-name-base-binary")
+        self._parser.add_argument('--copy-to', metavar="FOLDER",
+                                  help="Copy input files to the specified folder while hashes are calculated, so data is read once. Hashes are stored for the copies. "
+                                  "Files of input folders are copied with paths relative to input folder, other input files are copied into the folder itself. "
+                                  "If several input files have the same destination, only the first one is copied and the run ends with data read error. "
+                                  "Copy already having hash in the storage is skipped. Fast path for small files and hard links handling are not used in this mode")
+        self._parser.add_argument('--copy-verify', action="store_true",
+                                  help="Read every copy made with --copy-to again and compare its hash with the hash of the source. Cached data of the copy is dropped before, "
+                                  "if supported by the system, so the copy is read from the disk. Copy is removed if hashes are different")
+        self._parser.add_argument('--folder-hashes', action="store_true",
+                                  help="Calculate hash of every input folder and its subfolders from hashes of the files within after the files are handled, "
+                                  "data is not read again. Hash of the folder depends on names and hashes of files and subfolders, but not on location of the folder. "
+                                  "Hashes are stored in the hash file along with file hashes for folder names with separator at the end, e.g. 'data/photos/', "
+                                  "so folders of two replicas differ if and only if their hashes differ. "
+                                  "This requires --single-hash-file-name-base or --single-hash-file-name-base-json and input folder or --copy-to")
+        self._parser.add_argument('--dedup-analysis', action="store_true",
+                                  help="Estimate how much storage block-level deduplication saves across input files. Data read for hash calculation is also split "
+                                  "to chunks by content (FastCDC-like), chunks are hashed and unique chunks are counted. Total and unique sizes are printed at the end. "
+                                  "All input files should be read, so --force-calc-hash is required. Chunking is slow, because it is done in Python")
+        self._parser.add_argument('--dedup-analysis-chunk-size', type=int, default=8 * 1024,
+                                  help="Average size of chunks for --dedup-analysis, power of two. Chunks are from a quarter to 8 times of the average size (default: %(default)s)")
         self._parser.add_argument('--hash-file-name-output-postfix', action='append',
                             help="Specify postfix, which will be appended to the end of output file names. This is to specify for different contextes, "
                             "e.g. if file name ends with \".md5\", then it ends with \"md5.<value>\"")
@@ -131,10 +210,27 @@ class CommandLineAdapter(object):
         self._parser.add_argument('--use-absolute-file-names', help="Use absolute file names in output. If argument is not specified, relative file names used", action="store_true")
         self._parser.add_argument('--single-hash-file-name-base', help="If specified then all hashes are stored in one file specified as a value for this argument. Final file name include postfix", action="append")
         self._parser.add_argument('--single-hash-file-name-base-json', help="This is the same key as --single-hash-file-name-base. But postfix json is added. Result data stored in JSON", action="append")
+        self._parser.add_argument('--single-hash-file-name-base-binary', action="append",
+                                  help="This is the same key as --single-hash-file-name-base. But postfix shcat is added. Result data stored in binary catalog: "
+                                  "compact file with records sorted by key, which is queried by binary search in memory mapped file without loading the whole file. "
+                                  "This is efficient for very large number of files")
+        self._parser.add_argument('--hash-file-compression', choices=["none", "auto"] + list(hash_storages.compression_formats), default="auto",
+                                  help="Compression of the hash file specified with --single-hash-file-name-base or --single-hash-file-name-base-json. "
+                                  "For 'auto' compressed hash file is detected by content on load and compression is chosen by extension of the hash file name "
+                                  "(.gz, .xz, .bz2) on save. If compression is specified explicitly, then its extension is added to the postfix of the hash file name (default: %(default)s)")
+        self._parser.add_argument('--hash-file-fsync-policy', choices=util.fsync_policies, default="file",
+                                  help="Hash file is saved to temporary file in the same folder, which replaces the hash file, so the hash file is never left partially written. "
+                                  "This specifies flushing to disk on save: 'none' - rely on the operating system, 'file' - flush the new hash file before replacement, "
+                                  "'file-and-folder' - flush the folder after replacement also, so the replacement survives power loss (default: %(default)s)")
+        self._parser.add_argument('--per-directory-hash-file-name-base', metavar="FILE_NAME",
+                                  help="If specified then hashes are stored in one file per data folder with the specified name and postfix. "
+                                  "Hash file of the folder contains hashes for the files of this folder only, file names are stored without path. "
+                                  "Hash files are loaded when the folder is handled and only changed ones are saved, this is efficient for large trees")
         self._parser.add_argument('--suppress-hash-file-name-postfix', help="Suppress adding postfix in the hash file name for hash algo name", action="store_true")
         self._parser.add_argument('--preserve-unused-hash-records', action="store_true",
                                   help="This key works with --single-hash-file-name-base. By default if file with hashes already exists then records for files which not handled are deleted to avoid records for non-existing files. "
-                                 "If this key specified, then such records preserved in hash file")
+                                 "If this key specified, then such records preserved in hash file. "
+                                 "With --per-directory-hash-file-name-base records for the files which don't exist are deleted unless this key is specified")
         self._parser.add_argument('--norm-case-file-names', action="store_true",
                                   help="Use normalized case of file names on output. This is more robust, but file names may differ which may look inconvenient. It is also platform dependent. "
                                   "Refer for details to https://docs.python.org/3/library/os.path.html#os.path.normcase")
@@ -145,22 +241,214 @@ class CommandLineAdapter(object):
                                   "Specify 0 to save hash info after handling every file, this may result in large overhead when many files on input. "
                                   "Specify -1 to disable autosave, this may result the accumulated hash data missed if execution interrupts unexpectedly. "
                                   "This is essential when multiple hashes stored in one file.")
+        self._parser.add_argument('--suppress-background-autosave', action="store_true",
+                                  help="By default autosave of the hash file specified with --single-hash-file-name-base or --single-hash-file-name-base-json "
+                                  "is done in background thread from the snapshot of hashes, so handling of files is not stalled while large hash file is saved. "
+                                  "Specify this to save in the same thread. Autosave with --autosave-timeout 0 and the final save are always done in the same thread")
         self._parser.add_argument('--user-comment', '-u', action="append", help="Specify comment which will be added to output hash file")
+        self._parser.add_argument('--small-file-threshold', default=small_file_threshold_default, type=int,
+                                  help=f"Files with size not greater than this value, in bytes, are handled in fast path (default: {small_file_threshold_default}). "
+                                  "Such file is read in one call, there is no progress and timing reporting for it, and hashes are passed to the storage in batches. "
+                                  "Specify 0 to disable fast path. Fast path is not used when --pause-after-file is specified")
+        self._parser.add_argument('--suppress-hardlink-dedup', action="store_true",
+                                  help="By default file with several hard links is read once per run, and its hash is stored for every path of the file. "
+                                  "Physical file is identified by device, inode, size and modification time. Specify this to read every path")
+        self._parser.add_argument('--input-file-order', choices=["name", "inode", "physical"], default="name",
+                                  help="Order of reading input files: 'name' - sorted by file names, 'inode' - sorted by inode numbers, "
+                                  "'physical' - sorted by location of file data on the disk, it is obtained with FIEMAP on Linux, otherwise inode order is used. "
+                                  "Order of location reduces seeks when many small files are read from rotational disk (default: %(default)s)")
+        self._parser.add_argument('--throughput-history-file', metavar="FILE_NAME",
+                                  help="JSON file with per-file overhead and throughput of the devices measured in previous runs. "
+                                  "It is used to estimate time to completion from the start of the run, and it is updated at the end of the run. "
+                                  "Devices are identified by device numbers of the files")
+        self._parser.add_argument('--max-read-rate', type=util.parse_size,
+                                  help="Limit the rate of reading data from all input files together, in bytes per second. "
+                                  "Suffixes K, M, G, T (powers of 1024) are allowed, e.g. 50M. By default the rate is not limited")
+        self._parser.add_argument('--io-priority-class', choices=list(util.io_priority_classes),
+                                  help="Set I/O scheduling class for the program process, e.g. 'idle' to read data only when other processes don't use the disk. "
+                                  "This is supported on Linux only. Ref: https://man7.org/linux/man-pages/man1/ionice.1.html")
+        self._parser.add_argument('--io-priority-level', type=int, choices=range(0, 8), metavar="{0..7}",
+                                  help="Set I/O priority level for --io-priority-class 'realtime' and 'best-effort', 0 is the highest priority (default: 4)")
+        self._parser.add_argument('--cpu-niceness', type=int,
+                                  help="Set CPU niceness for the program process, from -20 (highest priority) to 19 (lowest priority)")
+        self._parser.add_argument('--metrics-ndjson-file',
+                                  help="Append machine readable metrics to the specified file in NDJSON format, one record per input file: "
+                                  "path, size, bytes read, duration, throughput, retries and skip reason")
+        self._parser.add_argument('--metrics-prometheus-textfile',
+                                  help="Periodically rewrite the specified file with metrics of the program run in Prometheus text format: counters of files, bytes, "
+                                  "retries and throughput histogram. This is intended for textfile collector of Prometheus node exporter")
+        self._parser.add_argument('--metrics-prometheus-update-interval', type=int, default=metrics.MetricsCollector().prometheus_update_interval,
+                                  help="Interval of rewriting the file specified with --metrics-prometheus-textfile, in seconds (default: %(default)s)")
+        self._parser.add_argument('--watch', action="store_true",
+                                  help="After handling of input files keep running and watch --input-folder folders for changes: hashes are calculated for created "
+                                  "and modified files and removed for deleted files. This works with --single-hash-file-name-base, --single-hash-file-name-base-json or --single-hash-file-name-base-binary only. "
+                                  "The program runs until it is interrupted with Ctrl+C or SIGTERM. Hashes are saved according to --autosave-timeout and on exit. "
+                                  "inotify is used on Linux, otherwise folders are rescanned periodically. Folders are rescanned also if inotify can't be started, "
+                                  "e.g. due to the limit of watches. Subfolders excluded with --input-folder-dir-mask-exclude and --input-folder-dir-mask-include are not watched")
+        self._parser.add_argument('--watch-debounce', type=float, default=watcher.ChangeDebouncer().delay,
+                                  help="Calculate hash for the changed file when it is not changed for the specified time, in seconds (default: %(default)s). "
+                                  "So the file which is being written is handled once")
+        self._parser.add_argument('--watch-polling-interval', type=float, default=10.0,
+                                  help="Interval of rescanning input folders when inotify is not available or --watch-use-polling is specified, in seconds (default: %(default)s)")
+        self._parser.add_argument('--watch-use-polling', action="store_true",
+                                  help="Rescan input folders periodically instead of using inotify, e.g. for network file systems which don't report changes")
+        self._parser.add_argument('--serve', metavar="SOCKET_PATH",
+                                  help="Load hash file once and answer requests for hashes on the specified Unix domain socket until the program is interrupted with Ctrl+C or SIGTERM. "
+                                  "Requests and responses are JSON objects, one per line: lookup of hashes, check if hashes exist and calculation of missing hashes. "
+                                  "Input files and folders are not specified in this mode. This works with --single-hash-file-name-base, --single-hash-file-name-base-json or --single-hash-file-name-base-binary only")
+        self._parser.add_argument('--convert-hash-file', nargs=2, metavar=("SOURCE", "DESTINATION"),
+                                  help="Convert hash file with hashes for many files to other format and exit. Format is chosen by file name extension: "
+                                  f"'{hash_storages.BinaryCatalogHashesStorage.extension}' for binary catalog, '.json' for JSON, otherwise text. "
+                                  "Extension of compression (.gz, .xz, .bz2) may follow '.json' and text ones. Input files and folders are not specified in this mode")
+        self._parser.add_argument('--compare-hash-files', nargs=2, metavar=("OLD", "NEW"),
+                                  help="Compare two hash files with hashes for many files and exit. Added, removed, modified and renamed (the same hash with other file name) "
+                                  "files are printed one per line. Hash files are read in streaming fashion and compared with merge-join, so they are not loaded into memory, "
+                                  "only records of added and removed files are kept to find renamed ones (see --compare-no-rename-detection). "
+                                  "File names are compared as they are stored, so hash files should contain file names of the same kind. "
+                                  "Text and JSON hash files should be sorted by file names, binary catalog can be compared with binary catalog only. "
+                                  "Input files and folders are not specified in this mode")
+        self._parser.add_argument('--compare-no-rename-detection', action="store_true",
+                                  help="Don't detect renamed files with --compare-hash-files, they are reported as removed and added. "
+                                  "All records are printed during comparison in order of file names, so memory usage doesn't depend on count of changes")
+        self._parser.add_argument('--merge-hash-files', nargs="+", metavar=("DESTINATION", "SOURCE"),
+                                  help="Merge text and JSON hash files with hashes for many files, e.g. hash files of shards (see --shard), into the destination hash file and exit. "
+                                  "Format of the destination is chosen by file name extension: '.json' for JSON, otherwise text. "
+                                  "Hash files are merged in streaming fashion, so they are not loaded into memory. They should be sorted by file names. "
+                                  "File names are stored as they are in the source hash files, so relative file names are allowed only if the source hash file "
+                                  "is in the folder of the destination one. Input files and folders are not specified in this mode")
+        self._parser.add_argument('--profile', action="store_true",
+                                  help="Measure time spent in the phases of the program run: enumeration of input files, data reading, hash calculation, "
+                                  "progress reporting, file names handling, loading and saving hash storage. The report is printed to stderr at the end of the run")
+        self._parser.add_argument('--profile-cprofile-file',
+                                  help="Profile the program run with cProfile and dump statistics to the specified file. "
+                                  "Ref: https://docs.python.org/3/library/profile.html")
+        self._parser.add_argument('--profile-tracemalloc-file',
+                                  help="Trace memory allocations during the program run, dump snapshot to the specified file and print top allocations to stderr. "
+                                  "Ref: https://docs.python.org/3/library/tracemalloc.html")
 
     def _postprocess_parsed_args(self):
-        if (not self._cmd_line_args.input_file and not self._cmd_line_args.input_folder):
+        if self._cmd_line_args.serve:
+            if self._input_specified():
+                self._parser.error("Input files and folders can't be specified with --serve")
+            if not self._single_hash_file_specified():
+                self._parser.error('--serve requires --single-hash-file-name-base, --single-hash-file-name-base-json or --single-hash-file-name-base-binary')
+        elif self._cmd_line_args.convert_hash_file:
+            if self._input_specified():
+                self._parser.error("Input files and folders can't be specified with --convert-hash-file")
+        elif self._cmd_line_args.compare_hash_files:
+            if self._input_specified():
+                self._parser.error("Input files and folders can't be specified with --compare-hash-files")
+        elif self._cmd_line_args.compare_no_rename_detection:
+            self._parser.error("--compare-no-rename-detection requires --compare-hash-files")
+        elif self._cmd_line_args.merge_hash_files:
+            if self._input_specified():
+                self._parser.error("Input files and folders can't be specified with --merge-hash-files")
+            if len(self._cmd_line_args.merge_hash_files) < 2:
+                self._parser.error("--merge-hash-files requires destination and one or more source hash files")
+        elif not self._input_specified():
             self._parser.error("One or more input files and/or folders should be specified")
 
+        if self._cmd_line_args.hash_archive_members:
+            if not self._single_hash_file_specified():
+                self._parser.error('--hash-archive-members requires --single-hash-file-name-base, --single-hash-file-name-base-json or --single-hash-file-name-base-binary')
+            if self._cmd_line_args.copy_to:
+                self._parser.error("--hash-archive-members can't be specified with --copy-to")
+
+        if self._cmd_line_args.folder_hashes:
+            if not (self._cmd_line_args.single_hash_file_name_base or self._cmd_line_args.single_hash_file_name_base_json):
+                self._parser.error('--folder-hashes requires --single-hash-file-name-base or --single-hash-file-name-base-json')
+            if self._cmd_line_args.watch or self._cmd_line_args.serve:
+                self._parser.error("--folder-hashes can't be specified with --watch or --serve")
+            if not (self._cmd_line_args.input_folder or self._cmd_line_args.copy_to):
+                self._parser.error("--folder-hashes requires input folder or --copy-to")
+
+        if self._cmd_line_args.copy_to:
+            if self._cmd_line_args.serve or self._cmd_line_args.convert_hash_file or self._cmd_line_args.compare_hash_files or \
+               self._cmd_line_args.merge_hash_files or self._cmd_line_args.watch:
+                self._parser.error("--copy-to can't be specified with --serve, --convert-hash-file, --compare-hash-files, --merge-hash-files or --watch")
+            copy_to = os.path.normcase(os.path.abspath(self._cmd_line_args.copy_to))
+            for input_folder in self._cmd_line_args.input_folder or []:
+                input_folder = os.path.normcase(os.path.abspath(input_folder))
+                if copy_to == input_folder or copy_to.startswith(os.path.join(input_folder, "")):
+                    self._parser.error("--copy-to folder can't be inside of input folder")
+        elif self._cmd_line_args.copy_verify:
+            self._parser.error("--copy-verify requires --copy-to")
+
+        if self._cmd_line_args.dedup_analysis:
+            if self._cmd_line_args.serve or self._cmd_line_args.convert_hash_file or self._cmd_line_args.compare_hash_files or \
+               self._cmd_line_args.merge_hash_files or self._cmd_line_args.watch:
+                self._parser.error("--dedup-analysis can't be specified with --serve, --convert-hash-file, --compare-hash-files, --merge-hash-files or --watch")
+            chunk_size = self._cmd_line_args.dedup_analysis_chunk_size
+            if chunk_size < 256 or chunk_size > 64 * 1024 * 1024 or chunk_size & (chunk_size - 1):
+                self._parser.error("--dedup-analysis-chunk-size must be power of two from 256 to 64 MiB")
+            # Data of all files is needed for analysis, so hashes of all files are calculated and stored again
+            if not self._cmd_line_args.force_calc_hash:
+                self._parser.error("--dedup-analysis requires --force-calc-hash, because all input files should be read")
+
+        if self._cmd_line_args.shard is not None and (self._cmd_line_args.serve or self._cmd_line_args.convert_hash_file or self._cmd_line_args.compare_hash_files or
+                                                      self._cmd_line_args.merge_hash_files or self._cmd_line_args.watch):
+            self._parser.error("--shard can't be specified with --serve, --convert-hash-file, --compare-hash-files, --merge-hash-files or --watch")
+        if self._cmd_line_args.shard is not None and self._cmd_line_args.folder_hashes:
+            # Hashes of folders would be calculated over the files of the shard only, and they would conflict on merge
+            self._parser.error("--shard can't be specified with --folder-hashes")
+
+        if self._cmd_line_args.input_file_list_null and not self._cmd_line_args.input_file_list:
+            self._parser.error("--input-file-list-null requires --input-file-list")
+
         if self._cmd_line_args.hash_file_name_output_postfix and len(self._cmd_line_args.hash_file_name_output_postfix) > 1:
             self._parser.error("--hash-file-name-output-postfix appears several times.")
 
         if self._cmd_line_args.pause_after_file and self._cmd_line_args.pause_after_file < 0:
             self._parser.error('--pause-after-file must be non-negative')
 
+        if self._cmd_line_args.small_file_threshold < 0:
+            self._parser.error('--small-file-threshold must be non-negative')
+
+        if self._cmd_line_args.max_read_rate is not None and self._cmd_line_args.max_read_rate <= 0:
+            self._parser.error('--max-read-rate must be positive')
+
+        if self._cmd_line_args.io_priority_level is not None and self._cmd_line_args.io_priority_class is None:
+            self._parser.error('--io-priority-level can be specified with --io-priority-class only')
+
+        if self._cmd_line_args.metrics_prometheus_update_interval < 0:
+            self._parser.error('--metrics-prometheus-update-interval must be non-negative')
+
+        if self._cmd_line_args.watch:
+            if not self._cmd_line_args.input_folder:
+                self._parser.error('--watch requires --input-folder')
+            if self._cmd_line_args.input_file_list:
+                self._parser.error("--input-file-list can't be specified with --watch, the list is read once")
+            if not self._single_hash_file_specified():
+                self._parser.error('--watch requires --single-hash-file-name-base, --single-hash-file-name-base-json or --single-hash-file-name-base-binary')
+
+        if self._cmd_line_args.watch_debounce < 0:
+            self._parser.error('--watch-debounce must be non-negative')
+
+        if self._cmd_line_args.watch_polling_interval <= 0:
+            self._parser.error('--watch-polling-interval must be positive')
+
         if self._cmd_line_args.single_hash_file_name_base is not None and len(self._cmd_line_args.single_hash_file_name_base) > 0 and \
            self._cmd_line_args.single_hash_file_name_base_json is not None and len(self._cmd_line_args.single_hash_file_name_base_json) > 0:
             self._parser.error("--single-hash-file-name-base and --single-hash-file-name-base-json are mutually exclusive. Only one of them can be specified")
 
+        if self._cmd_line_args.single_hash_file_name_base_binary:
+            if self._cmd_line_args.single_hash_file_name_base or self._cmd_line_args.single_hash_file_name_base_json:
+                self._parser.error("--single-hash-file-name-base-binary can't be specified with --single-hash-file-name-base or --single-hash-file-name-base-json")
+            if len(self._cmd_line_args.single_hash_file_name_base_binary) > 1:
+                self._parser.error("--single-hash-file-name-base-binary should be either specified once or not specified")
+            self._cmd_line_args.single_hash_file_name_base_binary = self._cmd_line_args.single_hash_file_name_base_binary[0]
+
+        if self._cmd_line_args.per_directory_hash_file_name_base is not None:
+            if self._single_hash_file_specified():
+                self._parser.error("--per-directory-hash-file-name-base can't be specified with --single-hash-file-name-base, --single-hash-file-name-base-json or --single-hash-file-name-base-binary")
+            per_directory_hash_file_name_base = self._cmd_line_args.per_directory_hash_file_name_base
+            if not per_directory_hash_file_name_base or os.path.basename(per_directory_hash_file_name_base) != per_directory_hash_file_name_base:
+                self._parser.error("--per-directory-hash-file-name-base should be file name without path")
+
+        if self._cmd_line_args.hash_file_compression not in ("none", "auto") and \
+           not self._cmd_line_args.single_hash_file_name_base and not self._cmd_line_args.single_hash_file_name_base_json:
+            self._parser.error("--hash-file-compression requires --single-hash-file-name-base or --single-hash-file-name-base-json")
+
         if self._cmd_line_args.single_hash_file_name_base:
             if len(self._cmd_line_args.single_hash_file_name_base) > 1:
                 self._parser.error("--single-hash-file-name-base should be either specified once or not specified")
@@ -171,6 +459,19 @@ class CommandLineAdapter(object):
                 self._parser.error("--single-hash-file-name-base-json should be either specified once or not specified")
             self._cmd_line_args.single_hash_file_name_base_json = self._cmd_line_args.single_hash_file_name_base_json[0]
 
+        # Masks are compiled once, they are matched with every file
+        self._file_mask_include = util.compile_file_masks(self._cmd_line_args.input_folder_file_mask_include)
+        self._file_mask_exclude = util.compile_file_masks(self._cmd_line_args.input_folder_file_mask_exclude)
+        self._dir_mask_include = util.compile_file_masks(self._cmd_line_args.input_folder_dir_mask_include)
+        self._dir_mask_exclude = util.compile_file_masks(self._cmd_line_args.input_folder_dir_mask_exclude)
+
+    def _input_specified(self):
+        return bool(self._cmd_line_args.input_file or self._cmd_line_args.input_folder or self._cmd_line_args.input_file_list)
+
+    def _single_hash_file_specified(self):
+        return bool(self._cmd_line_args.single_hash_file_name_base or self._cmd_line_args.single_hash_file_name_base_json or
+                    self._cmd_line_args.single_hash_file_name_base_binary)
+
     def _get_hash_file_name_postfix(self):
 
         postfix = ""
@@ -179,6 +480,8 @@ class CommandLineAdapter(object):
             postfix += "." + self._cmd_line_args.hash_algo
             if self._cmd_line_args.single_hash_file_name_base_json:
                 postfix += ".json"
+            if self._cmd_line_args.single_hash_file_name_base_binary:
+                postfix += hash_storages.BinaryCatalogHashesStorage.extension
 
         if self._cmd_line_args.add_output_file_name_timestamp:
             postfix += "." + self._start_time_dict["file_postfix"]
@@ -186,11 +489,232 @@ class CommandLineAdapter(object):
         if self._cmd_line_args.hash_file_name_output_postfix:
             postfix += "." + self._cmd_line_args.hash_file_name_output_postfix[0]
 
+        # Extension of compressed file should be the last one
+        compression_format = hash_storages.compression_formats.get(self._cmd_line_args.hash_file_compression)
+        if compression_format is not None and not self._cmd_line_args.suppress_hash_file_name_postfix:
+            postfix += compression_format[0]
+
         return postfix
 
-    def _handle_input_file(self, hash_storage: hash_storages.HashStorageAbstract, input_file_name):
+    def _create_file_hash_calc(self):
+        """
+        Create hash calculator configured according to the command line parameters. File name should be assigned by caller
+        """
+        calc = hash_calc.FileHashCalc()
+        calc.hash_str = self._cmd_line_args.hash_algo
+        calc.suppress_console_reporting_output = self._cmd_line_args.suppress_console_reporting_output
+        calc.retry_count_on_data_read_error = self._cmd_line_args.retry_count_on_data_read_error
+        calc.retry_pause_on_data_read_error = self._cmd_line_args.retry_pause_on_data_read_error
+        calc.read_rate_limiter = self._read_rate_limiter
+        calc.profiler = self._profiler
+        calc.chunk_index = self._chunk_index
+        calc.chunk_average_size = self._cmd_line_args.dedup_analysis_chunk_size
+        return calc
+
+    def _has_hash(self, hash_storage: hash_storages.HashStorageAbstract, input_file_name):
+        if self._profiler is None:
+            return hash_storage.has_hash(input_file_name)
+        moment = self._profiler.start()
+        ret = hash_storage.has_hash(input_file_name)
+        self._profiler.add_since("storage_has_hash", moment)
+        return ret
+
+    def _set_hash(self, hash_storage: hash_storages.HashStorageAbstract, data_file_name, hash_value):
+        if self._profiler is None:
+            hash_storage.set_hash(data_file_name, hash_value)
+            return
+        moment = self._profiler.start()
+        hash_storage.set_hash(data_file_name, hash_value)
+        self._profiler.add_since("storage_set_hash", moment)
+
+    def _set_hashes(self, hash_storage: hash_storages.HashStorageAbstract, hash_items):
+        if self._profiler is None:
+            hash_storage.set_hashes(hash_items)
+            return
+        moment = self._profiler.start()
+        hash_storage.set_hashes(hash_items)
+        self._profiler.add_since("storage_set_hash", moment)
+
+    def _apply_process_priority(self):
+        """
+        Setup resources usage for the whole program according to the command line parameters
+        """
+        if self._cmd_line_args.max_read_rate is not None:
+            # One bucket is shared by all files, so the limit is for the program rather than for a single file
+            self._read_rate_limiter = util.TokenBucket(self._cmd_line_args.max_read_rate)
+
+        if self._cmd_line_args.io_priority_class is not None:
+            io_priority_level = self._cmd_line_args.io_priority_level if self._cmd_line_args.io_priority_level is not None else 4
+            util.set_process_io_priority(self._cmd_line_args.io_priority_class, io_priority_level)
+
+        if self._cmd_line_args.cpu_niceness is not None:
+            util.set_process_cpu_niceness(self._cmd_line_args.cpu_niceness)
+
+    def _add_file_metrics(self, input_file_name, file_size, calc: hash_calc.FileHashCalc = None, duration = 0.0, skip_reason = None, failed = False):
+        if self._metrics is None:
+            return
+        bytes_read = calc.bytes_read if calc is not None else 0
+        retries = calc.retry_count if calc is not None else 0
+        self._metrics.add_file_record(input_file_name, file_size, bytes_read, duration, retries, skip_reason, failed)
+
+    def _get_hardlink_key(self, file_stat: os.stat_result):
+        """
+        Return key of the physical file which has several hard links, or None if the file has the only link or deduplication is suppressed.
+        Size and modification time are in the key, so the file modified during the run is not taken for the same one
+        """
+        if self._cmd_line_args.suppress_hardlink_dedup or self._cmd_line_args.copy_to or file_stat.st_nlink <= 1 or file_stat.st_ino == 0:
+            return None
+        return (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+
+    def _remember_hardlink_hash(self, hardlink_key, hash_value):
+        if hardlink_key is not None and hash_value is not None:
+            self._hardlink_hashes.setdefault(hardlink_key, hash_value)
+
+    def _reuse_hardlink_hash(self, hash_storage: hash_storages.HashStorageAbstract, input_file_name, file_size, hardlink_key, small_file_batch = None):
         """
-        Handle single input file input_file_name
+        Store the hash calculated in this run for other hard link of the file. Returns False if there is no such hash
+        """
+        hash_value = self._hardlink_hashes.get(hardlink_key) if hardlink_key is not None else None
+        if hash_value is None:
+            return False
+        if small_file_batch is not None:
+            small_file_batch.append((input_file_name, hash_value))
+        else:
+            self._info(f"Hash for file '{input_file_name}' is taken from other hard link of the file: {hash_value}")
+            self._set_hashes(hash_storage, [(input_file_name, hash_value)])
+        self._add_file_metrics(input_file_name, file_size, skip_reason="hardlink")
+        self._hardlink_saved_file_count += 1
+        self._hardlink_saved_size += file_size if file_size is not None else 0
+        return True
+
+    def _handle_small_input_file(self, hash_storage: hash_storages.HashStorageAbstract, calc: hash_calc.FileHashCalc, input_file_name, file_size, small_file_batch,
+                                 hardlink_key = None):
+        """
+        Handle small input file in fast path. There is no per-file reporting, and the hash is appended to `small_file_batch`
+        to be passed to the storage later with `_flush_small_file_batch`.
+
+        Returns ExitCode the same way as `_handle_input_file`. If file can't be read in fast path, it is handled with `_handle_input_file`.
+        """
+        if not self._cmd_line_args.force_calc_hash and self._has_hash(hash_storage, input_file_name):
+            if hardlink_key is not None and hardlink_key not in self._hardlink_hashes:
+                self._remember_hardlink_hash(hardlink_key, hash_storage.get_hash(input_file_name))
+            self._add_file_metrics(input_file_name, file_size, skip_reason="hash_exists")
+            return ExitCode.OK_SKIPPED_ALREADY_CALCULATED
+
+        if self._reuse_hardlink_hash(hash_storage, input_file_name, file_size, hardlink_key, small_file_batch):
+            return ExitCode.OK_SKIPPED_ALREADY_CALCULATED
+
+        if util.is_program_interrupted_by_user():
+            return ExitCode.PROGRAM_INTERRUPTED_BY_USER
+
+        calc.file_name = input_file_name
+        # Timing is skipped in fast path if it is not needed for metrics
+        start_moment = time.perf_counter() if self._metrics is not None else 0.0
+        try:
+            calc.run_small_file()
+        except OSError:
+            # Regular handling reports the error and supports retries
+            return self._handle_input_file(hash_storage, input_file_name, file_size, hardlink_key=hardlink_key)
+
+        small_file_batch.append((input_file_name, calc.result))
+        self._remember_hardlink_hash(hardlink_key, calc.result)
+        if self._metrics is not None:
+            self._add_file_metrics(input_file_name, file_size, calc, time.perf_counter() - start_moment)
+        return ExitCode.OK
+
+    def _flush_small_file_batch(self, hash_storage: hash_storages.HashStorageAbstract, small_file_batch):
+        if not small_file_batch:
+            return
+        self._set_hashes(hash_storage, small_file_batch)
+        small_file_batch.clear()
+
+    def _handle_archive_file(self, hash_storage: hash_storages.HashStorageAbstract, archive_file_name):
+        """
+        Calculate hashes of the members of the archive in one pass. Hashes are passed to the storage in batches.
+        Hashes of the members read before an error are stored
+        """
+        self._info(f"Calculate hashes for members of archive '{archive_file_name}'...")
+        calc = self._create_file_hash_calc()
+        hash_items = []
+        member_count = 0
+        ret = ExitCode.OK
+        try:
+            for member_name, member_size, f in archive_members.iter_members(archive_file_name):
+                if util.is_program_interrupted_by_user():
+                    ret = ExitCode.PROGRAM_INTERRUPTED_BY_USER
+                    break
+                try:
+                    member_file_name = archive_members.get_member_file_name(archive_file_name, member_name)
+                except ValueError as err:
+                    self._info(f"{err}. Member is skipped")
+                    ret = ExitCode.DATA_READ_ERROR
+                    continue
+                start_moment = time.perf_counter()
+                calc.run_stream(f)
+                self._add_file_metrics(member_file_name, member_size, calc, time.perf_counter() - start_moment)
+                hash_items.append((member_file_name, calc.result))
+                member_count += 1
+                if len(hash_items) >= self.small_file_batch_size:
+                    self._flush_small_file_batch(hash_storage, hash_items)
+        except (OSError, archive_members.ArchiveError) as err:
+            self._info(f"Error on reading archive '{archive_file_name}': {err}")
+            self._add_file_metrics(archive_file_name, None, skip_reason="data_read_error", failed=True)
+            ret = ExitCode.DATA_READ_ERROR
+        self._flush_small_file_batch(hash_storage, hash_items)
+        self._info(f"Hashes of {member_count} member(s) of archive '{archive_file_name}' are calculated")
+        return ret
+
+    def _get_copy_destination(self, input_file_name):
+        """
+        Name of the copy of the input file in --copy-to folder. Path relative to input folder is preserved for the files of input folders
+        """
+        for input_folder in self._cmd_line_args.input_folder or []:
+            try:
+                rel_file_name = os.path.relpath(input_file_name, input_folder)
+            except ValueError:
+                continue # Other drive on Windows
+            if not rel_file_name.startswith(os.pardir + os.sep):
+                return os.path.join(self._cmd_line_args.copy_to, rel_file_name)
+        return os.path.join(self._cmd_line_args.copy_to, os.path.basename(input_file_name))
+
+    def _register_copy_destination(self, input_file_name, copy_to_file_name):
+        """
+        Remember the source of the copy. Return False if other file of this run has the same destination, e.g. input files with equal names
+        in different folders, otherwise one of the copies would be lost
+        """
+        source_file_name = self._copy_sources.setdefault(os.path.normcase(os.path.abspath(copy_to_file_name)), input_file_name)
+        if os.path.normcase(os.path.abspath(source_file_name)) == os.path.normcase(os.path.abspath(input_file_name)):
+            return True
+        self._info(f"Files '{source_file_name}' and '{input_file_name}' have the same destination '{copy_to_file_name}'. File '{input_file_name}' is not copied")
+        return False
+
+    def _verify_copy(self, calc: hash_calc.FileHashCalc):
+        """
+        Calculate hashes of the copy made by `calc` and compare them with the hashes of the source. The copy is removed if hashes are different
+        """
+        copy_to_file_name = calc.copy_to_file_name
+        self._info(f"Verify copy '{copy_to_file_name}'")
+        # The copy is flushed on replacement unless fsync is disabled, otherwise cached data may be not dropped
+        util.drop_file_cache(copy_to_file_name)
+        verify_calc = self._create_file_hash_calc()
+        verify_calc.chunk_index = None # Data of the copy is the same, it should not be counted twice
+        verify_calc.file_name = copy_to_file_name
+        verify_calc.hash_strs = tuple(calc.results)
+        verify_calc_res = verify_calc.run()
+        calc.bytes_read += verify_calc.bytes_read
+        if verify_calc_res != hash_calc.FileHashCalc.ReturnCode.OK:
+            return verify_calc_res
+        if verify_calc.results != calc.results:
+            self._info(f"Hash of the copy '{copy_to_file_name}' differs from the hash of the source '{calc.file_name}': {verify_calc.result} != {calc.result}. "
+                       "The copy is removed")
+            os.remove(copy_to_file_name)
+            return hash_calc.FileHashCalc.ReturnCode.DATA_READ_ERROR
+        return hash_calc.FileHashCalc.ReturnCode.OK
+
+    def _handle_input_file(self, hash_storage: hash_storages.HashStorageAbstract, input_file_name, file_size = None, force_calc_hash = False, hardlink_key = None):
+        """
+        Handle single input file input_file_name. Hash is calculated even if it exists in the storage if `force_calc_hash` is True, e.g. when file is modified.
+        Hash is calculated once per run for the file with several hard links if `hardlink_key` is specified
         """
         if not isinstance(hash_storage, hash_storages.HashStorageAbstract):
             raise TypeError(f"HashStorageAbstract expected, {type(hash_storage)} found")
@@ -198,32 +722,55 @@ class CommandLineAdapter(object):
         start_date_time = datetime.now()
         self._info("Handle file start time: " + util.get_datetime_str(start_date_time) + " (" + input_file_name + ")")
 
+        # Hash of the copy is stored in copy mode
+        copy_to_file_name = self._get_copy_destination(input_file_name) if self._cmd_line_args.copy_to else None
+        stored_file_name = copy_to_file_name or input_file_name
+        if copy_to_file_name is not None and not self._register_copy_destination(input_file_name, copy_to_file_name):
+            self._add_file_metrics(input_file_name, file_size, skip_reason="copy_destination_conflict", failed=True)
+            return ExitCode.DATA_READ_ERROR
+
         # Ref: https://stackoverflow.com/questions/82831/how-do-i-check-whether-a-file-exists-without-exceptions
-        if not self._cmd_line_args.force_calc_hash and hash_storage.has_hash(input_file_name):
-            self._info("Hash for file '" + input_file_name + "' exists ... calculation of hash skipped.")
+        if not (force_calc_hash or self._cmd_line_args.force_calc_hash) and self._has_hash(hash_storage, stored_file_name) and \
+           (copy_to_file_name is None or os.path.isfile(copy_to_file_name)):
+            self._info("Hash for file '" + stored_file_name + "' exists ... calculation of hash skipped.")
+            if hardlink_key is not None and hardlink_key not in self._hardlink_hashes:
+                self._remember_hardlink_hash(hardlink_key, hash_storage.get_hash(input_file_name))
+            self._add_file_metrics(input_file_name, file_size, skip_reason="hash_exists")
+            return ExitCode.OK_SKIPPED_ALREADY_CALCULATED
+
+        if self._reuse_hardlink_hash(hash_storage, input_file_name, file_size, hardlink_key):
             return ExitCode.OK_SKIPPED_ALREADY_CALCULATED
         self._info("Calculate hash for file '" + input_file_name + "'...")
 
-        calc = hash_calc.FileHashCalc()
+        calc = self._create_file_hash_calc()
         calc.file_name = input_file_name
-        calc.hash_str = self._cmd_line_args.hash_algo
-        calc.suppress_console_reporting_output = self._cmd_line_args.suppress_console_reporting_output
-        calc.retry_count_on_data_read_error = self._cmd_line_args.retry_count_on_data_read_error
-        calc.retry_pause_on_data_read_error = self._cmd_line_args.retry_pause_on_data_read_error
+        if copy_to_file_name is not None:
+            self._info(f"Copy to '{copy_to_file_name}'")
+            os.makedirs(os.path.dirname(copy_to_file_name), exist_ok=True)
+            calc.copy_to_file_name = copy_to_file_name
+            calc.copy_fsync_policy = self._cmd_line_args.hash_file_fsync_policy
 
+        start_moment = time.perf_counter()
         calc_res = calc.run()
+        if calc_res == hash_calc.FileHashCalc.ReturnCode.OK and copy_to_file_name is not None and self._cmd_line_args.copy_verify:
+            calc_res = self._verify_copy(calc)
+        duration = time.perf_counter() - start_moment
         if calc_res != hash_calc.FileHashCalc.ReturnCode.OK:
             if calc_res == hash_calc.FileHashCalc.ReturnCode.PROGRAM_INTERRUPTED_BY_USER:
+                self._add_file_metrics(input_file_name, file_size, calc, duration, skip_reason="interrupted")
                 return ExitCode.PROGRAM_INTERRUPTED_BY_USER
             elif calc_res == hash_calc.FileHashCalc.ReturnCode.DATA_READ_ERROR:
+                self._add_file_metrics(input_file_name, file_size, calc, duration, skip_reason="data_read_error", failed=True)
                 return ExitCode.DATA_READ_ERROR
             else:
                 raise Exception(f"Error on calculation of the hash: {calc_res}")
         hash_value = calc.result
+        self._add_file_metrics(input_file_name, file_size, calc, duration)
+        self._remember_hardlink_hash(hardlink_key, hash_value)
 
-        hash_storage.set_hash(input_file_name, hash_value)
+        self._set_hash(hash_storage, stored_file_name, hash_value)
 
-        output_file_name = hash_storage.get_hash_file_name(input_file_name)
+        output_file_name = hash_storage.get_hash_file_name(stored_file_name)
         self._info("HASH:", hash_value, "(storage in file '" + output_file_name + "')")
 
         end_date_time = datetime.now()
@@ -231,42 +778,97 @@ class CommandLineAdapter(object):
         seconds = int((end_date_time - start_date_time).total_seconds())
         # print("Elapsed time: {0}:{1:02d}:{2:02d}".format(int(seconds / 60 / 60), int(seconds / 60) % 60, seconds % 60))
 
-        file_size = os.path.getsize(input_file_name)
+        if file_size is None:
+            file_size = os.path.getsize(input_file_name)
         speed = file_size / seconds if seconds > 0 else 0
         self._info(f"Elapsed time for file: {util.format_seconds(seconds)} (Average speed: {util.convert_size_to_display(speed)}/sec)")
-     
-        if self._cmd_line_args.pause_after_file is not None:
-            if not util.pause(self._cmd_line_args.pause_after_file):
-                # Return specific error code
-                return ExitCode.PROGRAM_INTERRUPTED_BY_USER
-
         return ExitCode.OK
 
+    def _pause_after_file(self):
+        """
+        Pause after handled file if --pause-after-file is specified. Return False if the program is interrupted during the pause
+        """
+        if self._cmd_line_args.pause_after_file is None:
+            return True
+        return util.pause(self._cmd_line_args.pause_after_file)
+
     def _file_masks_included(self, file_name):
         """
+        Include mask is matched with the whole file name, exclude mask is matched with the base name
+
         Ref: "Extract file name from path, no matter what the os/path format" https://stackoverflow.com/a/8384788/13441
         """
-        # base_file_name = ntpath.basename(file_name)
-        base_file_name = os.path.basename(file_name)
+        if self._file_mask_include is not None and not self._file_mask_include.fullmatch(os.path.normcase(file_name)):
+            return False
+        if self._file_mask_exclude is not None and self._file_mask_exclude.fullmatch(os.path.normcase(os.path.basename(file_name))):
+            return False
+        return True
 
+    def _shard_included(self, file_key):
+        """
+        Check if the file belongs to the shard specified with --shard. Key is the path relative to input folder or absolute path
+        """
+        if self._cmd_line_args.shard is None:
+            return True
+        shard_index, shard_count = self._cmd_line_args.shard
+        # Key is the same on all platforms
+        return util.get_shard_index(file_key.replace(os.sep, "/"), shard_count) == shard_index
 
-        if self._cmd_line_args.input_folder_file_mask_include:
-            file_included = False
-            include_masks = self._cmd_line_args.input_folder_file_mask_include.split(";")
-            for include_mask in include_masks:
-                if fnmatch.fnmatch(file_name, include_mask):
-                    file_included = True
-                    break
-            if not file_included:
-                return False
-
-        if self._cmd_line_args.input_folder_file_mask_exclude:
-            exclude_masks = self._cmd_line_args.input_folder_file_mask_exclude.split(";")
-            for exclude_mask in exclude_masks:
-                if fnmatch.fnmatch(base_file_name, exclude_mask):
-                    return False
+    def _dir_masks_included(self, dir_name, top_level):
+        """
+        Check base name of the subfolder. Include masks are checked for subfolders of input folder only (`top_level`)
+        """
+        dir_name = os.path.normcase(dir_name)
+        if top_level and self._dir_mask_include is not None and not self._dir_mask_include.fullmatch(dir_name):
+            return False
+        if self._dir_mask_exclude is not None and self._dir_mask_exclude.fullmatch(dir_name):
+            return False
         return True
 
+    def _path_dir_masks_included(self, file_name):
+        """
+        Check all subfolders on the path of the file from input folder, e.g. for the changes reported by watcher
+        """
+        if self._dir_mask_include is None and self._dir_mask_exclude is None:
+            return True
+        for input_folder in self._cmd_line_args.input_folder:
+            rel_dir_name = os.path.relpath(os.path.dirname(file_name), input_folder)
+            if rel_dir_name == os.pardir or rel_dir_name.startswith(os.pardir + os.sep):
+                continue
+            if rel_dir_name == os.curdir:
+                return True
+            dir_names = rel_dir_name.split(os.sep)
+            return all(self._dir_masks_included(dir_name, di == 0) for di, dir_name in enumerate(dir_names))
+        return True
+
+    def _order_input_files(self, input_file_names, input_file_stats):
+        """
+        Reorder input files sorted by names according to --input-file-order. Return pair of reordered lists (file names, stats).
+
+        On rotational disk reading of many small files in order of names results in a seek per file, reading in order of location on the disk reduces seeks.
+        Inode number is a cheap proxy of the location on many file systems, e.g. ext4 allocates data near the inode.
+        Physical offset of the first extent is precise, but it requires opening of every file, and it is supported on Linux only.
+        Sort is stable, so files with equal keys remain in order of names.
+
+        Ref: https://www.kernel.org/doc/html/latest/filesystems/fiemap.html
+        """
+        input_file_order = self._cmd_line_args.input_file_order
+        if input_file_order == "name":
+            return input_file_names, input_file_stats
+
+        if input_file_order == "inode":
+            keys = [(file_stat.st_dev, file_stat.st_ino) for file_stat in input_file_stats]
+        else:
+            assert input_file_order == "physical"
+            keys = []
+            for input_file_name, file_stat in zip(input_file_names, input_file_stats):
+                physical_offset = util.get_file_physical_offset(input_file_name)
+                # Files without known location, e.g. empty ones, are read first in order of inodes
+                keys.append((file_stat.st_dev, -1 if physical_offset is None else physical_offset, file_stat.st_ino))
+
+        indexes = sorted(range(len(input_file_names)), key=keys.__getitem__)
+        return [input_file_names[i] for i in indexes], [input_file_stats[i] for i in indexes]
+
     def _handle_input_files(self, hash_storage: hash_storages.HashStorageAbstract):
         """
         Handle input files according to the parameters from user
@@ -275,20 +877,15 @@ class CommandLineAdapter(object):
         if not isinstance(hash_storage, hash_storages.HashStorageAbstract):
             raise TypeError(f"HashStorageAbstract expected, {type(hash_storage)} found")
 
-        header_comments = [
-             "File generated by Smart Hasher (https://github.com/sergtk/smart_hasher)",
-            f"Timestamp of hash calculation: {self._start_time_dict['str']}",
-            f"Hash algorithm: {self._cmd_line_args.hash_algo}"]
-        if self._cmd_line_args.user_comment:
-            header_comments = header_comments + [f"User comment: {cmt}" for cmt in self._cmd_line_args.user_comment]
-        hash_storage.hash_file_header_comments = header_comments
-
-        hash_storage.suppress_hash_file_comments = self._cmd_line_args.suppress_output_file_comments
+        if self._profiler is not None:
+            moment = self._profiler.start()
 
         input_file_names = []
 
         if self._cmd_line_args.input_file:
             for input_file_name in self._cmd_line_args.input_file:
+                if not self._shard_included(os.path.abspath(input_file_name)):
+                    continue
                 if not os.path.isfile(input_file_name):
                     self._info(f"Input file does not exist: {input_file_name}")
                     return ExitCode.DATA_READ_ERROR
@@ -301,10 +898,17 @@ class CommandLineAdapter(object):
                 if not os.path.isdir(input_folder):
                     self._info(f"Input folder does not exist: {input_folder}")
                     return ExitCode.DATA_READ_ERROR
-                for dir_name, _, file_list in os.walk(input_folder):
+                # Names of all files start with the input folder, so the relative path for --shard is the suffix
+                input_folder_prefix_len = len(os.path.join(input_folder, ""))
+                for dir_name, dir_list, file_list in os.walk(input_folder):
+                    # Excluded subfolders are pruned, so they are not walked. Ref: https://docs.python.org/3/library/os.html#os.walk (topdown)
+                    if self._dir_mask_include is not None or self._dir_mask_exclude is not None:
+                        top_level = dir_name == input_folder
+                        dir_list[:] = [sub_dir_name for sub_dir_name in dir_list if self._dir_masks_included(sub_dir_name, top_level)]
                     for base_file_name in file_list:
                         input_file_name = os.path.join(dir_name, base_file_name)
-                        if not self._file_masks_included(input_file_name):
+                        if not self._file_masks_included(input_file_name) or hash_storage.is_hash_file(input_file_name) or \
+                           not self._shard_included(input_file_name[input_folder_prefix_len:]):
                             continue
                         # print("{0} -> {1}".format(dir_name, base_file_name));
                         input_file_names.append(input_file_name)
@@ -313,40 +917,381 @@ class CommandLineAdapter(object):
         # Ref: https://www.w3schools.com/python/python_howto_remove_duplicates.asp
         input_file_names = list(dict.fromkeys(input_file_names))
 
-        total_time_estimator = util.ProcessingTimeEstimator()
-        total_time_estimator.inc_total_size_with_files(input_file_names)
-    
         # Sort accounting unicode
         key1 = lambda v: (locale.strxfrm(v).casefold(), locale.strxfrm(v))
         input_file_names.sort(key=key1)
 
-        data_read_error = False
+        # File sizes are obtained once, they are used for time estimation and to choose fast path for small files.
+        # Files with several hard links are identified by the same stat call
+        input_file_stats = [os.stat(input_file_name) for input_file_name in input_file_names]
+        input_file_names, input_file_stats = self._order_input_files(input_file_names, input_file_stats)
+
+        if self._profiler is not None:
+            self._profiler.add_since("enumeration", moment)
+
+        total_time_estimator = util.ThroughputTimeEstimator()
+        for file_stat in input_file_stats:
+            total_time_estimator.add_file(util.ThroughputTimeEstimator.get_device_id(file_stat), file_stat.st_size)
+        throughput_history_file = self._cmd_line_args.throughput_history_file
+        if throughput_history_file:
+            total_time_estimator.load_history(throughput_history_file)
+
+        input_files = list(zip(input_file_names, input_file_stats))
+        file_count = len(input_files)
+        if self._cmd_line_args.input_file_list:
+            # Files of the list are handled after other input files in order of the list, count of them is not known in advance
+            input_files = itertools.chain(input_files, self._iter_input_file_list(total_time_estimator))
+            file_count = None
+        try:
+            return self._handle_input_files_ordered(hash_storage, input_files, file_count, total_time_estimator)
+        finally:
+            if throughput_history_file:
+                total_time_estimator.save_history(throughput_history_file, self._cmd_line_args.hash_file_fsync_policy)
+
+    def _iter_input_file_list(self, total_time_estimator: util.ThroughputTimeEstimator):
+        """
+        Iterate over pairs (file name, stat) for the file names read from --input-file-list. File names are read lazily, so the list is not kept in memory.
+        Stat is None if the file does not exist. Files are added to `total_time_estimator` as they are read
+        """
+        separator = b"\0" if self._cmd_line_args.input_file_list_null else b"\n"
+        if self._cmd_line_args.input_file_list == "-":
+            file_list = contextlib.nullcontext(sys.stdin.buffer)
+        else:
+            try:
+                file_list = open(self._cmd_line_args.input_file_list, "rb")
+            except OSError as err:
+                raise util.AppUsageError(f"File with list of input files can't be opened: '{self._cmd_line_args.input_file_list}'. {err.strerror}") from err
+        with file_list as f:
+            for input_file_name in util.iter_file_list(f, separator):
+                if not self._shard_included(os.path.abspath(input_file_name)):
+                    continue
+                try:
+                    file_stat = os.stat(input_file_name)
+                except OSError:
+                    file_stat = None
+                if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+                    yield input_file_name, None
+                    continue
+                total_time_estimator.add_file(util.ThroughputTimeEstimator.get_device_id(file_stat), file_stat.st_size)
+                yield input_file_name, file_stat
+
+    def _handle_input_files_ordered(self, hash_storage: hash_storages.HashStorageAbstract, input_files, file_count, total_time_estimator: util.ThroughputTimeEstimator):
+        """
+        Handle input files in the specified order. `input_files` is iterable of pairs (file name, stat), stat is None if the file does not exist.
+        `file_count` is None if count of the files is not known in advance. Time of every file handling is passed to `total_time_estimator`
+        """
+        small_file_threshold = self._cmd_line_args.small_file_threshold
+        # Pause is specified to reduce the load, so it should be applied after every file and fast path is not used.
+        # Files are copied in regular path, because the copy is written to temporary file and it may be verified
+        if small_file_threshold == 0 or self._cmd_line_args.pause_after_file is not None or self._cmd_line_args.copy_to:
+            small_file_threshold = -1 # Fast path is disabled, even empty files are handled in regular path
 
-        file_count = len(input_file_names)
-        for fi in range(0, file_count):
-            self._info(f"File {fi + 1} of {file_count}")
+        small_file_calc = self._create_file_hash_calc()
+        small_file_batch = []
 
-            input_file_name = input_file_names[fi]
-            h = self._handle_input_file(hash_storage, input_file_name)
+        data_read_error = False
+
+        file_count_str = f" of {file_count}" if file_count is not None else ""
+        fi = 0
+        for fi, (input_file_name, file_stat) in enumerate(input_files, 1):
+            if file_stat is None:
+                self._info(f"Input file does not exist: {input_file_name}")
+                data_read_error = True
+                continue
+            file_size = file_stat.st_size
+            hardlink_key = self._get_hardlink_key(file_stat)
+            device = util.ThroughputTimeEstimator.get_device_id(file_stat)
+            small_file = file_size <= small_file_threshold
+            start_moment = time.perf_counter()
+
+            if self._cmd_line_args.hash_archive_members and archive_members.is_archive_file(input_file_name):
+                self._flush_small_file_batch(hash_storage, small_file_batch)
+                self._info(f"File {fi}{file_count_str}")
+                small_file = False
+                h = self._handle_archive_file(hash_storage, input_file_name)
+            elif small_file:
+                h = self._handle_small_input_file(hash_storage, small_file_calc, input_file_name, file_size, small_file_batch, hardlink_key)
+            else:
+                self._flush_small_file_batch(hash_storage, small_file_batch)
+                self._info(f"File {fi}{file_count_str}")
+                h = self._handle_input_file(hash_storage, input_file_name, file_size, hardlink_key=hardlink_key)
 
             if h == ExitCode.DATA_READ_ERROR:
                 data_read_error = True
             elif h >= ExitCode.FAILED:
+                self._flush_small_file_batch(hash_storage, small_file_batch)
                 return h
 
-            if h == ExitCode.OK_SKIPPED_ALREADY_CALCULATED:
-                total_time_estimator.inc_total_size(-os.path.getsize(input_file_name))
+            if h == ExitCode.OK:
+                total_time_estimator.add_handled_file(device, file_size, time.perf_counter() - start_moment)
             else:
-                total_time_estimator.inc_handled_size(os.path.getsize(input_file_name))
-            
+                # Time of the files with read errors includes retries, so it is not accounted in the model of the device
+                total_time_estimator.skip_file(device, file_size)
+
+            # Fast path for small files is disabled with pause, so there are no pending hashes
+            if h == ExitCode.OK and not self._pause_after_file():
+                return ExitCode.PROGRAM_INTERRUPTED_BY_USER
+
+            if small_file:
+                # Small files are reported once per batch
+                if len(small_file_batch) < self.small_file_batch_size and (file_count is None or fi < file_count):
+                    continue
+                self._flush_small_file_batch(hash_storage, small_file_batch)
+                self._info(f"File {fi}{file_count_str}")
+
             total_time_str = total_time_estimator.get_result().get_str()
             self._info(total_time_str + "\n")
 
+        if small_file_batch:
+            # The last batch when count of files is not known in advance
+            self._flush_small_file_batch(hash_storage, small_file_batch)
+            self._info(f"File {fi}{file_count_str}")
+            self._info(total_time_estimator.get_result().get_str() + "\n")
+
+        if self._hardlink_saved_file_count > 0:
+            self._info(f"Hashes of {self._hardlink_saved_file_count} file(s) are taken from other hard links, "
+                       f"reading of {util.convert_size_to_display(self._hardlink_saved_size)} is saved")
+
+        if self._chunk_index is not None:
+            # This is the result of analysis, so it is printed even if reporting output is suppressed
+            print(self._chunk_index.get_report())
+
+        if data_read_error:
+            return ExitCode.DATA_READ_ERROR
+        return ExitCode.OK
+
+    def _watch_input_folders(self, hash_storage: hash_storages.HashStorageAbstract, folder_watcher: watcher.WatcherAbstract):
+        """
+        Keep hash storage up to date with changes in input folders until the program is interrupted
+        """
+        # Events for the hash file, its backup and temporary files are ignored
+        hash_file_name = os.path.abspath(hash_storage.get_hash_file_name(None))
+        debouncer = watcher.ChangeDebouncer(self._cmd_line_args.watch_debounce)
+        data_read_error = False
+
+        self._info(f"Watch input folders for changes ({type(folder_watcher).__name__}). Press Ctrl+C to stop")
+        while not util.is_program_interrupted_by_user():
+            # Timeout is short, so interruption is handled quickly
+            events = folder_watcher.wait_events(debouncer.get_wait_timeout(0.5))
+            rescan_needed = False
+            for kind, path in events:
+                if kind == watcher.WatchEventKind.RESCAN_NEEDED:
+                    rescan_needed = True
+                elif kind == watcher.WatchEventKind.FOLDER_DELETED:
+                    self._info(f"Folder deleted: {path}")
+                    debouncer.discard_folder(path)
+                    hash_storage.remove_folder_hashes(path)
+                elif path.startswith(hash_file_name) or not self._file_masks_included(path) or not self._path_dir_masks_included(path):
+                    continue
+                elif kind == watcher.WatchEventKind.FILE_DELETED:
+                    self._info(f"File deleted: {path}")
+                    debouncer.discard(path)
+                    hash_storage.remove_hash(path)
+                else:
+                    debouncer.add(path)
+
+            if rescan_needed:
+                # Changes of the files which are already in the storage can't be detected on rescan, only new files are handled
+                self._info("Some changes in input folders are lost, input folders are rescanned")
+                h = self._handle_input_files(hash_storage)
+                if h == ExitCode.DATA_READ_ERROR:
+                    data_read_error = True
+                elif h >= ExitCode.FAILED and h != ExitCode.PROGRAM_INTERRUPTED_BY_USER:
+                    return h
+
+            for input_file_name in debouncer.pop_ready():
+                if util.is_program_interrupted_by_user():
+                    debouncer.add(input_file_name)
+                    break
+                if not os.path.isfile(input_file_name):
+                    continue # File is deleted or it is not a regular file, deletion is reported by separate event
+                h = self._handle_input_file(hash_storage, input_file_name, force_calc_hash=True)
+                if h == ExitCode.OK:
+                    self._pause_after_file() # Interruption during the pause is checked before the next file
+                if h == ExitCode.DATA_READ_ERROR:
+                    data_read_error = True
+                if h in (ExitCode.DATA_READ_ERROR, ExitCode.PROGRAM_INTERRUPTED_BY_USER):
+                    # Hash is removed, so the file is handled on the next run rather than obsolete hash is kept
+                    hash_storage.remove_hash(input_file_name)
+                elif h >= ExitCode.FAILED:
+                    return h
+
+            hash_storage.autosave_if_needed()
+
+        # Files changed but not handled yet are handled on the next run
+        for input_file_name in debouncer.pop_all():
+            hash_storage.remove_hash(input_file_name)
+
+        # Interruption is the regular way to stop watching
         if data_read_error:
             return ExitCode.DATA_READ_ERROR
         return ExitCode.OK
 
+    def _handle_input_files_watched(self, hash_storage: hash_storages.HashStorageAbstract):
+        """
+        Handle input files and then watch input folders for changes
+        """
+        # Watching is started before handling of input files, so the changes made during handling are not missed
+        dir_filter = self._dir_masks_included if self._dir_mask_include is not None or self._dir_mask_exclude is not None else None
+        with watcher.create_watcher(self._cmd_line_args.input_folder, self._cmd_line_args.watch_polling_interval,
+                                    self._cmd_line_args.watch_use_polling, dir_filter, self._info) as folder_watcher:
+            exit_code = self._handle_input_files(hash_storage)
+            if exit_code >= ExitCode.FAILED and exit_code != ExitCode.DATA_READ_ERROR:
+                return exit_code
+            hash_storage.save_hashes_info()
+            return max(exit_code, self._watch_input_folders(hash_storage, folder_watcher))
+
+    def _serve_hash_storage(self, hash_storage: hash_storages.HashStorageAbstract):
+        """
+        Answer requests for hashes on Unix domain socket until the program is interrupted. Refer to `server` module for the protocol
+        """
+        if not hasattr(socket, "AF_UNIX"):
+            raise util.AppUsageError("--serve requires support of Unix domain sockets by the operating system")
+
+        # Input files are not handled, so all records should be kept rather than the records for handled files only
+        hash_storage.preserve_unused_hash_records = True
+
+        def compute_hash(input_file_name):
+            calc = self._create_file_hash_calc()
+            # Hashes are calculated concurrently, so the progress can't be reported
+            calc.suppress_console_reporting_output = True
+            calc.file_name = input_file_name
+            start_moment = time.perf_counter()
+            calc_res = calc.run()
+            # Metrics collector is not thread safe
+            with lookup_server.storage_lock:
+                self._add_file_metrics(input_file_name, None, calc, time.perf_counter() - start_moment,
+                                       failed=calc_res != hash_calc.FileHashCalc.ReturnCode.OK)
+            if calc_res != hash_calc.FileHashCalc.ReturnCode.OK:
+                return None
+            return calc.result
+
+        try:
+            lookup_server = server.HashLookupServer(self._cmd_line_args.serve, hash_storage, compute_hash)
+        except OSError as err:
+            raise util.AppUsageError(f"Can't listen on socket '{self._cmd_line_args.serve}': {err}") from err
+
+        with lookup_server:
+            # Ref: https://docs.python.org/3/library/socketserver.html#asynchronous-mixins
+            server_thread = threading.Thread(target=lookup_server.serve_forever, kwargs={"poll_interval": 0.5}, daemon=True)
+            server_thread.start()
+            self._info(f"Serve hashes on socket '{self._cmd_line_args.serve}'. Press Ctrl+C to stop")
+            try:
+                while not util.is_program_interrupted_by_user():
+                    time.sleep(0.5)
+                    with lookup_server.storage_lock:
+                        hash_storage.autosave_if_needed()
+            finally:
+                lookup_server.shutdown()
+                server_thread.join()
+
+        # Interruption is the regular way to stop the server
+        return ExitCode.OK
+
+    def _create_metrics_collector(self):
+        if self._cmd_line_args.metrics_ndjson_file is None and self._cmd_line_args.metrics_prometheus_textfile is None:
+            return None
+        ret = metrics.MetricsCollector()
+        ret.ndjson_file_name = self._cmd_line_args.metrics_ndjson_file
+        ret.prometheus_textfile_name = self._cmd_line_args.metrics_prometheus_textfile
+        ret.prometheus_update_interval = self._cmd_line_args.metrics_prometheus_update_interval
+        ret.open()
+        return ret
+
+    def _get_hash_file_header_comments(self):
+        ret = [
+             "File generated by Smart Hasher (https://github.com/sergtk/smart_hasher)",
+            f"Timestamp of hash calculation: {self._start_time_dict['str']}",
+            f"Hash algorithm: {self._cmd_line_args.hash_algo}"]
+        if self._cmd_line_args.user_comment:
+            ret = ret + [f"User comment: {cmt}" for cmt in self._cmd_line_args.user_comment]
+        return ret
+
+    def _create_converted_hash_storage(self, hash_file_name):
+        """
+        Create storage for the hash file to convert. Format is chosen by the file name extension
+        """
+        hash_file_format = hash_storages.get_hash_file_format(hash_file_name)
+        if hash_file_format == "binary":
+            ret = hash_storages.BinaryCatalogHashesStorage()
+            ret.binary_catalog_file_name_base = hash_file_name
+            ret.hash_algo = self._cmd_line_args.hash_algo
+        else:
+            ret = hash_storages.SingleFileHashesStorage()
+            ret.single_hash_file_name_base = hash_file_name
+            ret.json_format = hash_file_format == "json"
+            ret.preserve_unused_hash_records = True
+            ret.sort_by_hash_value = self._cmd_line_args.sort_by_hash_value
+            ret.compression = self._cmd_line_args.hash_file_compression
+
+        ret.use_absolute_file_names = self._cmd_line_args.use_absolute_file_names
+        ret.norm_case_file_names = self._cmd_line_args.norm_case_file_names
+        ret.hash_file_header_comments = self._get_hash_file_header_comments()
+        ret.suppress_hash_file_comments = self._cmd_line_args.suppress_output_file_comments
+        ret.fsync_policy = self._cmd_line_args.hash_file_fsync_policy
+        ret.profiler = self._profiler
+        return ret
+
+    def _convert_hash_file(self):
+        """
+        Hashes are passed from the source storage to the destination one without access to the data files, so they may not exist
+        """
+        source_file_name, destination_file_name = self._cmd_line_args.convert_hash_file
+        if not os.path.isfile(source_file_name):
+            raise util.AppUsageError(f"Hash file to convert does not exist: '{source_file_name}'")
+        if os.path.normcase(os.path.abspath(source_file_name)) == os.path.normcase(os.path.abspath(destination_file_name)):
+            raise util.AppUsageError("Source and destination hash files of conversion should be different")
+
+        source_storage = self._create_converted_hash_storage(source_file_name)
+        destination_storage = self._create_converted_hash_storage(destination_file_name)
+        source_storage.load_hashes_info()
+        destination_storage.import_hashes(source_storage.iter_hashes())
+        destination_storage.save_hashes_info()
+
+        self._info(f"Hash file '{source_file_name}' is converted to '{destination_file_name}'")
+        self._info(f"ExitCode: {ExitCode.OK.name} ({ExitCode.OK})")
+        return ExitCode.OK
+
+    def _compare_hash_files(self):
+        old_file_name, new_file_name = self._cmd_line_args.compare_hash_files
+        for hash_file_name in [old_file_name, new_file_name]:
+            if not os.path.isfile(hash_file_name):
+                raise util.AppUsageError(f"Hash file to compare does not exist: '{hash_file_name}'")
+
+        comparison = hash_file_diff.HashFilesComparison(old_file_name, new_file_name)
+        comparison.detect_renames = not self._cmd_line_args.compare_no_rename_detection
+        for diff_record in comparison.iter_differences():
+            print(diff_record)
+
+        self._info(", ".join(f"{status.value.capitalize()}: {count}" for status, count in comparison.counts.items()))
+        self._info(f"ExitCode: {ExitCode.OK.name} ({ExitCode.OK})")
+        return ExitCode.OK
+
+    def _merge_hash_files(self):
+        destination_file_name, *source_file_names = self._cmd_line_args.merge_hash_files
+        for source_file_name in source_file_names:
+            if not os.path.isfile(source_file_name):
+                raise util.AppUsageError(f"Hash file to merge does not exist: '{source_file_name}'")
+            if os.path.normcase(os.path.abspath(source_file_name)) == os.path.normcase(os.path.abspath(destination_file_name)):
+                raise util.AppUsageError("Destination hash file of merge should differ from the source ones")
+        if hash_storages.get_hash_file_format(destination_file_name) == "binary":
+            raise util.AppUsageError("Destination hash file of merge can't be binary catalog. Please convert it with --convert-hash-file after merge")
+
+        destination_storage = self._create_converted_hash_storage(destination_file_name)
+        record_count = destination_storage.save_sorted_hashes(hash_file_merge.iter_merged_hash_files(source_file_names, destination_file_name))
+
+        self._info(f"{len(source_file_names)} hash file(s) with {record_count} record(s) are merged into '{destination_file_name}'")
+        self._info(f"ExitCode: {ExitCode.OK.name} ({ExitCode.OK})")
+        return ExitCode.OK
+
     def _handle_input(self):
+        if self._cmd_line_args.convert_hash_file:
+            return self._convert_hash_file()
+        if self._cmd_line_args.compare_hash_files:
+            return self._compare_hash_files()
+        if self._cmd_line_args.merge_hash_files:
+            return self._merge_hash_files()
+
         if self._cmd_line_args.single_hash_file_name_base or self._cmd_line_args.single_hash_file_name_base_json:
             hash_storage = hash_storages.SingleFileHashesStorage()
 
@@ -359,6 +1304,17 @@ class CommandLineAdapter(object):
 
             hash_storage.preserve_unused_hash_records = self._cmd_line_args.preserve_unused_hash_records
             hash_storage.sort_by_hash_value = self._cmd_line_args.sort_by_hash_value
+            hash_storage.compression = self._cmd_line_args.hash_file_compression
+            hash_storage.background_autosave = not self._cmd_line_args.suppress_background_autosave
+        elif self._cmd_line_args.single_hash_file_name_base_binary:
+            hash_storage = hash_storages.BinaryCatalogHashesStorage()
+            hash_storage.binary_catalog_file_name_base = self._cmd_line_args.single_hash_file_name_base_binary
+            hash_storage.hash_algo = self._cmd_line_args.hash_algo
+        elif self._cmd_line_args.per_directory_hash_file_name_base:
+            hash_storage = hash_storages.PerDirectoryHashesStorage()
+            hash_storage.per_directory_hash_file_name_base = self._cmd_line_args.per_directory_hash_file_name_base
+            hash_storage.preserve_unused_hash_records = self._cmd_line_args.preserve_unused_hash_records
+            hash_storage.sort_by_hash_value = self._cmd_line_args.sort_by_hash_value
         else:
             hash_storage = hash_storages.HashPerFileStorage()
 
@@ -366,18 +1322,82 @@ class CommandLineAdapter(object):
         hash_storage.use_absolute_file_names = self._cmd_line_args.use_absolute_file_names
         hash_storage.norm_case_file_names = self._cmd_line_args.norm_case_file_names
         hash_storage.autosave_timeout = self._cmd_line_args.autosave_timeout
+        hash_storage.fsync_policy = self._cmd_line_args.hash_file_fsync_policy
+        hash_storage.profiler = self._profiler
+
+        hash_storage.hash_file_header_comments = self._get_hash_file_header_comments()
 
-        hash_storage.load_hashes_info()
-        exit_code = self._handle_input_files(hash_storage)
-        hash_storage.save_hashes_info() # Note, hash info is not stored on exception, because it is not clear if we can trust to that data
+        hash_storage.suppress_hash_file_comments = self._cmd_line_args.suppress_output_file_comments
+
+        self._metrics = self._create_metrics_collector()
+        if self._cmd_line_args.dedup_analysis:
+            self._chunk_index = chunking.ChunkIndex()
+        try:
+            hash_storage.load_hashes_info()
+            if self._cmd_line_args.watch:
+                exit_code = self._handle_input_files_watched(hash_storage)
+            elif self._cmd_line_args.serve:
+                exit_code = self._serve_hash_storage(hash_storage)
+            else:
+                exit_code = self._handle_input_files(hash_storage)
+                if self._cmd_line_args.folder_hashes:
+                    # Copies of all input files are in the destination folder
+                    folder_names = [self._cmd_line_args.copy_to] if self._cmd_line_args.copy_to else self._cmd_line_args.input_folder
+                    if exit_code < ExitCode.FAILED:
+                        hash_storage.update_folder_hashes(folder_names, self._cmd_line_args.hash_algo)
+                    else:
+                        # Hashes of some files are missing, folder hashes would differ from the hashes of complete replica
+                        self._info("Folder hashes are not calculated, because not all input files are handled")
+                        hash_storage.remove_folder_records(folder_names)
+            hash_storage.save_hashes_info() # Note, hash info is not stored on exception, because it is not clear if we can trust to that data
+        finally:
+            if self._metrics is not None:
+                self._metrics.close()
 
         # Ref: https://stackoverflow.com/questions/24487405/enum-getting-value-of-enum-on-string-conversion
         self._info(f"ExitCode: {exit_code.name} ({exit_code})")
 
         return exit_code
 
+    def _handle_input_profiled(self):
+        """
+        Handle input with profiling specified in command line parameters. Profiling results are reported at the end of the run
+        """
+        if self._cmd_line_args.profile:
+            self._profiler = profiling.PhaseProfiler()
+
+        if self._cmd_line_args.profile_tracemalloc_file:
+            tracemalloc.start()
+
+        cprofiler = None
+        if self._cmd_line_args.profile_cprofile_file:
+            cprofiler = cProfile.Profile()
+            cprofiler.enable()
+
+        try:
+            return self._handle_input()
+        finally:
+            if cprofiler is not None:
+                cprofiler.disable()
+                cprofiler.dump_stats(self._cmd_line_args.profile_cprofile_file)
+
+            if self._cmd_line_args.profile_tracemalloc_file:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                snapshot.dump(self._cmd_line_args.profile_tracemalloc_file)
+                print("Top memory allocations:", file=sys.stderr)
+                for stat_entry in snapshot.statistics("lineno")[:10]:
+                    print(stat_entry, file=sys.stderr)
+
+            if self._profiler is not None:
+                print(self._profiler.get_report(), file=sys.stderr)
+
     # input_args is a list of command line arguments. Typically the following value is passed: sys.argv[1:]
     def run(self, input_args):
+        with util.SignalInterruptionHandler():
+            return self._run(input_args)
+
+    def _run(self, input_args):
         try:
             self._fill_start_time_dict()
             self._input_args = input_args
@@ -385,7 +1405,8 @@ class CommandLineAdapter(object):
             # Ref: https://stackoverflow.com/questions/23032514/argparse-disable-same-argument-occurrences
             self._cmd_line_args = self._parser.parse_args(self._input_args)
             self._postprocess_parsed_args()
-            ret = self._handle_input()
+            self._apply_process_priority()
+            ret = self._handle_input_profiled()
             return ret
         except SystemExit as se:
             # Check if error is related to invalid command line parameters
@@ -396,6 +1417,9 @@ class CommandLineAdapter(object):
         except util.AppUsageError as aue:
             self._info(f"\nIncorrect usage of the application: {aue.args[0]}", file=sys.stderr)
             return ExitCode.APP_USAGE_ERROR
+        except KeyboardInterrupt:
+            # Repeated interruption signal, so hash info is not saved
+            return ExitCode.PROGRAM_INTERRUPTED_BY_USER
         except BaseException: # pylint: disable=W0703
             # Ref: https://stackoverflow.com/a/4564595/13441
             # Wierd that `ex` is not used
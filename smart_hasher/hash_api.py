@@ -0,0 +1,193 @@
+"""
+Python API to calculate hashes from other programs without running command line tool.
+
+Example:
+    import hash_api
+    import hash_storages
+
+    with hash_storages.SingleFileHashesStorage() as storage: # storage parameters should be set before `with`
+        for res in hash_api.hash_files(file_names, ["sha256"], storage=storage, jobs=4):
+            print(res.file_name, res.status.name, res.hashes)
+
+Nothing is printed on console.
+"""
+import concurrent.futures
+import enum
+import hashlib
+import os
+import time
+
+import hash_calc
+import hash_storages
+import util
+
+class HashResult(object):
+    """
+    This is a result of hash calculation for one file
+    """
+
+    @enum.unique
+    class Status(enum.Enum):
+        HASHED = 0
+        SKIPPED_ALREADY_CALCULATED = 1 # Storage already has hash for the file
+        DATA_READ_ERROR = 2
+        PROGRAM_INTERRUPTED_BY_USER = 3
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.status = None
+        self.hashes = {} # Dictionary "hash algorithm" -> "hash", it is empty if hash is not calculated
+        self.size = None
+        self.bytes_read = 0
+        self.duration = 0.0 # in seconds
+        self.retry_count = 0
+        self.error = None # Error message if hash is not calculated due to error
+
+    def __repr__(self):
+        return f"HashResult({self.file_name!r}, {self.status}, {self.hashes})"
+
+class HashFilesOptions(object):
+    """
+    Options of `hash_files()`, defaults are the same as for command line
+    """
+
+    def __init__(self):
+        self.force_calc_hash = False
+        self.retry_count_on_data_read_error = 5
+        self.retry_pause_on_data_read_error = 60 # in seconds
+        self.small_file_threshold = 64 * 1024
+        self.read_rate_limiter = None # util.TokenBucket
+
+def _hash_file(file_name, hash_algos, options: HashFilesOptions):
+    """
+    Calculate hashes for one file. This function is called in worker threads, so it should not access storage
+    """
+    ret = HashResult(file_name)
+
+    calc = hash_calc.FileHashCalc()
+    calc.file_name = file_name
+    calc.hash_strs = hash_algos
+    calc.suppress_console_reporting_output = True
+    calc.retry_count_on_data_read_error = options.retry_count_on_data_read_error
+    calc.retry_pause_on_data_read_error = options.retry_pause_on_data_read_error
+    calc.read_rate_limiter = options.read_rate_limiter
+
+    start_moment = time.perf_counter()
+    try:
+        ret.size = os.path.getsize(file_name)
+        calc_res = None
+        if ret.size <= options.small_file_threshold:
+            try:
+                calc_res = calc.run_small_file()
+            except OSError:
+                pass # Regular calculation below supports retries
+        if calc_res is None:
+            calc_res = calc.run()
+    except OSError as err:
+        calc_res = hash_calc.FileHashCalc.ReturnCode.DATA_READ_ERROR
+        ret.error = f"{type(err).__name__}: {err.strerror} (errno = {err.errno}, filename = {err.filename})"
+    ret.duration = time.perf_counter() - start_moment
+    ret.bytes_read = calc.bytes_read
+    ret.retry_count = calc.retry_count
+
+    if calc_res == hash_calc.FileHashCalc.ReturnCode.OK:
+        ret.status = HashResult.Status.HASHED
+        ret.hashes = calc.results
+    elif calc_res == hash_calc.FileHashCalc.ReturnCode.PROGRAM_INTERRUPTED_BY_USER:
+        ret.status = HashResult.Status.PROGRAM_INTERRUPTED_BY_USER
+    else:
+        ret.status = HashResult.Status.DATA_READ_ERROR
+        if ret.error is None:
+            ret.error = "Data read error, retries are exhausted"
+    return ret
+
+def hash_files(file_names, hash_algos = (hash_calc.FileHashCalc.hash_algo_default_str,), storage: hash_storages.HashStorageAbstract = None, jobs = 1,
+               options: HashFilesOptions = None):
+    """
+    Calculate hashes for files and yield `HashResult` for every file as soon as it is handled.
+
+    file_names - iterable of file names. It is consumed lazily, so it may be a generator over millions of files.
+    hash_algos - names of hash algorithms supported by hashlib. All of them are calculated in one pass over file data.
+    storage - optional hash storage. Files which hashes are in the storage are skipped unless `options.force_calc_hash` is set,
+        calculated hashes are passed to the storage. Storage keeps one hash per file, so the hash for the first algorithm is stored.
+        Storage should be loaded by the caller and it should be saved after the iteration, e.g. with `with` statement.
+    jobs - count of threads to read files in parallel. Results are yielded in order of completion if jobs > 1.
+    options - HashFilesOptions.
+
+    Iteration stops after the result with status PROGRAM_INTERRUPTED_BY_USER, see `util.request_program_interruption()`.
+    The request of interruption is forgotten when the iteration ends, so the next call is not interrupted.
+    """
+    try:
+        yield from _hash_files(file_names, hash_algos, storage, jobs, options)
+    finally:
+        util.reset_program_interruption()
+
+def _hash_files(file_names, hash_algos, storage, jobs, options):
+    hash_algos = tuple(hash_algos)
+    if not hash_algos:
+        raise ValueError("At least one hash algorithm should be specified")
+    for hash_algo in hash_algos:
+        if hash_algo not in hashlib.algorithms_available:
+            raise ValueError(f"Hash algorithm is not supported: '{hash_algo}'")
+    if jobs < 1:
+        raise ValueError("Count of jobs should be positive")
+    if storage is not None and not isinstance(storage, hash_storages.HashStorageAbstract):
+        raise TypeError(f"HashStorageAbstract expected, {type(storage)} found")
+    if options is None:
+        options = HashFilesOptions()
+
+    def files_to_hash():
+        """
+        Files which should be hashed. Storage is accessed from the thread of the caller only, so it need not be thread safe
+        """
+        for file_name in file_names:
+            if storage is not None and not options.force_calc_hash and storage.has_hash(file_name):
+                res = HashResult(file_name)
+                res.status = HashResult.Status.SKIPPED_ALREADY_CALCULATED
+                yield file_name, res
+            else:
+                yield file_name, None
+
+    def store(res):
+        if storage is not None and res.status == HashResult.Status.HASHED:
+            storage.set_hash(res.file_name, res.hashes[hash_algos[0]])
+        return res
+
+    if jobs == 1:
+        for file_name, skipped_res in files_to_hash():
+            if skipped_res is not None:
+                yield skipped_res
+                continue
+            res = store(_hash_file(file_name, hash_algos, options))
+            yield res
+            if res.status == HashResult.Status.PROGRAM_INTERRUPTED_BY_USER:
+                return
+        return
+
+    # Count of files submitted to the threads is limited, so the input is not materialized
+    max_pending = jobs * 4
+    files_iter = files_to_hash()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        pending = set()
+        input_exhausted = False
+        while True:
+            while not input_exhausted and len(pending) < max_pending:
+                file_name, skipped_res = next(files_iter, (None, None))
+                if file_name is None:
+                    input_exhausted = True
+                elif skipped_res is not None:
+                    yield skipped_res
+                else:
+                    pending.add(executor.submit(_hash_file, file_name, hash_algos, options))
+            if not pending:
+                return
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                res = store(future.result())
+                yield res
+                if res.status == HashResult.Status.PROGRAM_INTERRUPTED_BY_USER:
+                    return
+    finally:
+        # Ref: https://docs.python.org/3/library/concurrent.futures.html#concurrent.futures.Executor.shutdown
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -4,6 +4,10 @@ from datetime import datetime
 import util
 import enum
 import sys
+import contextlib
+import shutil
+import uuid
+import chunking
 
 class FileHashCalc(object):
     """This is a class to calculate hash for one file"""
@@ -14,11 +18,25 @@ class FileHashCalc(object):
     def __init__(self):
         self.file_name = None
         self.hash_str = FileHashCalc.hash_algo_default_str
+        self.hash_strs = None # Sequence of hash algorithms to calculate in one pass over data. If not specified, then `hash_str` is used
         self.suppress_console_reporting_output = False
         self.file_chunk_size = 1024 * 1024
-        self.result = None
+        self.result = None # Hash for the first algorithm
+        self.results = None # Dictionary "hash algorithm" -> "hash" for all calculated algorithms
         self.retry_count_on_data_read_error = 5
         self.retry_pause_on_data_read_error = 60 # in seconds
+        self.checkpoint_interval = 64 * 1024 * 1024 # State of hashers is saved after this count of bytes, so retry after read error resumes from the saved offset
+        self.read_rate_limiter = None # util.TokenBucket to limit read rate, bytes per second. It may be shared between calculators
+        self.bytes_read = 0 # Count of bytes read on the last run, including data read on failed tries
+        self.retry_count = 0 # Count of retries on the last run
+        self.profiler = None # profiling.PhaseProfiler to measure time of reading, hashing and progress reporting
+        self.resumed_size = 0 # Count of bytes which are not read again on retries of the last run, because they are covered by checkpoints
+        self.copy_to_file_name = None # If specified, data is written to this file while the hash is calculated, so the file is copied and hashed in one pass
+        self.copy_fsync_policy = "file" # One of `util.fsync_policies` for the copied file
+        self.chunk_index = None # chunking.ChunkIndex. If specified, data is also split to chunks by content for deduplication analysis
+        self.chunk_average_size = 8 * 1024
+        self.__checkpoint = None
+        self.__copy_tmp_file_name = None
 
     # Ref: https://docs.python.org/2/library/hashlib.html
     def __get_hasher(self, hash_str):
@@ -26,6 +44,19 @@ class FileHashCalc(object):
         ret = hashlib.new(hash_str)
         return ret
 
+    def __get_hashers(self):
+        hash_strs = self.hash_strs if self.hash_strs else (self.hash_str,)
+        return [(hash_str, self.__get_hasher(hash_str)) for hash_str in hash_strs]
+
+    def __get_chunker(self):
+        if self.chunk_index is None:
+            return None
+        return chunking.Chunker(self.chunk_index, self.chunk_average_size)
+
+    def __set_results(self, hashers):
+        self.results = {hash_str: hasher.hexdigest() for hash_str, hasher in hashers}
+        self.result = self.results[hashers[0][0]]
+
     # Ref: https://docs.python.org/3.7/library/enum.html
     @enum.unique
     class ReturnCode(enum.IntEnum):
@@ -36,6 +67,61 @@ class FileHashCalc(object):
         PROGRAM_INTERRUPTED_BY_USER = 8
         DATA_READ_ERROR = 9 # Error when reading data from file. This may be caused by network issues, and retrying does not help
 
+    def _get_read_chunk_size(self):
+        """
+        If read rate is limited, then chunk is reduced so the pauses between reads are short and the program stays responsive
+        """
+        if self.read_rate_limiter is None:
+            return self.file_chunk_size
+        return max(4096, min(self.file_chunk_size, int(self.read_rate_limiter.rate / 10)))
+
+    def _open_file(self):
+        return open(self.file_name, "rb")
+
+    def __get_file_identity(self, f):
+        """
+        Size and modification time of the opened file. Checkpoint is used on retry only if the file is not changed
+        """
+        file_stat = os.fstat(f.fileno())
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    def __save_checkpoint(self, offset, hashers, file_identity, chunker):
+        # Ref: https://docs.python.org/3/library/hashlib.html#hashlib.hash.copy
+        if chunker is not None:
+            # Chunks are passed to the index when the whole file is read, so they are kept in the checkpoint
+            chunker = chunker.copy()
+        self.__checkpoint = (offset, [(hash_str, hasher.copy()) for hash_str, hasher in hashers], file_identity, chunker)
+
+    def __restore_checkpoint(self, file_identity):
+        """
+        Return triple (offset, hashers, chunker) to continue hashing from. Hashers are restored from the checkpoint of the previous try if the file is not changed
+        """
+        if self.__checkpoint is not None:
+            offset, checkpoint_hashers, checkpoint_file_identity, checkpoint_chunker = self.__checkpoint
+            if checkpoint_file_identity == file_identity:
+                self.resumed_size += offset
+                if offset > 0:
+                    self._info(f"Resume from offset {offset:,d}")
+                # Hashers are copied, so the checkpoint may be used again if this try fails also
+                chunker = checkpoint_chunker.copy() if checkpoint_chunker is not None else None
+                return offset, [(hash_str, hasher.copy()) for hash_str, hasher in checkpoint_hashers], chunker
+            self._info("File is changed, hash is calculated from the start")
+        hashers = self.__get_hashers()
+        chunker = self.__get_chunker()
+        self.__save_checkpoint(0, hashers, file_identity, chunker)
+        return 0, hashers, chunker
+
+    def __open_copy_file(self, offset):
+        """
+        Open temporary file of the copy. On resume from checkpoint data after the checkpoint is discarded
+        """
+        if offset == 0:
+            return open(self.__copy_tmp_file_name, "wb")
+        ret = open(self.__copy_tmp_file_name, "r+b")
+        ret.truncate(offset)
+        ret.seek(offset)
+        return ret
+
     def _info(self, *objects, sep=' ', end='\n', file=sys.stdout, flush=False):
         if self.suppress_console_reporting_output:
             return
@@ -47,15 +133,11 @@ class FileHashCalc(object):
         """
 
         self.result = None
+        self.results = None
         
         if self.file_name is None:
             raise Exception("File name is not specified")
 
-        cur_size = 0
-        prev_percent = 0
-        hasher = self.__get_hasher(self.hash_str)
-        total_size = os.path.getsize(self.file_name)
-
         recent_moment = start_moment = datetime.now()
         recent_size = 0
         recent_speed = 0
@@ -63,15 +145,54 @@ class FileHashCalc(object):
         
         con_report_len = 0
 
+        read_rate_limiter = self.read_rate_limiter
+        chunk_size = self._get_read_chunk_size()
+        profiler = self.profiler
+
         data = True
-        with open(self.file_name, "rb") as f:
+        # Ref: https://docs.python.org/3/library/contextlib.html#contextlib.ExitStack
+        with contextlib.ExitStack() as stack:
+            f = stack.enter_context(self._open_file())
+            file_identity = self.__get_file_identity(f)
+            total_size = file_identity[0]
+            cur_size, hashers, chunker = self.__restore_checkpoint(file_identity)
+            if cur_size > 0:
+                f.seek(cur_size)
+            copy_file = stack.enter_context(self.__open_copy_file(cur_size)) if self.__copy_tmp_file_name is not None else None
+            checkpoint_interval = self.checkpoint_interval
+            checkpoint_size = start_size = cur_size
+            start_percent = prev_percent = int(10000 * cur_size / total_size) if total_size > 0 else 0
+
             while data:
                 #time.sleep(random.random())
                 #time.sleep(0.3)
                 # Read and update digest.
-                data = f.read(self.file_chunk_size)
+                if profiler is not None:
+                    moment = profiler.start()
+                data = f.read(chunk_size)
+                if profiler is not None:
+                    moment = profiler.add_since("read", moment)
+                if read_rate_limiter is not None:
+                    read_rate_limiter.consume(len(data))
+                    if profiler is not None:
+                        moment = profiler.add_since("read_throttle", moment)
+                if copy_file is not None:
+                    copy_file.write(data)
+                    if profiler is not None:
+                        moment = profiler.add_since("copy_write", moment)
                 cur_size += len(data)
-                hasher.update(data)
+                self.bytes_read += len(data)
+                for _, hasher in hashers:
+                    hasher.update(data)
+                if profiler is not None:
+                    moment = profiler.add_since("hash", moment)
+                if chunker is not None:
+                    chunker.update(data)
+                    if profiler is not None:
+                        moment = profiler.add_since("chunking", moment)
+                if cur_size - checkpoint_size >= checkpoint_interval:
+                    self.__save_checkpoint(cur_size, hashers, file_identity, chunker)
+                    checkpoint_size = cur_size
 
                 recent_size += len(data)
 
@@ -95,9 +216,9 @@ class FileHashCalc(object):
                     elapsed_seconds = (cur_moment - start_moment).total_seconds()
                     if (elapsed_seconds == 0):
                         continue
-                    remain_seconds = elapsed_seconds / percent * (10000 - percent)
+                    remain_seconds = elapsed_seconds / (percent - start_percent) * (10000 - percent)
 
-                    speed = cur_size / elapsed_seconds
+                    speed = (cur_size - start_size) / elapsed_seconds
                     speed_readable = util.convert_size_to_display(speed)
 
                     recent_seconds = (cur_moment - recent_moment).total_seconds()
@@ -117,27 +238,158 @@ class FileHashCalc(object):
                     con_report_len = con_report_len_new
                     self._info(f"{con_report}\r", end="")
                     prev_percent = percent
+                    if profiler is not None:
+                        profiler.add_since("progress", moment)
+        if chunker is not None:
+            chunker.finish()
         self._info(" " * con_report_len + "\r", end="") # Clear line
-        self.result = hasher.hexdigest()
+        self.__set_results(hashers)
+        return self.ReturnCode.OK
+
+    def run_small_file(self):
+        """
+        Calculate hash for the small file, which is usually read in one call.
+
+        This is a fast path for the small files: there is no progress reporting, no timing and no retries.
+        OSError is propagated to the caller, so the caller may fall back to `run()` which supports retries.
+        Copying (see `copy_to_file_name`) is done with `run()`.
+        """
+        if self.copy_to_file_name is not None:
+            return self.run()
+
+        self.result = None
+        self.results = None
+        self.bytes_read = 0
+        self.retry_count = 0
+
+        if self.file_name is None:
+            raise Exception("File name is not specified")
+
+        hashers = self.__get_hashers()
+        chunker = self.__get_chunker()
+        # Low level file API is used, because for small files overhead of buffered file object is noticeable
+        read_rate_limiter = self.read_rate_limiter
+        chunk_size = self._get_read_chunk_size()
+        profiler = self.profiler
+        if profiler is not None:
+            moment = profiler.start()
+        fd = os.open(self.file_name, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            data = os.read(fd, chunk_size)
+            while data:
+                if profiler is not None:
+                    moment = profiler.add_since("read", moment)
+                if read_rate_limiter is not None:
+                    read_rate_limiter.consume(len(data))
+                    if profiler is not None:
+                        moment = profiler.add_since("read_throttle", moment)
+                for _, hasher in hashers:
+                    hasher.update(data)
+                if profiler is not None:
+                    moment = profiler.add_since("hash", moment)
+                if chunker is not None:
+                    chunker.update(data)
+                    if profiler is not None:
+                        moment = profiler.add_since("chunking", moment)
+                self.bytes_read += len(data)
+                data = os.read(fd, chunk_size)
+        finally:
+            os.close(fd)
+            if profiler is not None:
+                profiler.add_since("read", moment)
+        if chunker is not None:
+            chunker.finish()
+        self.__set_results(hashers)
+        return self.ReturnCode.OK
+
+    def run_stream(self, f):
+        """
+        Calculate hash for the data read from binary file object `f` till the end, e.g. member of archive.
+        There is no progress reporting and no retries, because the stream can't be read again. OSError is propagated to the caller
+        """
+
+        self.result = None
+        self.results = None
+        self.bytes_read = 0
+        self.retry_count = 0
+
+        hashers = self.__get_hashers()
+        chunker = self.__get_chunker()
+        read_rate_limiter = self.read_rate_limiter
+        chunk_size = self._get_read_chunk_size()
+        profiler = self.profiler
+        while True:
+            if profiler is not None:
+                moment = profiler.start()
+            data = f.read(chunk_size)
+            if profiler is not None:
+                moment = profiler.add_since("read", moment)
+            if not data:
+                break
+            if read_rate_limiter is not None:
+                read_rate_limiter.consume(len(data))
+                if profiler is not None:
+                    moment = profiler.add_since("read_throttle", moment)
+            for _, hasher in hashers:
+                hasher.update(data)
+            if profiler is not None:
+                moment = profiler.add_since("hash", moment)
+            if chunker is not None:
+                chunker.update(data)
+                if profiler is not None:
+                    profiler.add_since("chunking", moment)
+            self.bytes_read += len(data)
+        if chunker is not None:
+            chunker.finish()
+        self.__set_results(hashers)
         return self.ReturnCode.OK
 
     def run(self):
         """
-        This is a main function of the class, which should be called after setup of all parameters
+        This is a main function of the class, which should be called after setup of all parameters.
+
+        On read error the file is read again after pause. Hashing is resumed from the last checkpoint, see `checkpoint_interval`,
+        so only data after the checkpoint is read again.
+
+        If `copy_to_file_name` is specified, the data is written to temporary file in the same folder, which replaces `copy_to_file_name`
+        when the hash is calculated successfully. Modification time of the source file is copied, permissions are copied for new file only
         """
 
+        self.bytes_read = 0
+        self.retry_count = 0
+        self.resumed_size = 0
+        self.__checkpoint = None
+        if self.copy_to_file_name is None:
+            return self.__run_tries()
+
+        self.__copy_tmp_file_name = f"{self.copy_to_file_name}.tmp.{uuid.uuid1()}"
+        try:
+            res = self.__run_tries()
+            if res == self.ReturnCode.OK:
+                shutil.copystat(self.file_name, self.__copy_tmp_file_name)
+                util.replace_file(self.__copy_tmp_file_name, self.copy_to_file_name, self.copy_fsync_policy)
+            return res
+        finally:
+            if os.path.exists(self.__copy_tmp_file_name):
+                os.remove(self.__copy_tmp_file_name)
+            self.__copy_tmp_file_name = None
+
+    def __run_tries(self):
         for cur_try in range(1, self.retry_count_on_data_read_error + 1):
             # Ref: https://stackoverflow.com/questions/2083987/how-to-retry-after-exception
             try:
                 res = self._run_single()
+                self.__checkpoint = None
                 return res
             except OSError as err:
                 self._info()
                 self._info(f"OS Error. {type(err)}: {err.strerror} (errno = {err.errno}, filename = {err.filename})")
-                if not util.pause(self.retry_pause_on_data_read_error):
+                if not util.pause(self.retry_pause_on_data_read_error, not self.suppress_console_reporting_output):
                     return self.ReturnCode.PROGRAM_INTERRUPTED_BY_USER
                 if cur_try < self.retry_count_on_data_read_error:
+                    self.retry_count += 1
                     self._info(f"Retry {cur_try + 1} of {self.retry_count_on_data_read_error}")
                 else:
                     self._info("Skip file. The hash for it can't be calculated due to the errors.\n")
+                    self.__checkpoint = None
                     return self.ReturnCode.DATA_READ_ERROR
@@ -0,0 +1,259 @@
+"""
+Comparison of two hash files, e.g. yesterday's and today's ones, to find added, removed, modified and renamed files.
+
+Hash files are read in streaming fashion and compared with merge-join, because records of text and JSON hash files are sorted by file names
+(see `hash_storages.file_name_sort_key()`) and records of binary catalogs are sorted by keys. So hash files are not loaded into memory,
+only records of added and removed files are kept to find renamed ones.
+
+File names are compared as they are stored in hash files. So both hash files should contain either absolute file names
+or file names relative to the same folder.
+
+Folder records (see `tree_hash`) are compared like file ones. Folder record precedes records of its content, so if hashes of the folder are equal,
+then records below the folder are skipped without comparison, and the comparison descends only into the folders which differ.
+
+Ref: https://en.wikipedia.org/wiki/Sort-merge_join
+"""
+import collections
+import enum
+import json
+
+import binary_catalog
+import hash_storages
+import tree_hash
+import util
+
+class DiffStatus(enum.Enum):
+    ADDED = "added"
+    REMOVED = "removed"
+    MODIFIED = "modified"
+    RENAMED = "renamed" # The same hash under other file name
+    UNCHANGED = "unchanged"
+
+class DiffRecord(object):
+    def __init__(self, status: DiffStatus, file_name, hash_value, old_file_name = None, old_hash_value = None):
+        self.status = status
+        self.file_name = file_name
+        self.hash_value = hash_value
+        self.old_file_name = old_file_name
+        self.old_hash_value = old_hash_value
+
+    def __str__(self):
+        if self.status == DiffStatus.MODIFIED:
+            return f"{self.status.value} {self.old_hash_value} -> {self.hash_value} *{self.file_name}"
+        if self.status == DiffStatus.RENAMED:
+            return f"{self.status.value} {self.hash_value} *{self.old_file_name} -> *{self.file_name}"
+        return f"{self.status.value} {self.hash_value} *{self.file_name}"
+
+def iter_text_hash_file(file_name):
+    """
+    Iterate over pairs (file name, hash) of text hash file
+    """
+    with hash_storages.open_hash_file(file_name, "r", hash_storages.detect_compression(file_name), encoding=None) as f:
+        for line_index, line in enumerate(f, 1):
+            if hash_storages.comment_pattern.fullmatch(line):
+                continue
+            match = hash_storages.hash_record_pattern.fullmatch(line)
+            if match is None:
+                raise util.AppUsageError(f"Input file with hashes has wrong format.\n    File {file_name}, Line {line_index}: {line[0:200]}")
+            yield match.group("file"), match.group("hash").lower()
+
+class _JsonStreamReader(object):
+    """
+    Decoder of JSON values one by one from the file, the buffer contains the current value only
+
+    Ref: https://docs.python.org/3/library/json.html#json.JSONDecoder.raw_decode
+    """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, f):
+        self.__file = f
+        self.__decoder = json.JSONDecoder()
+        self.__buffer = ""
+        self.__pos = 0
+        self.__eof = False
+
+    def __read_more(self):
+        chunk = self.__file.read(self.chunk_size)
+        self.__buffer = self.__buffer[self.__pos:] + chunk
+        self.__pos = 0
+        self.__eof = not chunk
+
+    def peek(self):
+        """
+        Skip whitespaces and return the next character, or empty string at the end of file
+        """
+        while True:
+            while self.__pos < len(self.__buffer) and self.__buffer[self.__pos].isspace():
+                self.__pos += 1
+            if self.__pos < len(self.__buffer) or self.__eof:
+                return self.__buffer[self.__pos:self.__pos + 1]
+            self.__read_more()
+
+    def expect(self, chars):
+        ch = self.peek()
+        if ch == "" or ch not in chars:
+            raise ValueError(f"One of '{chars}' is expected in JSON, but '{ch}' found")
+        self.__pos += 1
+        return ch
+
+    def decode(self):
+        while True:
+            self.peek()
+            try:
+                value, end = self.__decoder.raw_decode(self.__buffer, self.__pos)
+                # Number may be cut at the end of the buffer
+                if end < len(self.__buffer) or self.__eof:
+                    self.__pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.__eof:
+                    raise
+            self.__read_more()
+
+def iter_json_hash_file(file_name):
+    """
+    Iterate over pairs (file name, hash) of JSON hash file. Records of "data" array are decoded one by one, so the file is not loaded into memory
+    """
+    with hash_storages.open_hash_file(file_name, "r", hash_storages.detect_compression(file_name)) as f:
+        reader = _JsonStreamReader(f)
+        try:
+            reader.expect("{")
+            if reader.peek() == "}":
+                return
+            while True:
+                key = reader.decode()
+                reader.expect(":")
+                if key != "data":
+                    reader.decode()
+                else:
+                    reader.expect("[")
+                    if reader.peek() != "]":
+                        while True:
+                            hash_record = reader.decode()
+                            yield hash_record["file_name"], hash_record["hash"].lower()
+                            if reader.expect(",]") == "]":
+                                break
+                    else:
+                        reader.expect("]")
+                if reader.expect(",}") == "}":
+                    return
+        except (ValueError, KeyError, TypeError) as err:
+            # json.JSONDecodeError is subclass of ValueError
+            raise util.AppUsageError(f"Input JSON file with hashes has wrong format: {err}.\n    File {file_name}") from err
+
+def iter_sorted_hash_file(file_name):
+    """
+    Iterate over triples (sort key, file name, hash) of the hash file in order of the records. Order of records is checked
+    """
+    if hash_storages.get_hash_file_format(file_name) == "binary":
+        try:
+            catalog = binary_catalog.BinaryCatalog(file_name)
+        except binary_catalog.CatalogFormatError as err:
+            raise util.AppUsageError(str(err)) from err
+        with catalog:
+            for key, data_file_name, hash_value in catalog:
+                yield (key, data_file_name), data_file_name, hash_value
+        return
+
+    if hash_storages.get_hash_file_format(file_name) == "json":
+        hash_records = iter_json_hash_file(file_name)
+    else:
+        hash_records = iter_text_hash_file(file_name)
+    last_key = None
+    for data_file_name, hash_value in hash_records:
+        key = hash_storages.file_name_sort_key(data_file_name)
+        if last_key is not None and key <= last_key:
+            raise util.AppUsageError(f"Hash file '{file_name}' is not sorted by file names, record for '{data_file_name}' is out of order. "
+                                     "Hash files sorted by hash values can't be compared")
+        last_key = key
+        yield key, data_file_name, hash_value
+
+class HashFilesComparison(object):
+    """
+    Compare old and new hash files. `counts` contains count of records for every status when iteration over `iter_differences()` is finished
+    """
+
+    def __init__(self, old_file_name, new_file_name):
+        if (hash_storages.get_hash_file_format(old_file_name) == "binary") != (hash_storages.get_hash_file_format(new_file_name) == "binary"):
+            raise util.AppUsageError("Binary catalog can be compared with binary catalog only, records of other hash files are in other order. "
+                                     "Please convert one of the hash files")
+        self.old_file_name = old_file_name
+        self.new_file_name = new_file_name
+        self.detect_renames = True
+        self.skip_equal_folders = True # Records below the folders with equal hashes are not compared, they are counted as unchanged
+        self.counts = {status: 0 for status in DiffStatus}
+
+    def __report(self, record: DiffRecord):
+        self.counts[record.status] += 1
+        return record
+
+    def iter_differences(self):
+        """
+        Iterate over `DiffRecord` for every changed file. Modified files are reported during merge, added, removed and renamed ones at the end.
+        If `detect_renames` is False, then all records are reported during merge in order of file names, so nothing is kept in memory
+        """
+        self.counts = {status: 0 for status in DiffStatus}
+        removed = [] # Pairs (file name, hash) in order of records
+        added = []
+
+        equal_folders = set() # Names of folder records with equal hashes
+        def is_below_equal_folder(data_file_name):
+            return equal_folders and any(folder_name in equal_folders for folder_name in tree_hash.iter_parent_folder_records(data_file_name))
+
+        old_records = iter_sorted_hash_file(self.old_file_name)
+        new_records = iter_sorted_hash_file(self.new_file_name)
+        old_record = next(old_records, None)
+        new_record = next(new_records, None)
+        while old_record is not None or new_record is not None:
+            if old_record is not None and is_below_equal_folder(old_record[1]):
+                old_record = next(old_records, None)
+            elif new_record is not None and is_below_equal_folder(new_record[1]):
+                self.counts[DiffStatus.UNCHANGED] += 1
+                new_record = next(new_records, None)
+            elif new_record is None or (old_record is not None and old_record[0] < new_record[0]):
+                if self.detect_renames:
+                    removed.append(old_record[1:])
+                else:
+                    yield self.__report(DiffRecord(DiffStatus.REMOVED, old_record[1], old_record[2]))
+                old_record = next(old_records, None)
+            elif old_record is None or new_record[0] < old_record[0]:
+                if self.detect_renames:
+                    added.append(new_record[1:])
+                else:
+                    yield self.__report(DiffRecord(DiffStatus.ADDED, new_record[1], new_record[2]))
+                new_record = next(new_records, None)
+            else:
+                if old_record[2] != new_record[2]:
+                    yield self.__report(DiffRecord(DiffStatus.MODIFIED, new_record[1], new_record[2], old_record[1], old_record[2]))
+                else:
+                    self.counts[DiffStatus.UNCHANGED] += 1
+                    if self.skip_equal_folders and tree_hash.is_folder_record(new_record[1]):
+                        equal_folders.add(new_record[1])
+                old_record = next(old_records, None)
+                new_record = next(new_records, None)
+
+        renamed = []
+        if self.detect_renames:
+            removed_by_hash = {} # Hash -> indexes in `removed`, the first one is renamed first
+            for index, (_, hash_value) in enumerate(removed):
+                removed_by_hash.setdefault(hash_value, collections.deque()).append(index)
+            renamed_indexes = set()
+            not_renamed = []
+            for data_file_name, hash_value in added:
+                indexes = removed_by_hash.get(hash_value)
+                if indexes:
+                    index = indexes.popleft()
+                    renamed_indexes.add(index)
+                    renamed.append(DiffRecord(DiffStatus.RENAMED, data_file_name, hash_value, removed[index][0], hash_value))
+                else:
+                    not_renamed.append((data_file_name, hash_value))
+            added = not_renamed
+            removed = [removed_record for index, removed_record in enumerate(removed) if index not in renamed_indexes]
+
+        for data_file_name, hash_value in removed:
+            yield self.__report(DiffRecord(DiffStatus.REMOVED, data_file_name, hash_value))
+        for data_file_name, hash_value in added:
+            yield self.__report(DiffRecord(DiffStatus.ADDED, data_file_name, hash_value))
+        for record in renamed:
+            yield self.__report(record)
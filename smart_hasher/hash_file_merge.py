@@ -0,0 +1,45 @@
+"""
+Merge of hash files, e.g. produced by instances which handle shards of input files on different nodes (see --shard), into one hash file.
+
+Records of text and JSON hash files are sorted by file names (see `hash_storages.file_name_sort_key()`), so hash files are merged with k-way merge
+in streaming fashion, they are not loaded into memory. File names are merged as they are stored, so relative file names are allowed
+only if the source hash file is in the same folder as the destination one.
+
+Ref: https://en.wikipedia.org/wiki/K-way_merge_algorithm
+Ref: https://docs.python.org/3/library/heapq.html#heapq.merge
+"""
+import heapq
+import os
+
+import hash_file_diff
+import hash_storages
+import util
+
+def _iter_checked_hash_file(file_name, destination_file_name):
+    """
+    Iterate over triples (sort key, file name, hash) of the source hash file. File names should be absolute if the file is in other folder than the destination
+    """
+    same_folder = os.path.normcase(os.path.dirname(os.path.abspath(file_name))) == os.path.normcase(os.path.dirname(os.path.abspath(destination_file_name)))
+    for record in hash_file_diff.iter_sorted_hash_file(file_name):
+        if not same_folder and not os.path.isabs(record[1]):
+            raise util.AppUsageError(f"Hash file '{file_name}' contains relative file name '{record[1]}', but it is not in the folder of the destination hash file. "
+                                     "Please place hash files in the same folder or use absolute file names")
+        yield record
+
+def iter_merged_hash_files(file_names, destination_file_name):
+    """
+    Iterate over pairs (file name, hash) of all source hash files sorted by file names. Records of the same file in several hash files
+    are merged into one, AppUsageError is raised if their hashes differ
+    """
+    for file_name in file_names:
+        if hash_storages.get_hash_file_format(file_name) == "binary":
+            raise util.AppUsageError(f"Binary catalog can't be merged, records of it are in other order: '{file_name}'. Please convert it to text or JSON hash file")
+    last_file_name = last_hash_value = None
+    for _, data_file_name, hash_value in heapq.merge(*[_iter_checked_hash_file(file_name, destination_file_name) for file_name in file_names],
+                                                      key=lambda record: record[0]):
+        if data_file_name == last_file_name:
+            if hash_value != last_hash_value:
+                raise util.AppUsageError(f"Hash files to merge contain different hashes for file '{data_file_name}': {last_hash_value} and {hash_value}")
+            continue
+        last_file_name, last_hash_value = data_file_name, hash_value
+        yield data_file_name, hash_value
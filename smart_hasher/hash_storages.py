@@ -4,9 +4,83 @@ import util
 import re
 import locale
 import json
-import shutil
 import time
-import uuid
+import collections
+import threading
+import gzip
+import lzma
+import bz2
+import heapq
+import hashlib
+import binary_catalog
+import tree_hash
+
+# Patterns of the lines in text hash files
+# Ref: https://docs.python.org/3/library/re.html
+comment_pattern = re.compile(r"\s*(#.*)?\n?")
+# Ref: https://stackoverflow.com/questions/50618116/regex-for-finding-file-paths
+# Ref: https://stackoverflow.com/questions/2758921/regular-expression-that-finds-and-replaces-non-ascii-characters-with-python
+hash_record_pattern = re.compile(r"(?P<hash>[0-9A-Fa-f]+)\s+\*(?P<file>[\\\\/\w.: \\-\u0080-\uFFFF\)\(!]+)\n?")
+
+# Compression name -> (file name extension, magic bytes at the beginning of file, function to open file, options of the function for writing)
+# Levels are chosen so that saving of large hash file is not much slower than loading it
+# Ref: https://docs.python.org/3/library/archiving.html
+compression_formats = {
+    "gzip": (".gz", b"\x1f\x8b", gzip.open, {"compresslevel": 6}),
+    "xz": (".xz", b"\xfd7zXZ\x00", lzma.open, {"preset": 1}),
+    "bz2": (".bz2", b"BZh", bz2.open, {}),
+}
+
+def get_compression_by_extension(file_name):
+    for compression, (extension, _, _, _) in compression_formats.items():
+        if file_name.endswith(extension):
+            return compression
+    return "none"
+
+def detect_compression(file_name):
+    """
+    Detect compression by magic bytes, so the compressed file is recognized regardless of its name
+    """
+    with open(file_name, "rb") as f:
+        header = f.read(8)
+    for compression, (_, magic, _, _) in compression_formats.items():
+        if header.startswith(magic):
+            return compression
+    return "none"
+
+def open_hash_file(file_name, mode, compression = "none", encoding = "utf-8"):
+    """
+    Open hash file in text mode, the data is compressed or decompressed in streaming fashion. `mode` is "r" or "w"
+    """
+    if compression is None or compression == "none":
+        return open(file_name, mode, encoding=encoding)
+    _, _, open_func, write_options = compression_formats[compression]
+    # Compressed files are always in UTF-8, there are no legacy compressed files in other encodings
+    if mode == "w":
+        return open_func(file_name, "wt", encoding="utf-8", **write_options)
+    return open_func(file_name, mode + "t", encoding="utf-8")
+
+def file_name_sort_key(file_name):
+    """
+    Key to sort records of hash files by file names. Hash files are compared with merge-join, so it should be the same for saving and comparing.
+
+    Ref: https://stackoverflow.com/questions/1097908/how-do-i-sort-unicode-strings-alphabetically-in-python
+    Ref: https://stackoverflow.com/a/50437802/13441
+    Ref: https://stackoverflow.com/a/1318709/13441
+    """
+    file_name_xfrm = locale.strxfrm(file_name)
+    return (file_name_xfrm.casefold(), file_name_xfrm)
+
+def get_hash_file_format(file_name):
+    """
+    Format of the hash file by extension of its name: "binary", "json" or "text". Extension of compression may follow ".json"
+    """
+    if file_name.endswith(binary_catalog.file_extension):
+        return "binary"
+    compression_format = compression_formats.get(get_compression_by_extension(file_name))
+    if compression_format is not None:
+        file_name = file_name[:-len(compression_format[0])]
+    return "json" if file_name.endswith(".json") else "text"
 
 class HashStorageAbstract(abc.ABC):
     """
@@ -20,6 +94,19 @@ class HashStorageAbstract(abc.ABC):
         self.suppress_hash_file_comments = False
         self.norm_case_file_names = False
         self.autosave_timeout = -1
+        self.fsync_policy = "file" # One of `util.fsync_policies`, it is applied when hash file is replaced on save
+        self.profiler = None # profiling.PhaseProfiler to measure time of loading, saving and file names handling
+
+    def _rel_file_path(self, work_file_name, base_file_name, return_absolute_path = False):
+        """
+        This is `util.rel_file_path()` which time is accounted in profiler if it is specified
+        """
+        if self.profiler is None:
+            return util.rel_file_path(work_file_name, base_file_name, return_absolute_path)
+        moment = self.profiler.start()
+        ret = util.rel_file_path(work_file_name, base_file_name, return_absolute_path)
+        self.profiler.add_since("rel_path", moment)
+        return ret
 
     def _check_data_hash_files_names_equal(self, data_file_name, hash_file_name):
         """
@@ -54,12 +141,51 @@ class HashStorageAbstract(abc.ABC):
         Check if the hash for file data_file_name is already calculated
         """
 
+    @abc.abstractmethod
+    def get_hash(self, data_file_name):
+        """
+        Get hash for the data file or None if there is no hash for it.
+        Unlike `has_hash` this does not mark the hash record as used, so it is intended for lookups rather than handling of input files
+        """
+
     @abc.abstractmethod
     def set_hash(self, data_file_name, hash_value):
         """
         Force re-hash should be accounted
         """
 
+    def set_hashes(self, hash_items):
+        """
+        Set hashes for many data files at once. `hash_items` is an iterable of pairs (data_file_name, hash_value).
+
+        Storages may override this to handle the batch cheaper than calling `set_hash` for every item
+        """
+        for data_file_name, hash_value in hash_items:
+            self.set_hash(data_file_name, hash_value)
+
+    @abc.abstractmethod
+    def remove_hash(self, data_file_name):
+        """
+        Remove hash for the data file, e.g. when the data file is deleted. Nothing is done if there is no hash for the file
+        """
+
+    @abc.abstractmethod
+    def remove_folder_hashes(self, folder_name):
+        """
+        Remove hashes for all data files below the folder, e.g. when the folder is deleted
+        """
+
+    def autosave_if_needed(self):
+        """
+        Save hashes if there are changes and `autosave_timeout` is expired. This is called periodically by long running handling, e.g. watching of folders
+        """
+
+    def is_hash_file(self, file_name):
+        """
+        Check if the file is a hash file of the storage, so it should be skipped when input folders are enumerated
+        """
+        return False
+
     def __enter__ (self):
         """
         Ref: https://www.geeksforgeeks.org/with-statement-in-python/ - it looks fine for __enter__, but not for __exit__
@@ -102,6 +228,16 @@ class HashPerFileStorage(HashStorageAbstract):
             raise util.AppUsageError(f"Path '{hash_file_name}' is dir and can't be used to save hash value")
         return True
 
+    def get_hash(self, data_file_name):
+        hash_file_name = self.get_hash_file_name(data_file_name)
+        if not os.path.isfile(hash_file_name):
+            return None
+        with open(hash_file_name, "r") as hash_file:
+            for line in hash_file:
+                if line.strip() and not line.startswith("#"):
+                    return line.split(" ", 1)[0]
+        return None
+
     def set_hash(self, data_file_name, hash_value):
         hash_file_name = self.get_hash_file_name(data_file_name)
         self._check_data_hash_files_names_equal(data_file_name, hash_file_name)
@@ -114,13 +250,21 @@ class HashPerFileStorage(HashStorageAbstract):
             if self.use_absolute_file_names:
                 data_file_name_user = os.path.abspath(data_file_name)
             else:
-                data_file_name_user = util.rel_file_path(data_file_name, hash_file_name, False)
+                data_file_name_user = self._rel_file_path(data_file_name, hash_file_name, False)
 
             if self.norm_case_file_names:
                 data_file_name_user = os.path.normcase(data_file_name_user)
 
             hash_file.write(f"{hash_value} *{data_file_name_user}\n")
 
+    def remove_hash(self, data_file_name):
+        hash_file_name = self.get_hash_file_name(data_file_name)
+        if os.path.isfile(hash_file_name):
+            os.remove(hash_file_name)
+
+    def remove_folder_hashes(self, folder_name):
+        pass # Hash files are stored near data files, so they are removed together with the folder
+
 class SingleFileHashesStorage(HashStorageAbstract):
     """
     This is a hash information storage to save hash information in one hash file for many data files
@@ -136,8 +280,22 @@ class SingleFileHashesStorage(HashStorageAbstract):
         self.preserve_unused_hash_records = False
         self.sort_by_hash_value = False
         self.json_format = False # Use JSON format for reading and writting data
+        self.compression = "auto" # Compression of hash file: "none", "auto" or one of `compression_formats`. For "auto" it is detected by content on load and by extension on save
         self.last_time_load_save = time.time() # Strictly speaking this is not correct value, but construction time is good value to avoid non-initialized variable
-        self.__backup_hash_file_name = ""
+        self.__unsaved_changes = False # True if hashes are changed after the last load or save
+        self.background_autosave = True # Save on expiration of `autosave_timeout` in background thread, so handling of files is not stalled
+        self.__autosave_thread = None
+        self.__autosave_error = None
+
+    def __get_compression_for_load(self, hash_file_name):
+        if self.compression == "auto":
+            return detect_compression(hash_file_name)
+        return self.compression
+
+    def __get_compression_for_save(self, hash_file_name):
+        if self.compression == "auto":
+            return get_compression_by_extension(hash_file_name)
+        return self.compression
 
     def __input_hash_file_error_message(self, error_message, hash_file_name, line_index, line):
         ret = f"{error_message}.\n    File {hash_file_name}"
@@ -150,7 +308,11 @@ class SingleFileHashesStorage(HashStorageAbstract):
             raise util.AppUsageError(self.__input_hash_file_error_message("Input hash file contains duplicated entry for file '{data_file_name}'", hash_file_name, line_index, line))
 
         #data_file_name =  os.path.abspath(data_file_name)
-        data_file_name = util.rel_file_path(data_file_name, hash_file_name, True)
+        is_folder = tree_hash.is_folder_record(data_file_name)
+        data_file_name = self._rel_file_path(data_file_name, hash_file_name, True)
+        if is_folder:
+            # Absolute path is normalized without separator at the end, but it marks folder record
+            data_file_name = os.path.join(os.path.abspath(data_file_name), "")
 
         if self.norm_case_file_names:
             data_file_name = os.path.normcase(data_file_name)
@@ -162,14 +324,8 @@ class SingleFileHashesStorage(HashStorageAbstract):
     def __load_hashes_info_from_text(self, hash_file_name):
         """
         Ref: https://docs.python.org/3.7/library/collections.html#collections.OrderedDict
-        Ref: https://docs.python.org/3/library/re.html
         """
-        comment_pattern = re.compile(r"\s*(#.*)?\n?")
-        # Ref: https://stackoverflow.com/questions/50618116/regex-for-finding-file-paths
-        # Ref: https://stackoverflow.com/questions/2758921/regular-expression-that-finds-and-replaces-non-ascii-characters-with-python
-        hash_record_pattern = re.compile(r"(?P<hash>[0-9A-Fa-f]+)\s+\*(?P<file>[\\\\/\w.: \\-\u0080-\uFFFF\)\(]+)\n?")
-
-        with open(hash_file_name, "r") as f:
+        with open_hash_file(hash_file_name, "r", self.__get_compression_for_load(hash_file_name), encoding=None) as f:
             line = f.readline()
             line_index = 1
             while line:
@@ -195,7 +351,7 @@ class SingleFileHashesStorage(HashStorageAbstract):
         Ref: https://stackabuse.com/reading-and-writing-json-to-a-file-in-python/
         Ref: https://docs.python.org/2/library/json.html
         """
-        with open(hash_file_name, "r", encoding="utf-8") as f:
+        with open_hash_file(hash_file_name, "r", self.__get_compression_for_load(hash_file_name)) as f:
             json_data = json.load(f)
         for hash_record in json_data["data"]:
             data_file_name = hash_record["file_name"]
@@ -206,10 +362,15 @@ class SingleFileHashesStorage(HashStorageAbstract):
         if self.single_hash_file_name_base is None:
             raise Exception("Input file name base is not specified")
         
+        self.__join_background_save()
+
         hash_file_name = self.get_hash_file_name(None)
         if not os.path.exists(hash_file_name):
             return
 
+        if self.profiler is not None:
+            moment = self.profiler.start()
+
         # Dictionary stores pair "absolute file name" -> "(hash, unused status)"
         self.hash_data = dict()
 
@@ -219,129 +380,137 @@ class SingleFileHashesStorage(HashStorageAbstract):
             self.__load_hashes_info_from_text(hash_file_name)
 
         self.last_time_load_save = time.time()
+        self.__unsaved_changes = False
 
-    def __save_hashes_info_file(self):
+        if self.profiler is not None:
+            self.profiler.add_since("storage_load", moment)
+
+    def __save_hashes_info_file(self, hash_data, in_background = False):
+        """
+        Hash file is written in one pass, so it can be compressed in streaming fashion.
+        `hash_data` is a snapshot of hashes in case of save in background thread, profiler is not used there because it is not thread safe
+        """
+        rel_file_path = util.rel_file_path if in_background else self._rel_file_path
         if not self.suppress_hash_file_comments:
             all_header_comments = self.hash_file_header_comments.copy()
             # Ref: https://blog.finxter.com/python-how-to-count-elements-in-a-list-matching-a-condition/
             # Ref: https://stackoverflow.com/questions/3013449/list-comprehension-vs-lambda-filter
-            record_number = sum((v[1][1] or self.preserve_unused_hash_records) for v in self.hash_data.items())
+            record_number = sum((v[1][1] or self.preserve_unused_hash_records) for v in hash_data.items())
             all_header_comments.append(f"Number of records: {record_number}.")
 
         hash_file_name = self.get_hash_file_name(None)
 
-        if self.json_format:
-            json_data = {}
-        else:
+        if not self.json_format:
             hash_file_folder = os.path.split(hash_file_name)[0]
             if hash_file_folder != "" and not os.path.isdir(hash_file_folder):
                 raise Exception(f"Folder to create hash file in does not exist: {hash_file_folder}")
-            # Create empty file
-            with open(hash_file_name, "w"):
-                pass
-
-        if not self.suppress_hash_file_comments:
-            if self.json_format:
-                # Ref: https://stackoverflow.com/questions/244777/can-comments-be-used-in-json
-                json_data["_comment"] = all_header_comments
-            else:
-                comment_str = "# " + "\n# ".join(all_header_comments) + "\n"
-                with open(hash_file_name, "a") as hash_file:
-                    hash_file.write(comment_str)
-
-        if self.json_format:
-            # We added data after _comment, so the "_comment" follow above the data.
-            # Strictly speaking JSON writer may not preserve such order, but usually does.
-            json_data["data"] = []
 
         hash_data_sorted = []
 
+        # Most of data files are usually in the folder of the hash file or below, relative names for them are just suffixes.
+        # This is much cheaper than `util.rel_file_path()`, which is used for other files
+        hash_file_dir_prefix = os.path.join(util.drive_normcase(os.path.dirname(os.path.abspath(hash_file_name))), "")
+        hash_file_dir_prefix_len = len(hash_file_dir_prefix)
+
         # Ref: https://stackoverflow.com/questions/3294889/iterating-over-dictionaries-using-for-loops
         #for data_file_name, hash in self.hash_data.items():
-        for data_file_name, hash_value in self.hash_data.items():
+        for data_file_name, hash_value in hash_data.items():
             if self.use_absolute_file_names:
                 data_file_name_user = data_file_name
                 assert os.path.isabs(data_file_name_user)
+            elif data_file_name == hash_file_dir_prefix:
+                # Folder record for the folder of the hash file itself
+                data_file_name_user = tree_hash.root_folder_record
+            elif data_file_name.startswith(hash_file_dir_prefix):
+                data_file_name_user = data_file_name[hash_file_dir_prefix_len:]
+            elif tree_hash.is_folder_record(data_file_name):
+                data_file_name_user = os.path.join(rel_file_path(os.path.dirname(data_file_name), hash_file_name, False), "")
             else:
-                data_file_name_user = util.rel_file_path(data_file_name, hash_file_name, False)
+                data_file_name_user = rel_file_path(data_file_name, hash_file_name, False)
             hash_data_sorted.append((data_file_name_user, hash_value))
 
         if self.sort_by_hash_value:
             # Sort by hash. If hashes equal, sort by file name
-            key1 = lambda v: (v[1][0].lower(), locale.strxfrm(v[0]).casefold(), locale.strxfrm(v[0]))
+            key1 = lambda v: (v[1][0].lower(),) + file_name_sort_key(v[0])
         else:
-            # Ref: https://stackoverflow.com/questions/1097908/how-do-i-sort-unicode-strings-alphabetically-in-python
-            # Ref: https://stackoverflow.com/a/50437802/13441
-            # Ref: https://stackoverflow.com/a/1318709/13441
-            key1 = lambda v: (locale.strxfrm(v[0]).casefold(), locale.strxfrm(v[0]))
+            key1 = lambda v: file_name_sort_key(v[0])
                 
         hash_data_sorted.sort(key=key1)
 
-        try:
-            if not self.json_format:
-                hash_file = open(hash_file_name, "a", encoding="utf-8")
-
-            for data_file_name, hash_info in hash_data_sorted:
-                # Check that current hash entry should be stored
-                if self.preserve_unused_hash_records or hash_info[1]:
-                    if self.json_format:
-                        json_data["data"].append({"file_name": data_file_name, "hash": hash_info[0]})
-                    else:
-                        hash_file.write(f"{hash_info[0]} *{data_file_name}\n")
-        except BaseException as be: # pylint: disable=W0703
-            raise be
-        finally:
-            if not self.json_format:
-                hash_file.close()
-
-        if not self.suppress_hash_file_comments:
-            if not self.json_format:
-                with open(hash_file_name, "a") as hash_file:
-                    hash_file.write("# End of file\n")
+        compression = self.__get_compression_for_save(hash_file_name)
+        # Hash file is written to temporary file which replaces it, so hash file is consistent even if the program is interrupted while saving
+        with util.atomic_file_write(hash_file_name, self.fsync_policy) as tmp_hash_file_name:
+            with open_hash_file(tmp_hash_file_name, "w", compression) as hash_file:
+                if self.json_format:
+                    json_data = {}
+                    if not self.suppress_hash_file_comments:
+                        # Ref: https://stackoverflow.com/questions/244777/can-comments-be-used-in-json
+                        json_data["_comment"] = all_header_comments
+                    # We added data after _comment, so the "_comment" follow above the data.
+                    # Strictly speaking JSON writer may not preserve such order, but usually does.
+                    json_data["data"] = [{"file_name": data_file_name, "hash": hash_info[0]} for data_file_name, hash_info in hash_data_sorted
+                                         if self.preserve_unused_hash_records or hash_info[1]]
+                    # Ref: https://stackoverflow.com/questions/12943819/how-to-prettyprint-a-json-file
+                    # Ref: https://stackoverflow.com/questions/16291358/python-saving-json-files-as-utf-8
+                    json.dump(json_data, hash_file, indent=4, ensure_ascii=False)
+                else:
+                    if not self.suppress_hash_file_comments:
+                        hash_file.write("# " + "\n# ".join(all_header_comments) + "\n")
+                    for data_file_name, hash_info in hash_data_sorted:
+                        # Check that current hash entry should be stored
+                        if self.preserve_unused_hash_records or hash_info[1]:
+                            hash_file.write(f"{hash_info[0]} *{data_file_name}\n")
+                    if not self.suppress_hash_file_comments:
+                        hash_file.write("# End of file\n")
 
-        if self.json_format:
-            with open(hash_file_name, 'w', encoding="utf-8") as f:
-                # Ref: https://stackoverflow.com/questions/12943819/how-to-prettyprint-a-json-file
-                # Ref: https://stackoverflow.com/questions/16291358/python-saving-json-files-as-utf-8
-                json.dump(json_data, f, indent=4, ensure_ascii=False)
+    def save_sorted_hashes(self, hash_items):
+        """
+        Write hash file from pairs (file name as it is stored, hash) in streaming fashion, e.g. merged from other hash files, so records are not kept in memory.
+        Records should be sorted by `file_name_sort_key()`, they are written as is. Count of records is not known in advance, so it is written at the end
+        """
+        hash_file_name = self.get_hash_file_name(None)
+        record_number = 0
+        with util.atomic_file_write(hash_file_name, self.fsync_policy) as tmp_hash_file_name:
+            with open_hash_file(tmp_hash_file_name, "w", self.__get_compression_for_save(hash_file_name)) as hash_file:
+                if self.json_format:
+                    # The same layout as written by `json.dump()` with indent 4 for the whole file
+                    hash_file.write("{\n")
+                    if not self.suppress_hash_file_comments:
+                        hash_file.write('    "_comment": ' + json.dumps(self.hash_file_header_comments, indent=4, ensure_ascii=False).replace("\n", "\n    ") + ",\n")
+                    hash_file.write('    "data": [')
+                    for data_file_name, hash_value in hash_items:
+                        hash_record = json.dumps({"file_name": data_file_name, "hash": hash_value}, indent=4, ensure_ascii=False)
+                        hash_file.write(("\n" if record_number == 0 else ",\n") + "        " + hash_record.replace("\n", "\n        "))
+                        record_number += 1
+                    hash_file.write("\n    ]\n}" if record_number > 0 else "]\n}")
+                else:
+                    if not self.suppress_hash_file_comments:
+                        hash_file.write("# " + "\n# ".join(self.hash_file_header_comments) + "\n")
+                    for data_file_name, hash_value in hash_items:
+                        hash_file.write(f"{hash_value} *{data_file_name}\n")
+                        record_number += 1
+                    if not self.suppress_hash_file_comments:
+                        hash_file.write(f"# Number of records: {record_number}.\n# End of file\n")
+        self.last_time_load_save = time.time()
+        return record_number
 
     def save_hashes_info(self):
-        self.__hash_file_make_backup()
-        self.__save_hashes_info_file()
-        # Note, in case of exception backup is not cleaned up. But actually this is what we want, because in case of exception we may need to restore data from backup.
-        self.__hash_file_del_backup()
+        if self.profiler is not None:
+            moment = self.profiler.start()
+
+        # Background save writes older snapshot, so it should not finish after this save. Its error is not reported, because all hashes are saved here
+        self.__join_background_save()
+        self.__save_hashes_info_file(self.hash_data)
         self.last_time_load_save = time.time()
+        self.__unsaved_changes = False
+
+        if self.profiler is not None:
+            self.profiler.add_since("storage_save", moment)
 
     def get_hash_file_name(self, _):
         ret = f"{self.single_hash_file_name_base}{self.hash_file_name_postfix}"
         return ret
 
-    def __get_backup_hash_file_name(self):
-        """
-        Return backup file name based on hash file name. Hash file name should be prefix of it
-
-        If there is backup file name then it is generated.
-        """
-        hash_file_name = self.get_hash_file_name(None)
-        if self.__backup_hash_file_name.startswith(hash_file_name):
-            return self.__backup_hash_file_name
-
-        # Ref: https://docs.python.org/2/library/uuid.html
-        self.__backup_hash_file_name = f"{hash_file_name}.back.{uuid.uuid1()}"
-        return self.__backup_hash_file_name
-
-    def __hash_file_make_backup(self):
-        hash_file_name = self.get_hash_file_name(None)
-        backup_hash_file_name = self.__get_backup_hash_file_name()
-        if os.path.isfile(hash_file_name):
-            shutil.copyfile(hash_file_name, backup_hash_file_name)
-            #time.sleep(5)
-
-    def __hash_file_del_backup(self):
-        backup_hash_file_name = self.__get_backup_hash_file_name()
-        if os.path.isfile(backup_hash_file_name):
-            os.remove(backup_hash_file_name)
-
     def has_hash(self, data_file_name):
         self._check_data_hash_files_names_equal(data_file_name, self.get_hash_file_name(None))
 
@@ -355,8 +524,55 @@ class SingleFileHashesStorage(HashStorageAbstract):
             self.hash_data[fn] = (self.hash_data[fn][0], True)
         return ret
 
-    def __autosave_if_needed(self):
-        if self.autosave_timeout == -1:
+    def __join_background_save(self):
+        """
+        Wait for background save if it is running. Error of background save is returned
+        """
+        if self.__autosave_thread is None:
+            return None
+        self.__autosave_thread.join()
+        self.__autosave_thread = None
+        ret = self.__autosave_error
+        self.__autosave_error = None
+        return ret
+
+    def __background_save(self, hash_data):
+        try:
+            self.__save_hashes_info_file(hash_data, True)
+        except BaseException as err: # pylint: disable=W0703
+            self.__autosave_error = err
+
+    def __start_background_save(self):
+        """
+        Save is done from the snapshot of `hash_data`. Values of `hash_data` are immutable tuples, so shallow copy is enough.
+        Copy is much cheaper than sorting and writing, which are done in background thread
+
+        Ref: https://docs.python.org/3/library/threading.html
+        """
+        if self.profiler is not None:
+            moment = self.profiler.start()
+
+        hash_data = dict(self.hash_data)
+        self.__autosave_thread = threading.Thread(target=self.__background_save, args=(hash_data,), name="hash_file_autosave")
+        self.__autosave_thread.start()
+        self.last_time_load_save = time.time()
+        self.__unsaved_changes = False
+
+        if self.profiler is not None:
+            self.profiler.add_since("storage_snapshot", moment)
+
+    def autosave_if_needed(self):
+        """
+        With `background_autosave` only one background save runs at a time. If it is still running when autosave is needed again,
+        then the changes are accumulated until it is finished. Error of background save is raised on the next call
+        """
+        if self.__autosave_thread is not None and not self.__autosave_thread.is_alive():
+            error = self.__join_background_save()
+            if error is not None:
+                self.__unsaved_changes = True
+                raise error
+
+        if self.autosave_timeout == -1 or not self.__unsaved_changes:
             return
 
         if self.autosave_timeout == 0:
@@ -366,11 +582,15 @@ class SingleFileHashesStorage(HashStorageAbstract):
         # Ref: https://stackoverflow.com/questions/3638532/find-time-difference-in-seconds-as-an-integer-with-python
         # Ref: https://docs.python.org/3/library/time.html#time.time
         if time.time() - self.last_time_load_save > self.autosave_timeout:
-            self.save_hashes_info()
+            if not self.background_autosave:
+                self.save_hashes_info()
+            elif self.__autosave_thread is None:
+                self.__start_background_save()
             return
 
-    def set_hash(self, data_file_name, hash_value):
-        self._check_data_hash_files_names_equal(data_file_name, self.get_hash_file_name(None))
+    def __set_hash_no_autosave(self, data_file_name, hash_value, check_file_names = True):
+        if check_file_names:
+            self._check_data_hash_files_names_equal(data_file_name, self.get_hash_file_name(None))
 
         fn = os.path.abspath(data_file_name)
         fn = util.drive_normcase(fn)
@@ -379,5 +599,499 @@ class SingleFileHashesStorage(HashStorageAbstract):
         if self.norm_case_file_names:
             fn = os.path.normcase(fn)
         self.hash_data[fn] = (hash_value, True)
+        self.__unsaved_changes = True
+
+    def set_hash(self, data_file_name, hash_value):
+        self.__set_hash_no_autosave(data_file_name, hash_value)
+        self.autosave_if_needed()
+
+    def __get_data_file_key(self, data_file_name):
+        fn = util.drive_normcase(os.path.abspath(data_file_name))
+        if self.norm_case_file_names:
+            fn = os.path.normcase(fn)
+        return fn
+
+    def get_hash(self, data_file_name):
+        hash_info = self.hash_data.get(self.__get_data_file_key(data_file_name))
+        if hash_info is None:
+            return None
+        return hash_info[0]
+
+    def remove_hash(self, data_file_name):
+        if self.hash_data.pop(self.__get_data_file_key(data_file_name), None) is not None:
+            self.__unsaved_changes = True
+        self.autosave_if_needed()
+
+    def remove_folder_hashes(self, folder_name):
+        prefix = os.path.join(self.__get_data_file_key(folder_name), "")
+        removed_file_names = [fn for fn in self.hash_data if fn.startswith(prefix)]
+        for fn in removed_file_names:
+            del self.hash_data[fn]
+        if removed_file_names:
+            self.__unsaved_changes = True
+        self.autosave_if_needed()
+
+    @staticmethod
+    def __samestat(data_file_name, hash_file_stat):
+        try:
+            return os.path.samestat(os.stat(data_file_name), hash_file_stat)
+        except OSError:
+            # Data file may be not a regular file, e.g. member of archive
+            return False
+
+    def set_hashes(self, hash_items):
+        """
+        Autosave is checked once for the whole batch, so with `autosave_timeout` 0 the hash file is saved once per batch rather than per file.
+
+        Resolving real path for every data file is expensive, so data files are compared with the hash file by stat.
+        If the hash file does not exist, then it can't be the same as any existing data file.
+        """
+        hash_file_name = self.get_hash_file_name(None)
+        try:
+            hash_file_stat = os.stat(hash_file_name)
+        except FileNotFoundError:
+            hash_file_stat = None
+
+        for data_file_name, hash_value in hash_items:
+            if hash_file_stat is not None and self.__samestat(data_file_name, hash_file_stat):
+                self._check_data_hash_files_names_equal(data_file_name, hash_file_name)
+            self.__set_hash_no_autosave(data_file_name, hash_value, False)
+        self.autosave_if_needed()
+
+    def iter_hashes(self):
+        """
+        Iterate over pairs (absolute data file name, hash) for all records, e.g. to convert the hash file to other format
+        """
+        for data_file_name, hash_info in self.hash_data.items():
+            yield data_file_name, hash_info[0]
+
+    def import_hashes(self, hash_items):
+        """
+        Add pairs (absolute data file name, hash) from other storage. Unlike `set_hashes` data files are not accessed, so they may not exist
+        """
+        for data_file_name, hash_value in hash_items:
+            self.hash_data[data_file_name] = (hash_value, True)
+            self.__unsaved_changes = True
+
+    def remove_folder_records(self, folder_names):
+        """
+        Remove records of the folders and their subfolders, e.g. if the files are not handled completely and folder hashes can't be trusted
+        """
+        folder_prefixes = tuple(os.path.join(self.__get_data_file_key(folder_name), "") for folder_name in folder_names)
+        removed_file_names = [fn for fn in self.hash_data if tree_hash.is_folder_record(fn) and fn.startswith(folder_prefixes)]
+        for fn in removed_file_names:
+            del self.hash_data[fn]
+        if removed_file_names:
+            self.__unsaved_changes = True
+
+    def update_folder_hashes(self, folder_names, hash_algo):
+        """
+        Calculate hashes of the folders and their subfolders from hashes of files stored, see `tree_hash`. Data files are not read.
+        Hashes are stored as records with separator at the end of the folder name, previous records of the folders are replaced
+        """
+        if self.profiler is not None:
+            moment = self.profiler.start()
+
+        self.remove_folder_records(folder_names)
+        folder_keys = [self.__get_data_file_key(folder_name) for folder_name in folder_names]
+        # Records which are not used in this run are not saved, so they are not accounted
+        file_hashes = ((data_file_name, hash_info[0]) for data_file_name, hash_info in self.hash_data.items()
+                       if (hash_info[1] or self.preserve_unused_hash_records) and not tree_hash.is_folder_record(data_file_name))
+        folder_hashes = tree_hash.get_folder_hashes(file_hashes, folder_keys, hash_algo)
+        for folder_name, hash_value in folder_hashes.items():
+            self.hash_data[os.path.join(folder_name, "")] = (hash_value, True)
+        self.__unsaved_changes = True
+
+        if self.profiler is not None:
+            self.profiler.add_since("folder_hashes", moment)
+
+class PerDirectoryHashesStorage(HashStorageAbstract):
+    """
+    This is a hash information storage to save hash information in one hash file per data folder.
+
+    Hash file of the folder (shard) contains records for the data files of this folder only, file names are stored without path.
+    Shards are loaded when the hashes of the folder are accessed first time, and the least recently used shards are unloaded when count of loaded shards
+    exceeds `max_loaded_shards`. Only changed shards are saved. So memory usage and saving cost depend on the folders handled rather than the whole tree.
+
+    Records for the data files which don't exist are deleted when the shard is loaded, unless `preserve_unused_hash_records` is specified.
+    """
+
+    class _Shard(object):
+        def __init__(self):
+            self.hash_data = dict() # Data file name without path -> hash
+            self.dirty = False
+
+    def __init__(self):
+        super().__init__()
+        self.per_directory_hash_file_name_base = None # Name of the hash file in every folder without path, `hash_file_name_postfix` is appended to it
+        self.preserve_unused_hash_records = False
+        self.sort_by_hash_value = False
+        self.max_loaded_shards = 256
+        self.last_time_load_save = time.time()
+        self.__shards = collections.OrderedDict() # Absolute folder name -> _Shard, ordered from the least recently used
+
+    def __get_shard_file_base_name(self):
+        if not self.per_directory_hash_file_name_base:
+            raise Exception("Hash file name base is not specified")
+        return self.per_directory_hash_file_name_base + self.hash_file_name_postfix
+
+    def __split_data_file_name(self, data_file_name):
+        folder_name, base_file_name = os.path.split(util.drive_normcase(os.path.abspath(data_file_name)))
+        if base_file_name == self.__get_shard_file_base_name():
+            raise util.AppUsageError(f"Data and hash file names are the same: '{data_file_name}'. Please exclude hash files from input data files")
+        # Ref: https://docs.python.org/3.2/library/os.path.html#os.path.normcase
+        if self.norm_case_file_names:
+            folder_name = os.path.normcase(folder_name)
+            base_file_name = os.path.normcase(base_file_name)
+        return folder_name, base_file_name
+
+    def __load_shard(self, folder_name):
+        shard = self._Shard()
+        hash_file_name = os.path.join(folder_name, self.__get_shard_file_base_name())
+        if not os.path.isfile(hash_file_name):
+            return shard
+
+        if self.profiler is not None:
+            moment = self.profiler.start()
+
+        with open(hash_file_name, "r", encoding="utf-8") as f:
+            for line_index, line in enumerate(f, 1):
+                if comment_pattern.fullmatch(line):
+                    continue
+                match = hash_record_pattern.fullmatch(line)
+                if match is None:
+                    raise util.AppUsageError(f"Input file with hashes has wrong format.\n    File {hash_file_name}, Line {line_index}: {line[0:200]}")
+                base_file_name = match.group("file")
+                if self.norm_case_file_names:
+                    base_file_name = os.path.normcase(base_file_name)
+                if base_file_name in shard.hash_data:
+                    raise util.AppUsageError(f"Input hash file contains duplicated entry for file '{base_file_name}'.\n    File {hash_file_name}, Line {line_index}")
+                shard.hash_data[base_file_name] = match.group("hash").lower()
+
+        if not self.preserve_unused_hash_records:
+            existing_file_names = os.listdir(folder_name)
+            if self.norm_case_file_names:
+                existing_file_names = [os.path.normcase(fn) for fn in existing_file_names]
+            existing_file_names = set(existing_file_names)
+            for base_file_name in [fn for fn in shard.hash_data if fn not in existing_file_names]:
+                del shard.hash_data[base_file_name]
+                shard.dirty = True
+
+        if self.profiler is not None:
+            self.profiler.add_since("storage_load", moment)
+        return shard
+
+    def __save_shard(self, folder_name, shard):
+        if self.profiler is not None:
+            moment = self.profiler.start()
+
+        hash_file_name = os.path.join(folder_name, self.__get_shard_file_base_name())
+        if not shard.hash_data:
+            if os.path.isfile(hash_file_name):
+                os.remove(hash_file_name)
+        elif os.path.isdir(folder_name):
+            if self.sort_by_hash_value:
+                key1 = lambda v: (v[1].lower(),) + file_name_sort_key(v[0])
+            else:
+                key1 = lambda v: file_name_sort_key(v[0])
+            lines = []
+            if not self.suppress_hash_file_comments:
+                lines += [f"# {cmt}\n" for cmt in self.hash_file_header_comments + [f"Number of records: {len(shard.hash_data)}."]]
+            lines += [f"{hash_value} *{base_file_name}\n" for base_file_name, hash_value in sorted(shard.hash_data.items(), key=key1)]
+            if not self.suppress_hash_file_comments:
+                lines.append("# End of file\n")
+            with util.atomic_file_write(hash_file_name, self.fsync_policy) as tmp_hash_file_name:
+                with open(tmp_hash_file_name, "w", encoding="utf-8") as f:
+                    f.writelines(lines)
+        shard.dirty = False
+
+        if self.profiler is not None:
+            self.profiler.add_since("storage_save", moment)
+
+    def __get_shard(self, folder_name):
+        shard = self.__shards.get(folder_name)
+        if shard is not None:
+            self.__shards.move_to_end(folder_name)
+            return shard
+
+        shard = self.__load_shard(folder_name)
+        self.__shards[folder_name] = shard
+        while len(self.__shards) > self.max_loaded_shards:
+            unloaded_folder_name, unloaded_shard = self.__shards.popitem(last=False)
+            if unloaded_shard.dirty:
+                self.__save_shard(unloaded_folder_name, unloaded_shard)
+        return shard
+
+    def load_hashes_info(self):
+        """
+        Shards are loaded on demand, so this only resets loaded shards
+        """
+        self.__get_shard_file_base_name()
+        self.__shards.clear()
+        self.last_time_load_save = time.time()
+
+    def save_hashes_info(self):
+        for folder_name, shard in self.__shards.items():
+            if shard.dirty:
+                self.__save_shard(folder_name, shard)
+        self.last_time_load_save = time.time()
+
+    def autosave_if_needed(self):
+        if self.autosave_timeout == -1:
+            return
+        if self.autosave_timeout == 0 or time.time() - self.last_time_load_save > self.autosave_timeout:
+            self.save_hashes_info()
+
+    def is_hash_file(self, file_name):
+        return os.path.basename(file_name) == self.__get_shard_file_base_name()
+
+    def get_hash_file_name(self, data_file_name):
+        return os.path.join(os.path.dirname(os.path.abspath(data_file_name)), self.__get_shard_file_base_name())
+
+    def has_hash(self, data_file_name):
+        return self.get_hash(data_file_name) is not None
+
+    def get_hash(self, data_file_name):
+        folder_name, base_file_name = self.__split_data_file_name(data_file_name)
+        return self.__get_shard(folder_name).hash_data.get(base_file_name)
+
+    def set_hash(self, data_file_name, hash_value):
+        folder_name, base_file_name = self.__split_data_file_name(data_file_name)
+        shard = self.__get_shard(folder_name)
+        shard.hash_data[base_file_name] = hash_value
+        shard.dirty = True
+        self.autosave_if_needed()
+
+    def set_hashes(self, hash_items):
+        """
+        Autosave is checked once for the whole batch
+        """
+        autosave_timeout = self.autosave_timeout
+        self.autosave_timeout = -1
+        try:
+            super().set_hashes(hash_items)
+        finally:
+            self.autosave_timeout = autosave_timeout
+        self.autosave_if_needed()
+
+    def remove_hash(self, data_file_name):
+        folder_name, base_file_name = self.__split_data_file_name(data_file_name)
+        shard = self.__get_shard(folder_name)
+        if shard.hash_data.pop(base_file_name, None) is not None:
+            shard.dirty = True
+        self.autosave_if_needed()
+
+    def remove_folder_hashes(self, folder_name):
+        # Hash files are removed together with the folder, so only loaded shards are forgotten
+        prefix = os.path.join(util.drive_normcase(os.path.abspath(folder_name)), "")
+        for loaded_folder_name in [fn for fn in self.__shards if os.path.join(fn, "").startswith(prefix)]:
+            del self.__shards[loaded_folder_name]
 
-        self.__autosave_if_needed()
\ No newline at end of file
+class BinaryCatalogHashesStorage(HashStorageAbstract):
+    """
+    This is a hash information storage to save hash information for many data files in one binary catalog, see `binary_catalog` module.
+
+    Catalog is memory mapped and queried with binary search, so it is not loaded into memory and loading time does not depend on its size.
+    Changed and removed hashes are kept in memory and merged into the catalog on save. Both catalog and changes are sorted by key,
+    so merge is done in one streaming pass and the new catalog replaces the old one atomically.
+
+    File names are stored relative to the folder of the catalog, or absolute ones if `use_absolute_file_names` is specified.
+    Options of file names of existing catalog are kept, so the catalog should be converted to change them.
+    Records are not marked as used, so all of them are preserved in the catalog.
+    Catalog is opened on the first access and closed on save, so the file is not kept open between saves.
+    """
+
+    extension = binary_catalog.file_extension
+
+    def __init__(self):
+        super().__init__()
+        self.binary_catalog_file_name_base = None
+        self.hash_algo = None # Name of hash algorithm stored in the header of catalog, it should correspond to size of the hashes
+        self.last_time_load_save = time.time()
+        self.__catalog = None
+        self.__catalog_opened = False
+        self.__changes = dict() # File name as stored in catalog -> hash, or None if hash is removed
+
+    def __get_options_flags(self):
+        ret = 0
+        if self.use_absolute_file_names:
+            ret |= binary_catalog.FLAG_ABSOLUTE_FILE_NAMES
+        if self.norm_case_file_names:
+            ret |= binary_catalog.FLAG_NORM_CASE_FILE_NAMES
+        return ret
+
+    def __get_catalog(self):
+        if not self.__catalog_opened:
+            self.__catalog_opened = True
+            hash_file_name = self.get_hash_file_name(None)
+            if os.path.exists(hash_file_name):
+                try:
+                    self.__catalog = binary_catalog.BinaryCatalog(hash_file_name)
+                except binary_catalog.CatalogFormatError as err:
+                    raise util.AppUsageError(str(err)) from err
+        return self.__catalog
+
+    def __get_flags(self):
+        catalog = self.__get_catalog()
+        if catalog is not None:
+            return catalog.flags
+        return self.__get_options_flags()
+
+    def __get_catalog_dir_prefix(self):
+        return os.path.join(util.drive_normcase(os.path.dirname(os.path.abspath(self.get_hash_file_name(None)))), "")
+
+    def __get_catalog_file_name(self, data_file_name):
+        """
+        Convert data file name to the form which is stored in catalog
+        """
+        flags = self.__get_flags()
+        fn = util.drive_normcase(os.path.abspath(data_file_name))
+        if flags & binary_catalog.FLAG_NORM_CASE_FILE_NAMES:
+            fn = os.path.normcase(fn)
+        if flags & binary_catalog.FLAG_ABSOLUTE_FILE_NAMES:
+            return fn
+        prefix = self.__get_catalog_dir_prefix()
+        if fn.startswith(prefix):
+            return fn[len(prefix):]
+        return self._rel_file_path(fn, self.get_hash_file_name(None), False)
+
+    def __get_data_file_name(self, catalog_file_name, catalog_dir_prefix):
+        if self.__get_flags() & binary_catalog.FLAG_ABSOLUTE_FILE_NAMES:
+            return catalog_file_name
+        return os.path.normpath(os.path.join(catalog_dir_prefix, catalog_file_name))
+
+    def __close_catalog(self):
+        if self.__catalog is not None:
+            self.__catalog.close()
+            self.__catalog = None
+        self.__catalog_opened = False
+
+    def __iter_merged_entries(self):
+        """
+        Iterate over entries (key, catalog file name, hash) of catalog with changes applied, in order of keys
+        """
+        catalog_entries = ((key, fn, 1, hash_value) for key, fn, hash_value in (self.__get_catalog() or []))
+        changed_entries = ((key, fn, 0, hash_value) for key, fn, hash_value in binary_catalog.sort_records(self.__changes.items()))
+        # Changed entry goes before catalog entry with the same file name, so it replaces that one
+        last_entry = None
+        for key, fn, _, hash_value in heapq.merge(changed_entries, catalog_entries):
+            if (key, fn) == last_entry:
+                continue
+            last_entry = (key, fn)
+            if hash_value is not None:
+                yield key, fn, hash_value
+
+    def load_hashes_info(self):
+        if self.binary_catalog_file_name_base is None:
+            raise Exception("Binary catalog file name base is not specified")
+
+        self.__close_catalog()
+        self.__changes = dict()
+        # Catalog is checked on load to report wrong file early
+        self.__get_catalog()
+        self.last_time_load_save = time.time()
+
+    def save_hashes_info(self):
+        hash_file_name = self.get_hash_file_name(None)
+        catalog = self.__get_catalog()
+        if not self.__changes and catalog is not None:
+            self.__close_catalog()
+            self.last_time_load_save = time.time()
+            return
+
+        if self.profiler is not None:
+            moment = self.profiler.start()
+
+        try:
+            if catalog is not None:
+                hash_size = catalog.hash_size
+            else:
+                hash_size = next((len(hash_value) // 2 for hash_value in self.__changes.values() if hash_value is not None), None)
+                if hash_size is None:
+                    hash_size = hashlib.new(self.hash_algo).digest_size
+            if self.hash_algo is not None and hashlib.new(self.hash_algo).digest_size != hash_size:
+                raise util.AppUsageError(f"Size of hashes in binary catalog '{hash_file_name}' does not correspond to hash algorithm {self.hash_algo}")
+
+            with binary_catalog.BinaryCatalogWriter(hash_file_name, self.hash_algo or "", hash_size, self.__get_flags(), self.fsync_policy) as writer:
+                for entry in self.__iter_merged_entries():
+                    writer.add(*entry)
+                # Catalog is replaced when writer is closed, memory mapped file can't be replaced on some platforms
+                self.__close_catalog()
+        except ValueError as err:
+            raise util.AppUsageError(f"Binary catalog '{hash_file_name}' can't be saved: {err}") from err
+        finally:
+            self.__close_catalog()
+        self.__changes = dict()
+        self.last_time_load_save = time.time()
+
+        if self.profiler is not None:
+            self.profiler.add_since("storage_save", moment)
+
+    def get_hash_file_name(self, _):
+        return f"{self.binary_catalog_file_name_base}{self.hash_file_name_postfix}"
+
+    def has_hash(self, data_file_name):
+        self._check_data_hash_files_names_equal(data_file_name, self.get_hash_file_name(None))
+        return self.get_hash(data_file_name) is not None
+
+    def get_hash(self, data_file_name):
+        fn = self.__get_catalog_file_name(data_file_name)
+        if fn in self.__changes:
+            return self.__changes[fn]
+        catalog = self.__get_catalog()
+        if catalog is None:
+            return None
+        return catalog.lookup(fn)
+
+    def set_hash(self, data_file_name, hash_value):
+        self._check_data_hash_files_names_equal(data_file_name, self.get_hash_file_name(None))
+        self.__changes[self.__get_catalog_file_name(data_file_name)] = hash_value
+        self.autosave_if_needed()
+
+    def set_hashes(self, hash_items):
+        """
+        Autosave is checked once for the whole batch, because every save rewrites the catalog
+        """
+        autosave_timeout = self.autosave_timeout
+        self.autosave_timeout = -1
+        try:
+            super().set_hashes(hash_items)
+        finally:
+            self.autosave_timeout = autosave_timeout
+        self.autosave_if_needed()
+
+    def remove_hash(self, data_file_name):
+        if self.get_hash(data_file_name) is not None:
+            self.__changes[self.__get_catalog_file_name(data_file_name)] = None
+        self.autosave_if_needed()
+
+    def remove_folder_hashes(self, folder_name):
+        """
+        This scans the whole catalog, so it is expensive for large catalogs. Changes are sorted before the scan, so they can be updated during it
+        """
+        prefix = os.path.join(self.__get_catalog_file_name(folder_name), "")
+        for _, fn, _ in self.__iter_merged_entries():
+            if fn.startswith(prefix):
+                self.__changes[fn] = None
+        self.autosave_if_needed()
+
+    def autosave_if_needed(self):
+        if self.autosave_timeout == -1 or not self.__changes:
+            return
+        if self.autosave_timeout == 0 or time.time() - self.last_time_load_save > self.autosave_timeout:
+            self.save_hashes_info()
+
+    def iter_hashes(self):
+        """
+        Iterate over pairs (absolute data file name, hash) for all records, e.g. to convert the catalog to other format
+        """
+        catalog_dir_prefix = self.__get_catalog_dir_prefix()
+        for _, fn, hash_value in self.__iter_merged_entries():
+            yield self.__get_data_file_name(fn, catalog_dir_prefix), hash_value
+
+    def import_hashes(self, hash_items):
+        """
+        Add pairs (absolute data file name, hash) from other storage. Unlike `set_hashes` data files are not accessed, so they may not exist
+        """
+        for data_file_name, hash_value in hash_items:
+            self.__changes[self.__get_catalog_file_name(data_file_name)] = hash_value
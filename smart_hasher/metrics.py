@@ -0,0 +1,145 @@
+import json
+import os
+import time
+import uuid
+
+class MetricsCollector(object):
+    """
+    This is a class to collect machine readable performance metrics of the program run.
+
+    Metrics are reported in two forms, each of them is optional:
+      * NDJSON stream with one record per file. Ref: http://ndjson.org/
+      * Prometheus textfile with counters and throughput histogram, it is periodically rewritten.
+        Ref: https://github.com/prometheus/node_exporter#textfile-collector
+        Ref: https://prometheus.io/docs/instrumenting/exposition_formats/
+    """
+
+    # Upper bounds of the throughput histogram buckets, bytes per second
+    throughput_buckets = tuple(mib * 1024 * 1024 for mib in (1, 5, 10, 25, 50, 100, 200, 500, 1000, 2000))
+
+    # Throughput of small files mostly shows per-file overhead rather than disk speed, so they are not observed in histogram
+    throughput_min_file_size = 1024 * 1024
+
+    def __init__(self):
+        self.ndjson_file_name = None
+        self.prometheus_textfile_name = None
+        self.prometheus_update_interval = 15 # in seconds
+        self.files_total = {"hashed": 0, "skipped": 0, "failed": 0}
+        self.bytes_read_total = 0
+        self.read_seconds_total = 0.0
+        self.retries_total = 0
+        self.throughput_bucket_counts = [0] * len(self.throughput_buckets)
+        self.throughput_count = 0
+        self.throughput_sum = 0.0
+        self.start_time = time.time()
+        self.__ndjson_file = None
+        self.__last_prometheus_update = None
+
+    def open(self):
+        if self.ndjson_file_name is not None:
+            # Line buffering, so the records are available for the consumers as soon as a file is handled
+            self.__ndjson_file = open(self.ndjson_file_name, "a", encoding="utf-8", buffering=1)
+        self.write_prometheus_textfile()
+
+    def close(self):
+        if self.__ndjson_file is not None:
+            self.__ndjson_file.close()
+            self.__ndjson_file = None
+        self.write_prometheus_textfile()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def add_file_record(self, file_name, size, bytes_read = 0, duration = 0.0, retries = 0, skip_reason = None, failed = False):
+        """
+        Add metrics for one handled file.
+
+        `skip_reason` is specified if hash is not calculated, e.g. because it already exists. `failed` is True if hash can't be calculated due to errors
+        """
+        throughput = bytes_read / duration if duration > 0 else None
+
+        if failed:
+            self.files_total["failed"] += 1
+        elif skip_reason is not None:
+            self.files_total["skipped"] += 1
+        else:
+            self.files_total["hashed"] += 1
+        self.bytes_read_total += bytes_read
+        self.read_seconds_total += duration
+        self.retries_total += retries
+
+        if throughput is not None and not failed and bytes_read >= self.throughput_min_file_size:
+            self.throughput_count += 1
+            self.throughput_sum += throughput
+            for i, bucket in enumerate(self.throughput_buckets):
+                if throughput <= bucket:
+                    self.throughput_bucket_counts[i] += 1
+                    break
+
+        if self.__ndjson_file is not None:
+            record = {
+                "timestamp": time.time(),
+                "path": file_name,
+                "size": size,
+                "bytes_read": bytes_read,
+                "duration": duration,
+                "throughput": throughput,
+                "retries": retries,
+                "skip_reason": skip_reason,
+                "failed": failed}
+            self.__ndjson_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        if self.__last_prometheus_update is None or time.monotonic() - self.__last_prometheus_update >= self.prometheus_update_interval:
+            self.write_prometheus_textfile()
+
+    def get_prometheus_text(self):
+        lines = [
+            "# HELP smart_hasher_files_total Count of input files handled by result.",
+            "# TYPE smart_hasher_files_total counter"]
+        for result, count in self.files_total.items():
+            lines.append(f'smart_hasher_files_total{{result="{result}"}} {count}')
+
+        lines += [
+            "# HELP smart_hasher_bytes_read_total Count of bytes read from input files.",
+            "# TYPE smart_hasher_bytes_read_total counter",
+            f"smart_hasher_bytes_read_total {self.bytes_read_total}",
+            "# HELP smart_hasher_read_seconds_total Time spent on handling of input files, seconds.",
+            "# TYPE smart_hasher_read_seconds_total counter",
+            f"smart_hasher_read_seconds_total {self.read_seconds_total}",
+            "# HELP smart_hasher_read_retries_total Count of retries on data read errors.",
+            "# TYPE smart_hasher_read_retries_total counter",
+            f"smart_hasher_read_retries_total {self.retries_total}",
+            f"# HELP smart_hasher_file_throughput_bytes_per_second Throughput of reading input files not smaller than {self.throughput_min_file_size} bytes.",
+            "# TYPE smart_hasher_file_throughput_bytes_per_second histogram"]
+        cumulative_count = 0
+        for bucket, count in zip(self.throughput_buckets, self.throughput_bucket_counts):
+            cumulative_count += count
+            lines.append(f'smart_hasher_file_throughput_bytes_per_second_bucket{{le="{bucket}"}} {cumulative_count}')
+        lines += [
+            f'smart_hasher_file_throughput_bytes_per_second_bucket{{le="+Inf"}} {self.throughput_count}',
+            f"smart_hasher_file_throughput_bytes_per_second_sum {self.throughput_sum}",
+            f"smart_hasher_file_throughput_bytes_per_second_count {self.throughput_count}",
+            "# HELP smart_hasher_run_start_timestamp_seconds Time when the program run started.",
+            "# TYPE smart_hasher_run_start_timestamp_seconds gauge",
+            f"smart_hasher_run_start_timestamp_seconds {self.start_time}",
+            "# HELP smart_hasher_last_update_timestamp_seconds Time when metrics were updated last time.",
+            "# TYPE smart_hasher_last_update_timestamp_seconds gauge",
+            f"smart_hasher_last_update_timestamp_seconds {time.time()}"]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_textfile(self):
+        """
+        File is written to a temporary file and then renamed, so the collector never reads partially written file
+        """
+        if self.prometheus_textfile_name is None:
+            return
+        tmp_file_name = f"{self.prometheus_textfile_name}.tmp.{uuid.uuid1()}"
+        with open(tmp_file_name, "w", encoding="utf-8") as f:
+            f.write(self.get_prometheus_text())
+        os.replace(tmp_file_name, self.prometheus_textfile_name)
+        self.__last_prometheus_update = time.monotonic()
@@ -0,0 +1,46 @@
+import time
+
+class PhaseProfiler(object):
+    """
+    This is a class to accumulate time spent in the phases of the program run, e.g. data reading, hash calculation, saving of hash file.
+
+    Monotonic timer with nanosecond resolution is used. The code which is measured calls `start()` once and then `add_since()`
+    at the end of every phase, so the overhead is one timer call per phase.
+
+    Ref: https://docs.python.org/3/library/time.html#time.perf_counter_ns
+    """
+
+    def __init__(self):
+        self.phases = {} # Phase name -> [total duration in nanoseconds, count of calls]
+        self.start_moment = time.perf_counter_ns()
+
+    @staticmethod
+    def start():
+        return time.perf_counter_ns()
+
+    def add(self, phase, duration_ns):
+        phase_info = self.phases.get(phase)
+        if phase_info is None:
+            self.phases[phase] = [duration_ns, 1]
+        else:
+            phase_info[0] += duration_ns
+            phase_info[1] += 1
+
+    def add_since(self, phase, start_moment):
+        """
+        Account time passed from `start_moment` to `phase`. Returns current moment, so it can be used as start of the next phase
+        """
+        cur_moment = time.perf_counter_ns()
+        self.add(phase, cur_moment - start_moment)
+        return cur_moment
+
+    def get_report(self):
+        total_ns = time.perf_counter_ns() - self.start_moment
+        lines = [f"Profile of the program run. Total time: {total_ns / 1e9:.3f} sec",
+                 f"{'Phase':<24} {'Time, sec':>12} {'Share':>8} {'Calls':>12} {'Per call, us':>14}"]
+        for phase, (duration_ns, count) in sorted(self.phases.items(), key=lambda v: -v[1][0]):
+            share = duration_ns / total_ns * 100 if total_ns > 0 else 0
+            lines.append(f"{phase:<24} {duration_ns / 1e9:>12.3f} {share:>7.1f}% {count:>12,d} {duration_ns / count / 1e3:>14.1f}")
+        lines.append("Note, some phases are nested: 'rel_path' is a part of 'storage_load' and 'storage_save', "
+                     "'storage_save' may be a part of 'storage_set_hash' on autosave")
+        return "\n".join(lines)
@@ -0,0 +1,198 @@
+"""
+Local server which answers requests for hashes from hash storage loaded into memory once.
+
+Server listens on Unix domain socket. Protocol is newline delimited JSON (Ref: http://ndjson.org/): client sends one request per line
+and receives one response per line in the same order. Client may send many requests over one connection, connections are handled concurrently.
+
+Request:
+    {"id": 1, "op": "lookup", "paths": ["/data/file1.txt", "/data/file2.txt"]}
+Response:
+    {"id": 1, "results": [{"path": "/data/file1.txt", "hash": "..."}, {"path": "/data/file2.txt", "hash": null}]}
+
+Operations:
+    lookup - get hash from the storage, `hash` is null if there is no hash for the file.
+    has_hash - check if the storage has hash for the file, result contains boolean `has_hash`.
+    compute - get hash from the storage, and calculate it if it is missing. Result contains `hash`, `computed` flag and `error` if hash can't be calculated.
+        Specify `"force": true` to calculate hash even if it is in the storage.
+    ping - check that server is alive.
+`id` is optional, it is returned as is. On error response contains `error` instead of `results`.
+
+Paths should be absolute, relative paths are resolved from the current folder of the server.
+"""
+import json
+import os
+import socket
+import socketserver
+import stat
+import threading
+
+import hash_storages
+import util
+
+class HashLookupRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handle all requests of one connection
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.process_message(line)
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+class HashLookupServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Server for hash storage.
+
+    Storage is not thread safe, so it is accessed under `storage_lock`. Hashes are calculated without lock, so files are read in parallel.
+    `compute_hash(file_name)` should return hash for the file or None if it can't be calculated
+    """
+
+    daemon_threads = True # Client connections don't prevent the program exit
+
+    def __init__(self, socket_path, hash_storage: hash_storages.HashStorageAbstract, compute_hash = None):
+        self.socket_path = socket_path
+        self.hash_storage = hash_storage
+        self.compute_hash = compute_hash
+        self.storage_lock = threading.Lock()
+        self.__closed = False
+        self.__remove_stale_socket()
+        super().__init__(socket_path, HashLookupRequestHandler)
+
+    def __remove_stale_socket(self):
+        """
+        Socket file is left after the server which is not stopped gracefully. It should be removed, unless other server is listening on it
+        """
+        if not os.path.exists(self.socket_path):
+            return
+        if not stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+            raise OSError(f"Path '{self.socket_path}' exists and it is not a socket")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(self.socket_path)
+            except OSError:
+                os.remove(self.socket_path)
+                return
+        raise OSError(f"Other server is listening on socket '{self.socket_path}'")
+
+    def server_close(self):
+        """
+        Connections may be still handled after the server is closed, so storage is not accessed after that and it can be saved safely
+        """
+        with self.storage_lock:
+            self.__closed = True
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def __get_hash(self, path):
+        with self.storage_lock:
+            if self.__closed:
+                raise OSError("Server is stopped")
+            return self.hash_storage.get_hash(path)
+
+    def __lookup(self, path):
+        return {"path": path, "hash": self.__get_hash(path)}
+
+    def __has_hash(self, path):
+        return {"path": path, "has_hash": self.__get_hash(path) is not None}
+
+    def __compute(self, path, force):
+        if not force:
+            hash_value = self.__get_hash(path)
+            if hash_value is not None:
+                return {"path": path, "hash": hash_value, "computed": False, "error": None}
+
+        if self.compute_hash is None:
+            return {"path": path, "hash": None, "computed": False, "error": "Calculation of hashes is not supported by the server"}
+        if not os.path.isfile(path):
+            return {"path": path, "hash": None, "computed": False, "error": "File does not exist"}
+        hash_value = self.compute_hash(path)
+        if hash_value is None:
+            return {"path": path, "hash": None, "computed": False, "error": "Hash can't be calculated due to data read error"}
+
+        with self.storage_lock:
+            if self.__closed:
+                raise OSError("Server is stopped")
+            self.hash_storage.set_hash(path, hash_value)
+        return {"path": path, "hash": hash_value, "computed": True, "error": None}
+
+    def process_message(self, message):
+        """
+        Handle one request and return response. Errors of the request are reported in response
+        """
+        request_id = None
+        try:
+            request = json.loads(message)
+            if not isinstance(request, dict):
+                raise ValueError("Request should be JSON object")
+            request_id = request.get("id")
+            op = request.get("op")
+            if op == "ping":
+                return {"id": request_id, "results": []}
+
+            paths = request.get("paths")
+            if paths is None and "path" in request:
+                paths = [request["path"]]
+            if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+                raise ValueError("'paths' should be list of strings")
+
+            if op == "lookup":
+                results = [self.__lookup(path) for path in paths]
+            elif op == "has_hash":
+                results = [self.__has_hash(path) for path in paths]
+            elif op == "compute":
+                force = bool(request.get("force", False))
+                results = [self.__compute(path, force) for path in paths]
+            else:
+                raise ValueError(f"Unknown operation: {op!r}")
+            return {"id": request_id, "results": results}
+        except (ValueError, OSError, util.AppUsageError) as err:
+            # json.JSONDecodeError is subclass of ValueError. AppUsageError is raised by the storage, e.g. for the path of the hash file itself
+            return {"id": request_id, "error": f"{type(err).__name__}: {err}"}
+
+class HashLookupClient(object):
+    """
+    Client for `HashLookupServer`. Example:
+
+        with HashLookupClient("/run/smart_hasher.sock") as client:
+            hashes = {res["path"]: res["hash"] for res in client.request("lookup", paths)}
+    """
+
+    def __init__(self, socket_path, timeout = None):
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__socket.settimeout(timeout)
+        self.__socket.connect(socket_path)
+        self.__file = self.__socket.makefile("rwb")
+        self.__next_id = 0
+
+    def close(self):
+        self.__file.close()
+        self.__socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def request(self, op, paths = None, **params):
+        """
+        Send request and return results. Exception is raised if server reports error
+        """
+        self.__next_id += 1
+        request = dict(params, id=self.__next_id, op=op)
+        if paths is not None:
+            request["paths"] = list(paths)
+        self.__file.write(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+        self.__file.flush()
+        line = self.__file.readline()
+        if not line:
+            raise ConnectionError("Connection is closed by server")
+        response = json.loads(line)
+        if "error" in response:
+            raise RuntimeError(f"Server error: {response['error']}")
+        return response.get("results", response)
@@ -0,0 +1,122 @@
+import unittest
+import os
+import shutil
+import filecmp
+import hashlib
+import tests.util_test
+import binary_catalog
+import hash_storages
+import cmd_line
+
+class BinaryCatalogTestCase(unittest.TestCase):
+
+    def  setUp(self):
+        self.data_path = tests.util_test.get_data_path()
+        self.work_path = tests.util_test.get_work_path()
+        tests.util_test.clean_work_dir()
+
+    def  tearDown(self):
+        tests.util_test.clean_work_dir()
+
+    def test_write_lookup(self):
+        catalog_file_name = os.path.join(self.work_path, "catalog.shcat")
+        records = {f"folder{i % 7}/file_{i}.txt": hashlib.sha1(str(i).encode()).hexdigest() for i in range(1000)}
+        with binary_catalog.BinaryCatalogWriter(catalog_file_name, "sha1", 20) as writer:
+            for entry in binary_catalog.sort_records(records.items()):
+                writer.add(*entry)
+
+        with binary_catalog.BinaryCatalog(catalog_file_name) as catalog:
+            self.assertEqual(len(catalog), len(records))
+            self.assertEqual(catalog.hash_algo, "sha1")
+            for file_name, hash_value in records.items():
+                self.assertEqual(catalog.lookup(file_name), hash_value)
+            self.assertIsNone(catalog.lookup("folder0/missing.txt"))
+            self.assertEqual({fn: hash_value for _, fn, hash_value in catalog}, records)
+
+        # Entries should be added in order of keys
+        with self.assertRaises(ValueError):
+            with binary_catalog.BinaryCatalogWriter(catalog_file_name, "sha1", 20) as writer:
+                for entry in reversed(binary_catalog.sort_records(records.items())):
+                    writer.add(*entry)
+        self.assertEqual(os.listdir(self.work_path), ["catalog.shcat"])
+
+        with open(catalog_file_name, "wb") as f:
+            f.write(b"0123456789abcdef" * 8)
+        with self.assertRaises(binary_catalog.CatalogFormatError):
+            binary_catalog.BinaryCatalog(catalog_file_name)
+
+    def test_storage(self):
+        data_folder = os.path.join(self.work_path, "data")
+        data_file_names = [os.path.join(data_folder, f"file{i}.txt") for i in range(5)]
+        hash_storage = hash_storages.BinaryCatalogHashesStorage()
+        hash_storage.binary_catalog_file_name_base = os.path.join(self.work_path, "hashes")
+        hash_storage.hash_file_name_postfix = ".sha1.shcat"
+        hash_storage.hash_algo = "sha1"
+        with hash_storage:
+            for i, data_file_name in enumerate(data_file_names):
+                hash_storage.set_hash(data_file_name, f"{i:040x}")
+
+        with hash_storage:
+            self.assertTrue(hash_storage.has_hash(data_file_names[1]))
+            self.assertEqual(hash_storage.get_hash(data_file_names[2]), f"{2:040x}")
+            self.assertIsNone(hash_storage.get_hash(os.path.join(self.work_path, "file1.txt")))
+            hash_storage.set_hash(data_file_names[3], "f" * 40)
+            hash_storage.remove_hash(data_file_names[4])
+            self.assertIsNone(hash_storage.get_hash(data_file_names[4]))
+
+        with hash_storage:
+            self.assertEqual(dict(hash_storage.iter_hashes()), {data_file_names[0]: f"{0:040x}", data_file_names[1]: f"{1:040x}",
+                                                                 data_file_names[2]: f"{2:040x}", data_file_names[3]: "f" * 40})
+            hash_storage.remove_folder_hashes(data_folder)
+        with hash_storage:
+            self.assertEqual(list(hash_storage.iter_hashes()), [])
+
+        # Hash of other size can't be stored
+        hash_storage.hash_algo = "sha256"
+        with self.assertRaises(Exception):
+            with hash_storage:
+                hash_storage.set_hash(data_file_names[0], "0" * 64)
+
+    def test_cli_binary_catalog(self):
+        data_folder = os.path.join(self.work_path, "data")
+        os.mkdir(data_folder)
+        for i in range(1, 4):
+            shutil.copyfile(os.path.join(self.data_path, f"file{i}.txt"), os.path.join(data_folder, f"file{i}.txt"))
+
+        hash_file_base = os.path.join(self.work_path, "hashes")
+        cl = f"--input-folder {data_folder} --single-hash-file-name-base-binary {hash_file_base} --suppress-console-reporting-output"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        catalog_file_name = hash_file_base + ".sha1.shcat"
+        catalog_mtime = os.stat(catalog_file_name).st_mtime_ns
+        # Nothing is changed, so the catalog is not rewritten
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        self.assertEqual(os.stat(catalog_file_name).st_mtime_ns, catalog_mtime)
+
+        with binary_catalog.BinaryCatalog(catalog_file_name) as catalog:
+            for i in range(1, 4):
+                with open(os.path.join(data_folder, f"file{i}.txt"), "rb") as f:
+                    self.assertEqual(catalog.lookup(os.path.join("data", f"file{i}.txt")), hashlib.sha1(f.read()).hexdigest())
+
+        cl = f"--input-folder {data_folder} --single-hash-file-name-base-binary {hash_file_base} --single-hash-file-name-base {hash_file_base}"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+
+    def test_cli_convert(self):
+        hash_storage_file = "dummy_hash_storage_2_general_rel.sha1"
+        work_hash_storage_file = os.path.join(self.work_path, hash_storage_file)
+        data_hash_storage_file = os.path.join(self.data_path, "hash_storages", hash_storage_file)
+        shutil.copyfile(data_hash_storage_file, work_hash_storage_file)
+
+        # Text -> binary -> JSON -> text gives the same records
+        catalog_file_name = os.path.join(self.work_path, "converted.sha1.shcat")
+        json_file_name = os.path.join(self.work_path, "converted.sha1.json")
+        text_file_name = os.path.join(self.work_path, "converted.sha1")
+        for source, destination in [(work_hash_storage_file, catalog_file_name), (catalog_file_name, json_file_name), (json_file_name, text_file_name)]:
+            cl = f"--convert-hash-file {source} {destination} --suppress-output-file-comments --suppress-console-reporting-output"
+            self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        self.assertTrue(filecmp.cmp(text_file_name, data_hash_storage_file + ".save", shallow=False), f"Wrong output in '{text_file_name}'")
+
+        cl = f"--convert-hash-file {catalog_file_name} {text_file_name} --input-folder {self.work_path}"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+
+if __name__ == '__main__':
+    unittest.main()
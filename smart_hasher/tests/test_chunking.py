@@ -0,0 +1,59 @@
+import unittest
+import random
+import chunking
+
+class ChunkingTestCase(unittest.TestCase):
+
+    def get_chunks(self, data, piece_size, average_size = 1024):
+        """
+        Return list of (digest, size) of the chunks of `data` passed to the chunker in pieces of `piece_size`
+        """
+        chunks = []
+        class RecordingIndex(chunking.ChunkIndex):
+            def add(self, digest, size):
+                chunks.append((digest, size))
+                super().add(digest, size)
+        chunker = chunking.Chunker(RecordingIndex(), average_size)
+        for pos in range(0, len(data), piece_size):
+            chunker.update(data[pos:pos + piece_size])
+        chunker.finish()
+        return chunks
+
+    def test_chunker(self):
+        rnd = random.Random(0)
+        data = rnd.randbytes(256 * 1024)
+        chunks = self.get_chunks(data, len(data))
+        self.assertEqual(sum(size for _, size in chunks), len(data))
+        for _, size in chunks[:-1]:
+            self.assertTrue(256 <= size <= 8 * 1024, size)
+        # Average size is close to the specified one
+        self.assertTrue(512 < len(data) / len(chunks) < 2048, len(data) / len(chunks))
+        # Boundaries don't depend on the pieces of data
+        self.assertEqual(self.get_chunks(data, 1000), chunks)
+        self.assertEqual(self.get_chunks(data, 1), chunks)
+
+        # Boundaries are restored after inserted data, so most of chunks are the same
+        shifted_chunks = self.get_chunks(data[:1000] + b"inserted" + data[1000:], 4096)
+        self.assertLessEqual(len(set(shifted_chunks) - set(chunks)), 2)
+
+        # Data without boundaries is split by maximal size
+        self.assertEqual([size for _, size in self.get_chunks(bytes(20 * 1024), 4096)], [8 * 1024, 8 * 1024, 4 * 1024])
+        self.assertEqual(self.get_chunks(b"", 10), [])
+
+    def test_chunk_index(self):
+        merge_threshold = chunking.ChunkIndex.merge_threshold
+        chunking.ChunkIndex.merge_threshold = 4
+        try:
+            chunk_index = chunking.ChunkIndex()
+            for i in range(100):
+                chunk_index.add(i * 7919 % 101, 10)
+            for i in range(50):
+                chunk_index.add(i * 13 % 101, 20)
+        finally:
+            chunking.ChunkIndex.merge_threshold = merge_threshold
+        self.assertEqual((chunk_index.total_count, chunk_index.total_size), (150, 2000))
+        self.assertEqual((chunk_index.unique_count, chunk_index.unique_size), (100, 1000))
+        self.assertIn("(50.0%)", chunk_index.get_report())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,21 @@ import os
 import shutil
 import filecmp
 import tracemalloc
+import hashlib
+import json
+import io
+import sys
+import contextlib
+import pstats
+import threading
+import time
+import tarfile
+import zipfile
 
 import tests.util_test
 import cmd_line
+import util
+import watcher
 
 class SimpleCommandLineTestCase(unittest.TestCase):
     """This class contains testing simple functionality from command line"""
@@ -196,6 +208,21 @@ class SimpleCommandLineTestCase(unittest.TestCase):
         # Ref: https://docs.python.org/3.7/library/filecmp.html
         self.assertTrue(filecmp.cmp(data_file_name, work_file_name, shallow=False), f"Input data file is corrupted! ({work_file_name})")
 
+        # Single hash file is checked by real path, e.g. for input file which is a symbolic link to the hash file
+        hash_file_name = f'{self.work_path}/hashes.sha1'
+        cl = f'--input-file {work_file_name} --single-hash-file-name-base {self.work_path}/hashes --suppress-console-reporting-output'
+        self.assertEqual(cmd_line_adapter.run_cmd_line(cl), cmd_line.ExitCode.OK)
+        with open(hash_file_name, "rb") as f:
+            hash_file_data = f.read()
+        try:
+            os.symlink(hash_file_name, f'{self.work_path}/link.txt')
+        except OSError:
+            return # Creation of symbolic links requires privileges on Windows
+        cl = f'--input-file {self.work_path}/link.txt --single-hash-file-name-base {self.work_path}/hashes --suppress-console-reporting-output'
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.APP_USAGE_ERROR)
+        with open(hash_file_name, "rb") as f:
+            self.assertEqual(f.read(), hash_file_data)
+
     def test_calc_hash_with_user_comments(self):
         shutil.copyfile(f'{self.data_path}/file1.txt', f'{self.work_path}/file1.txt')
 
@@ -237,6 +264,432 @@ class SimpleCommandLineTestCase(unittest.TestCase):
         exit_code = cmd_line_adapter.run_cmd_line(f'--input-file {self.work_path}\\file1.txt --input-file {self.work_path}\\fake_file.txt --suppress-console-reporting-output')
         self.assertTrue(exit_code == cmd_line.ExitCode.DATA_READ_ERROR, "Report on non-existent file expected")
 
+    def test_small_file_fast_path(self):
+        hash_values_expected = {}
+        for i in range(1, 4):
+            shutil.copyfile(f'{self.data_path}/file{i}.txt', f'{self.work_path}/file{i}.txt')
+            with open(f'{self.work_path}/file{i}.txt', "rb") as f:
+                hash_values_expected[f"file{i}.txt"] = hashlib.sha1(f.read()).hexdigest()
+
+        hash_file_name = f"{self.work_path}/hash_storage.sha1"
+
+        # Threshold 0 disables fast path, so results of both paths are compared
+        for small_file_threshold in [0, 1024 * 1024]:
+            cmd_line_adapter = cmd_line.CommandLineAdapter()
+            exit_code = cmd_line_adapter.run_cmd_line(f'--input-folder {self.work_path} --input-folder-file-mask-exclude *.sha1 --single-hash-file-name-base {hash_file_name} '
+                                                      f'--suppress-hash-file-name-postfix --small-file-threshold {small_file_threshold} --force-calc-hash '
+                                                      '--suppress-console-reporting-output --suppress-output-file-comments')
+            self.assertEqual(exit_code, cmd_line.ExitCode.OK)
+
+            with open(hash_file_name, "r") as f:
+                hash_values_actual = {file_name.strip(): hash_value for hash_value, file_name in (line.split(" *") for line in f)}
+            with self.subTest(small_file_threshold = small_file_threshold):
+                self.assertEqual(hash_values_expected, hash_values_actual)
+
+    def test_metrics_output(self):
+        data_folder = f"{self.work_path}/data"
+        os.mkdir(data_folder)
+        for i in range(1, 4):
+            shutil.copyfile(f'{self.data_path}/file{i}.txt', f'{data_folder}/file{i}.txt')
+
+        ndjson_file_name = f"{self.work_path}/metrics.ndjson"
+        prometheus_file_name = f"{self.work_path}/metrics.prom"
+        cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/hash_storage --suppress-console-reporting-output " \
+             f"--metrics-ndjson-file {ndjson_file_name} --metrics-prometheus-textfile {prometheus_file_name}"
+
+        # Second run skips all files, because hashes are already calculated
+        for _ in range(2):
+            cmd_line_adapter = cmd_line.CommandLineAdapter()
+            exit_code = cmd_line_adapter.run_cmd_line(cl)
+            self.assertEqual(exit_code, cmd_line.ExitCode.OK)
+
+        with open(ndjson_file_name, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 6)
+        for record in records[:3]:
+            self.assertIsNone(record["skip_reason"])
+            self.assertEqual(record["size"], record["bytes_read"])
+            self.assertEqual(record["retries"], 0)
+        for record in records[3:]:
+            self.assertEqual(record["skip_reason"], "hash_exists")
+            self.assertEqual(record["bytes_read"], 0)
+
+        # Prometheus file reflects the last run only
+        with open(prometheus_file_name, "r", encoding="utf-8") as f:
+            prometheus_lines = f.read().splitlines()
+        self.assertIn('smart_hasher_files_total{result="hashed"} 0', prometheus_lines)
+        self.assertIn('smart_hasher_files_total{result="skipped"} 3', prometheus_lines)
+        self.assertIn('smart_hasher_bytes_read_total 0', prometheus_lines)
+
+    @unittest.skipUnless(hasattr(os, "link"), "Hard links are not supported")
+    def test_hardlink_dedup(self):
+        data_folder = f"{self.work_path}/data"
+        os.mkdir(data_folder)
+        shutil.copyfile(f'{self.data_path}/file1.txt', f'{data_folder}/file1.txt')
+        shutil.copyfile(f'{self.data_path}/file2.txt', f'{data_folder}/file2.txt')
+        for i in range(1, 3):
+            os.link(f'{data_folder}/file1.txt', f'{data_folder}/link{i}.txt')
+        os.link(f'{data_folder}/file2.txt', f'{data_folder}/link3.txt')
+        with open(f'{data_folder}/file1.txt', "rb") as f:
+            file1_hash = hashlib.sha1(f.read()).hexdigest()
+        with open(f'{data_folder}/file2.txt', "rb") as f:
+            file2_hash = hashlib.sha1(f.read()).hexdigest()
+
+        # Both fast path and regular path are checked
+        for small_file_threshold, suppress_hardlink_dedup in [(1024 * 1024, False), (0, False), (0, True)]:
+            ndjson_file_name = f"{self.work_path}/metrics.ndjson"
+            cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/hash_storage --suppress-console-reporting-output --force-calc-hash " \
+                 f"--small-file-threshold {small_file_threshold} --metrics-ndjson-file {ndjson_file_name} --suppress-output-file-comments"
+            if suppress_hardlink_dedup:
+                cl += " --suppress-hardlink-dedup"
+            self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+
+            with open(ndjson_file_name, "r", encoding="utf-8") as f:
+                records = {os.path.basename(record["path"]): record for record in (json.loads(line) for line in f)}
+            os.remove(ndjson_file_name)
+            with self.subTest(small_file_threshold = small_file_threshold, suppress_hardlink_dedup = suppress_hardlink_dedup):
+                read_file_names = sorted(fn for fn, record in records.items() if record["bytes_read"] > 0)
+                self.assertEqual(read_file_names, sorted(records) if suppress_hardlink_dedup else ["file1.txt", "file2.txt"])
+                with open(f"{self.work_path}/hash_storage.sha1", "r") as f:
+                    hash_values = {file_name.strip(): hash_value for hash_value, file_name in (line.split(" *") for line in f)}
+                self.assertEqual(hash_values, {os.path.join("data", fn): hash_value for fn, hash_value in
+                                               [("file1.txt", file1_hash), ("link1.txt", file1_hash), ("link2.txt", file1_hash),
+                                                ("file2.txt", file2_hash), ("link3.txt", file2_hash)]})
+
+    def test_input_file_order(self):
+        data_folder = f"{self.work_path}/data"
+        os.mkdir(data_folder)
+        # Files are created in reversed order of names, so order of inodes differs from order of names on most file systems
+        for i in reversed(range(1, 5)):
+            shutil.copyfile(f'{self.data_path}/file{i}.txt', f'{data_folder}/file{i}.txt')
+        with open(f'{data_folder}/empty.txt', "w"):
+            pass
+
+        hash_file_contents = []
+        for input_file_order in ["name", "inode", "physical"]:
+            ndjson_file_name = f"{self.work_path}/metrics.ndjson"
+            cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/hash_storage_{input_file_order} --suppress-console-reporting-output " \
+                 f"--input-file-order {input_file_order} --metrics-ndjson-file {ndjson_file_name} --suppress-output-file-comments"
+            self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+
+            with open(ndjson_file_name, "r", encoding="utf-8") as f:
+                handled_file_names = [json.loads(line)["path"] for line in f]
+            os.remove(ndjson_file_name)
+            with self.subTest(input_file_order = input_file_order):
+                self.assertEqual(sorted(handled_file_names), sorted(os.path.join(data_folder, fn) for fn in os.listdir(data_folder)))
+                if input_file_order == "inode":
+                    self.assertEqual(handled_file_names, sorted(handled_file_names, key=lambda fn: os.stat(fn).st_ino))
+                # Hash file is sorted by names in spite of the order of reading
+                with open(f"{self.work_path}/hash_storage_{input_file_order}.sha1", "r") as f:
+                    hash_file_contents.append(f.read())
+        self.assertEqual(hash_file_contents[1:], hash_file_contents[:1] * 2)
+
+        cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/hash_storage --input-file-order size"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+
+    def test_throughput_history_file(self):
+        data_folder = f"{self.work_path}/data"
+        os.mkdir(data_folder)
+        for i in range(1, 4):
+            shutil.copyfile(f'{self.data_path}/file{i}.txt', f'{data_folder}/file{i}.txt')
+        history_file_name = f"{self.work_path}/throughput.json"
+        cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/hash_storage --suppress-console-reporting-output " \
+             f"--throughput-history-file {history_file_name}"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        with open(history_file_name, "r", encoding="utf-8") as f:
+            devices = json.load(f)["devices"]
+        self.assertEqual(list(devices), [str(os.stat(data_folder).st_dev)])
+        self.assertIn("per_file_overhead", devices[str(os.stat(data_folder).st_dev)])
+
+        # History is loaded on the next run
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl + " --force-calc-hash"), cmd_line.ExitCode.OK)
+
+        # Time of the file with read error is not accounted
+        class FailingCommandLineAdapter(cmd_line.CommandLineAdapter):
+            def _create_file_hash_calc(self):
+                calc = super()._create_file_hash_calc()
+                def open_file():
+                    raise OSError(5, "Input/output error", calc.file_name)
+                calc._open_file = open_file
+                return calc
+        with open(history_file_name, "r", encoding="utf-8") as f:
+            devices = json.load(f)["devices"]
+        cl += " --force-calc-hash --small-file-threshold 0 --retry-count-on-data-read-error 1 --retry-pause-on-data-read-error 1"
+        self.assertEqual(FailingCommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.DATA_READ_ERROR)
+        with open(history_file_name, "r", encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["devices"], devices)
+
+    def test_dir_masks(self):
+        data_folder = f"{self.work_path}/data"
+        for rel_file_name in ["root.txt", "root.log", "src/a.txt", "src/lib/b.txt", "src/node_modules/c.txt", "docs/d.TXT",
+                              ".git/objects/e.txt", "node_modules/x/f.txt", "other/g.txt"]:
+            file_name = os.path.join(data_folder, rel_file_name)
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            with open(file_name, "w") as f:
+                f.write(rel_file_name)
+
+        for masks, expected_file_names in [
+                ("--input-folder-dir-mask-exclude .git;node_modules", ["docs/d.TXT", "other/g.txt", "root.log", "root.txt", "src/a.txt", "src/lib/b.txt"]),
+                ("--input-folder-dir-mask-include src;doc? --input-folder-dir-mask-exclude node_modules --input-folder-file-mask-exclude *.log",
+                 ["docs/d.TXT", "root.txt", "src/a.txt", "src/lib/b.txt"]),
+                ("--input-folder-dir-mask-include lib --input-folder-file-mask-include *.txt;*.log", ["root.log", "root.txt"])]:
+            with self.subTest(masks = masks):
+                hash_file_name = f"{self.work_path}/hash_storage.sha1"
+                if os.path.exists(hash_file_name):
+                    os.remove(hash_file_name)
+                cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/hash_storage --suppress-console-reporting-output " \
+                     f"--suppress-output-file-comments {masks}"
+                self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+                with open(hash_file_name, "r") as f:
+                    file_names = sorted(line.rstrip("\n").split(" *")[1] for line in f)
+                self.assertEqual(file_names, [os.path.join("data", os.path.normpath(fn)) for fn in expected_file_names])
+
+    def test_input_file_list(self):
+        data_folder = f"{self.work_path}/data"
+        os.mkdir(data_folder)
+        file_names = []
+        for i in range(1, 4):
+            file_names.append(os.path.join(data_folder, f"file {i}.txt"))
+            shutil.copyfile(f'{self.data_path}/file{i}.txt', file_names[-1])
+        hash_file_name = f"{self.work_path}/hash_storage.sha1"
+        cl = f"--single-hash-file-name-base {self.work_path}/hash_storage --suppress-console-reporting-output --suppress-output-file-comments"
+
+        def read_hash_file_names():
+            with open(hash_file_name, "r") as f:
+                return sorted(os.path.basename(line.rstrip("\n").split(" *")[1]) for line in f)
+
+        # Null separated list with file name containing new line, the list is read from standard input. Such name can be stored in JSON only
+        file_names.append(os.path.join(data_folder, "new\nline.txt"))
+        shutil.copyfile(f'{self.data_path}/file4.txt', file_names[-1])
+        stdin = sys.stdin
+        sys.stdin = io.TextIOWrapper(io.BytesIO(b"\0".join(os.fsencode(fn) for fn in file_names[2:]) + b"\0"))
+        try:
+            cl_json = f"--single-hash-file-name-base-json {self.work_path}/hash_storage --suppress-console-reporting-output " \
+                      f"--input-file-list - --input-file-list-null --input-file '{file_names[0]}'"
+            self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl_json), cmd_line.ExitCode.OK)
+        finally:
+            sys.stdin = stdin
+        with open(f"{hash_file_name}.json", "r", encoding="utf-8") as f:
+            self.assertEqual(sorted(os.path.basename(record["file_name"]) for record in json.load(f)["data"]), ["file 1.txt", "file 3.txt", "new\nline.txt"])
+        os.remove(file_names.pop())
+
+        list_file_name = f"{self.work_path}/list.txt"
+        with open(list_file_name, "w") as f:
+            f.write("\n".join(file_names + [file_names[0], os.path.join(data_folder, "missing.txt")]) + "\n")
+        # Small file threshold 0 checks the regular path, otherwise the last batch is saved after the end of the list
+        for small_file_threshold in [0, 1024 * 1024]:
+            exit_code = cmd_line.CommandLineAdapter().run_cmd_line(cl + f" --input-file-list {list_file_name} --small-file-threshold {small_file_threshold}")
+            self.assertEqual(exit_code, cmd_line.ExitCode.DATA_READ_ERROR)
+            self.assertEqual(read_hash_file_names(), ["file 1.txt", "file 2.txt", "file 3.txt"])
+            os.remove(hash_file_name)
+
+        cl = f"--input-file-list {self.work_path}/missing_list.txt --single-hash-file-name-base {self.work_path}/hash_storage"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.APP_USAGE_ERROR)
+        cl = f"--input-file '{file_names[0]}' --input-file-list-null"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+
+    def test_copy_to(self):
+        data_folder = f"{self.work_path}/data"
+        os.makedirs(f"{data_folder}/sub")
+        shutil.copyfile(f'{self.data_path}/file1.txt', f'{data_folder}/file1.txt')
+        shutil.copyfile(f'{self.data_path}/file2.txt', f'{data_folder}/sub/file2.txt')
+        copy_folder = f"{self.work_path}/copy"
+        hash_file_name = f"{copy_folder}/hashes.sha1"
+        cl = f"--input-folder {data_folder} --input-file {self.data_path}/file3.txt --copy-to {copy_folder} --single-hash-file-name-base {copy_folder}/hashes " \
+             "--suppress-console-reporting-output --suppress-output-file-comments"
+        for copy_verify in [False, True]:
+            with self.subTest(copy_verify = copy_verify):
+                shutil.rmtree(copy_folder, ignore_errors=True)
+                exit_code = cmd_line.CommandLineAdapter().run_cmd_line(cl + (" --copy-verify" if copy_verify else ""))
+                self.assertEqual(exit_code, cmd_line.ExitCode.OK)
+                expected_hashes = {}
+                for source_file_name, copy_file_name in [(f"{data_folder}/file1.txt", "file1.txt"), (f"{data_folder}/sub/file2.txt", os.path.join("sub", "file2.txt")),
+                                                         (f"{self.data_path}/file3.txt", "file3.txt")]:
+                    self.assertTrue(filecmp.cmp(source_file_name, os.path.join(copy_folder, copy_file_name), shallow=False))
+                    with open(source_file_name, "rb") as f:
+                        expected_hashes[copy_file_name] = hashlib.sha1(f.read()).hexdigest()
+                with open(hash_file_name, "r") as f:
+                    self.assertEqual({file_name.rstrip("\n"): hash_value for hash_value, file_name in (line.split(" *") for line in f)}, expected_hashes)
+
+        # Copies with hashes are skipped, removed copy is made again
+        copy_mtime = os.stat(f"{copy_folder}/file1.txt").st_mtime_ns
+        os.remove(f"{copy_folder}/sub/file2.txt")
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        self.assertEqual(os.stat(f"{copy_folder}/file1.txt").st_mtime_ns, copy_mtime)
+        self.assertTrue(filecmp.cmp(f"{data_folder}/sub/file2.txt", f"{copy_folder}/sub/file2.txt", shallow=False))
+
+        # Input files with equal names have the same destination, the second one is not copied
+        os.makedirs(f"{self.work_path}/other")
+        shutil.copyfile(f'{self.data_path}/file2.txt', f'{self.work_path}/other/file1.txt')
+        for _ in range(2):
+            cl = f"--input-file {data_folder}/file1.txt --input-file {self.work_path}/other/file1.txt --copy-to {self.work_path}/copy2 " \
+                 f"--single-hash-file-name-base {self.work_path}/copy2/hashes --suppress-console-reporting-output --suppress-output-file-comments"
+            self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.DATA_READ_ERROR)
+            self.assertTrue(filecmp.cmp(f"{data_folder}/file1.txt", f"{self.work_path}/copy2/file1.txt", shallow=False))
+
+        cl = f"--input-folder {self.work_path} --copy-to {copy_folder} --single-hash-file-name-base {self.work_path}/hashes"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+        cl = f"--input-folder {data_folder} --copy-verify"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+
+    def test_hash_archive_members(self):
+        data_folder = f"{self.work_path}/data"
+        os.mkdir(data_folder)
+        members = {}
+        for i in range(1, 4):
+            with open(f'{self.data_path}/file{i}.txt', "rb") as f:
+                members[f"folder/file{i}.txt" if i > 1 else f"file{i}.txt"] = f.read()
+        with tarfile.open(f"{data_folder}/archive.tar.gz", "w:gz") as tar:
+            for member_name, data in members.items():
+                tar_info = tarfile.TarInfo(member_name)
+                tar_info.size = len(data)
+                tar.addfile(tar_info, io.BytesIO(data))
+        with zipfile.ZipFile(f"{data_folder}/archive.zip", "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr("empty_folder/", b"")
+            for member_name, data in members.items():
+                zip_file.writestr(member_name, data)
+            zip_file.writestr("../outside.txt", b"outside")
+        shutil.copyfile(f'{self.data_path}/file4.txt', f'{data_folder}/file4.txt')
+
+        hash_file_name = f"{self.work_path}/hash_storage.sha1"
+        cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/hash_storage --hash-archive-members " \
+             "--suppress-console-reporting-output --suppress-output-file-comments"
+        # Member with unsafe name is skipped
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.DATA_READ_ERROR)
+        expected_hashes = {os.path.join("data", "file4.txt"): None}
+        for archive_name in ["archive.tar.gz", "archive.zip"]:
+            for member_name, data in members.items():
+                expected_hashes[os.path.join("data", archive_name + "!", os.path.normpath(member_name))] = hashlib.sha1(data).hexdigest()
+        with open(f'{data_folder}/file4.txt', "rb") as f:
+            expected_hashes[os.path.join("data", "file4.txt")] = hashlib.sha1(f.read()).hexdigest()
+        with open(hash_file_name, "r") as f:
+            self.assertEqual({file_name.rstrip("\n"): hash_value for hash_value, file_name in (line.split(" *") for line in f)}, expected_hashes)
+
+        # Damaged archive
+        with open(f"{data_folder}/archive.tar.gz", "r+b") as f:
+            f.seek(30)
+            f.write(b"damaged" * 10)
+        os.remove(f"{data_folder}/archive.zip")
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.DATA_READ_ERROR)
+
+        # Member with unsupported compression method, it is 99 (AES encryption) in central directory record
+        os.remove(f"{data_folder}/archive.tar.gz")
+        with zipfile.ZipFile(f"{data_folder}/archive.zip", "w") as zip_file:
+            zip_file.writestr("file.txt", b"data")
+        with open(f"{data_folder}/archive.zip", "r+b") as f:
+            data = f.read()
+            f.seek(data.index(b"PK\x01\x02") + 10)
+            f.write((99).to_bytes(2, "little"))
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.DATA_READ_ERROR)
+
+        cl = f"--input-folder {data_folder} --per-directory-hash-file-name-base hashes --hash-archive-members"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+
+    def test_dedup_analysis(self):
+        data_folder = f"{self.work_path}/data"
+        os.mkdir(data_folder)
+        data = os.urandom(100 * 1024)
+        for i, file_data in enumerate([data, data, data[:50 * 1024] + b"modified" + data[50 * 1024:]]):
+            with open(f"{data_folder}/file{i}.bin", "wb") as f:
+                f.write(file_data)
+        cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/hash_storage --dedup-analysis --dedup-analysis-chunk-size 1024 " \
+             "--force-calc-hash --suppress-console-reporting-output"
+        # Files are read with --force-calc-hash even if their hashes exist
+        for _ in range(2):
+            adapter = cmd_line.CommandLineAdapter()
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(adapter.run_cmd_line(cl), cmd_line.ExitCode.OK)
+            self.assertIn("Deduplication analysis", output.getvalue())
+            chunk_index = adapter._chunk_index
+            self.assertEqual(chunk_index.total_size, 3 * len(data) + len(b"modified"))
+            # Only a few chunks around modification are unique in the third file
+            self.assertLess(chunk_index.unique_size, len(data) + 20 * 1024)
+
+        cl = f"--input-folder {data_folder} --dedup-analysis --dedup-analysis-chunk-size 1000 --force-calc-hash"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+        cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/hash_storage --dedup-analysis"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+
+    def test_watch_mode(self):
+        data_folder = f"{self.work_path}/data"
+        hash_file_name = f"{self.work_path}/hash_storage.sha1"
+
+        def read_hashes():
+            if not os.path.isfile(hash_file_name):
+                return None
+            with open(hash_file_name, "r", encoding="utf-8") as f:
+                return dict(reversed(line.rstrip("\n").split(" *", 1)) for line in f if line.strip())
+
+        def wait_hashes(expected_hashes):
+            for _ in range(200):
+                if read_hashes() == expected_hashes:
+                    return True
+                time.sleep(0.05)
+            return False
+
+        modifications_ok = []
+        def modify_files():
+            try:
+                if not wait_hashes({"data/file1.txt": file1_hash, "data/file2.txt": file2_hash}):
+                    return
+                with open(f"{data_folder}/file1.txt", "ab") as f:
+                    f.write(b"appended")
+                with open(f"{data_folder}/sub/file3.txt", "wb") as f:
+                    f.write(b"new file")
+                os.remove(f"{data_folder}/file2.txt")
+                modifications_ok.append(wait_hashes({
+                    "data/file1.txt": hashlib.sha1(file1_data + b"appended").hexdigest(),
+                    "data/sub/file3.txt": hashlib.sha1(b"new file").hexdigest()}))
+            finally:
+                util.request_program_interruption()
+
+        for use_polling in [False, True]:
+            if not use_polling and not watcher.InotifyWatcher.is_supported():
+                continue
+            tests.util_test.clean_work_dir()
+            os.makedirs(f"{data_folder}/sub")
+            for i in range(1, 3):
+                shutil.copyfile(f'{self.data_path}/file{i}.txt', f'{data_folder}/file{i}.txt')
+            with open(f"{data_folder}/file1.txt", "rb") as f:
+                file1_data = f.read()
+            file1_hash = hashlib.sha1(file1_data).hexdigest()
+            with open(f"{data_folder}/file2.txt", "rb") as f:
+                file2_hash = hashlib.sha1(f.read()).hexdigest()
+
+            cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/hash_storage --suppress-console-reporting-output " \
+                 f"--suppress-output-file-comments --autosave-timeout 0 --watch --watch-debounce 0.1 --watch-polling-interval 0.2"
+            if use_polling:
+                cl += " --watch-use-polling"
+
+            modifications_ok.clear()
+            modify_thread = threading.Thread(target=modify_files)
+            modify_thread.start()
+            cmd_line_adapter = cmd_line.CommandLineAdapter()
+            exit_code = cmd_line_adapter.run_cmd_line(cl)
+            modify_thread.join()
+
+            self.assertEqual(exit_code, cmd_line.ExitCode.OK)
+            self.assertEqual(modifications_ok, [True], f"use_polling = {use_polling}")
+
+    def test_profile_report(self):
+        shutil.copyfile(f'{self.data_path}/file1.txt', f'{self.work_path}/file1.txt')
+        cprofile_file_name = f"{self.work_path}/profile.out"
+
+        # Threshold 0 disables fast path, so all phases of regular path are measured
+        cmd_line_adapter = cmd_line.CommandLineAdapter()
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            exit_code = cmd_line_adapter.run_cmd_line(f'--input-file {self.work_path}/file1.txt --single-hash-file-name-base {self.work_path}/hash_storage '
+                                                      f'--small-file-threshold 0 --profile --profile-cprofile-file {cprofile_file_name} --suppress-console-reporting-output')
+        self.assertEqual(exit_code, cmd_line.ExitCode.OK)
+
+        report_phases = {line.split()[0] for line in stderr.getvalue().splitlines()[2:-1]}
+        self.assertTrue({"enumeration", "read", "hash", "storage_set_hash", "storage_save"} <= report_phases, f"Phases are missed in profile report: {report_phases}")
+
+        # Check that the dump is valid
+        pstats.Stats(cprofile_file_name)
+
     #@unittest.skip("This is sandbox, actually not unit test")
     def _test_sandbox(self):
         # Ref: https://docs.python.org/3/library/tracemalloc.html
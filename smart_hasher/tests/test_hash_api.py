@@ -0,0 +1,96 @@
+import unittest
+import os
+import hashlib
+import tests.util_test
+import hash_api
+import hash_storages
+import util
+
+class HashApiTestCase(unittest.TestCase):
+
+    def  setUp(self):
+        self.work_path = tests.util_test.get_work_path()
+        tests.util_test.clean_work_dir()
+
+        self.file_data = {}
+        for i in range(20):
+            file_name = os.path.join(self.work_path, f"file{i:02d}.bin")
+            data = os.urandom(i * 10000)
+            with open(file_name, "wb") as f:
+                f.write(data)
+            self.file_data[file_name] = data
+
+    def  tearDown(self):
+        tests.util_test.clean_work_dir()
+
+    def check_hashed(self, results, hash_algos):
+        self.assertEqual(sorted(res.file_name for res in results), sorted(self.file_data))
+        for res in results:
+            self.assertEqual(res.status, hash_api.HashResult.Status.HASHED)
+            self.assertEqual(res.size, len(self.file_data[res.file_name]))
+            self.assertEqual(res.bytes_read, res.size)
+            self.assertEqual(res.hashes, {hash_algo: hashlib.new(hash_algo, self.file_data[res.file_name]).hexdigest() for hash_algo in hash_algos})
+
+    def test_hash_files(self):
+        for jobs in [1, 4]:
+            for hash_algos in [["sha1"], ["md5", "sha256"]]:
+                options = hash_api.HashFilesOptions()
+                options.small_file_threshold = 50000 # Both fast and regular paths are used
+                results = list(hash_api.hash_files(iter(self.file_data), hash_algos, jobs=jobs, options=options))
+                self.check_hashed(results, hash_algos)
+
+    def test_hash_files_storage(self):
+        hash_file_name = os.path.join(self.work_path, "hashes")
+        storage = hash_storages.SingleFileHashesStorage()
+        storage.single_hash_file_name_base = hash_file_name
+        storage.hash_file_name_postfix = ".sha256"
+        storage.suppress_hash_file_comments = True
+        with storage:
+            results = list(hash_api.hash_files(self.file_data, ["sha256", "md5"], storage=storage, jobs=3))
+        self.check_hashed(results, ["sha256", "md5"])
+        self.assertTrue(os.path.isfile(hash_file_name + ".sha256"))
+
+        with storage:
+            results = list(hash_api.hash_files(self.file_data, ["sha256"], storage=storage, jobs=3))
+            self.assertEqual([res.status for res in results], [hash_api.HashResult.Status.SKIPPED_ALREADY_CALCULATED] * len(self.file_data))
+            for file_name, data in self.file_data.items():
+                self.assertEqual(storage.hash_data[os.path.abspath(file_name)][0],hashlib.sha256(data).hexdigest())
+
+    def test_hash_files_errors(self):
+        options = hash_api.HashFilesOptions()
+        options.retry_count_on_data_read_error = 2
+        options.retry_pause_on_data_read_error = 0
+        missing_file_name = os.path.join(self.work_path, "missing.bin")
+        results = list(hash_api.hash_files([missing_file_name], options=options))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].status, hash_api.HashResult.Status.DATA_READ_ERROR)
+        self.assertEqual(results[0].hashes, {})
+        self.assertIsNotNone(results[0].error)
+
+        with self.assertRaises(ValueError):
+            list(hash_api.hash_files(self.file_data, ["no-such-algo"]))
+        with self.assertRaises(ValueError):
+            list(hash_api.hash_files(self.file_data, jobs=0))
+
+    def test_hash_files_interrupted(self):
+        util.request_program_interruption()
+        try:
+            options = hash_api.HashFilesOptions()
+            options.small_file_threshold = 0
+            results = list(hash_api.hash_files(sorted(self.file_data)[1:], jobs=2, options=options))
+        finally:
+            util.program_interrupted = False
+        self.assertGreater(len(results), 0)
+        self.assertLess(len(results), len(self.file_data) - 1)
+        self.assertEqual(results[-1].status, hash_api.HashResult.Status.PROGRAM_INTERRUPTED_BY_USER)
+
+        # Interruption requested during iteration doesn't affect the next call
+        for jobs in [1, 2]:
+            with self.subTest(jobs = jobs):
+                for res in hash_api.hash_files(sorted(self.file_data), jobs=jobs, options=options):
+                    util.request_program_interruption()
+                results = list(hash_api.hash_files(sorted(self.file_data), jobs=jobs, options=options))
+                self.assertEqual([res.status for res in results], [hash_api.HashResult.Status.HASHED] * len(self.file_data))
+
+if __name__ == '__main__':
+    unittest.main()
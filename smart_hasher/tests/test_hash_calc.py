@@ -0,0 +1,153 @@
+import unittest
+import os
+import hashlib
+import tests.util_test
+import hash_calc
+import chunking
+
+class FailingFile(object):
+    """
+    File object which raises OSError when `fail_offset` is reached
+    """
+
+    def __init__(self, f, fail_offset):
+        self.f = f
+        self.fail_offset = fail_offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.f.close()
+        return False
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def seek(self, offset):
+        self.f.seek(offset)
+
+    def read(self, size):
+        if self.fail_offset is not None and self.f.tell() + size > self.fail_offset:
+            raise OSError(5, "Input/output error", self.f.name)
+        return self.f.read(size)
+
+class FailingFileHashCalc(hash_calc.FileHashCalc):
+    """
+    Calculator which file fails on reading at the specified offsets, one offset per try
+    """
+
+    def __init__(self, fail_offsets):
+        super().__init__()
+        self.fail_offsets = list(fail_offsets)
+
+    def _open_file(self):
+        f = super()._open_file()
+        return FailingFile(f, self.fail_offsets.pop(0) if self.fail_offsets else None)
+
+class FileHashCalcTestCase(unittest.TestCase):
+
+    def  setUp(self):
+        self.work_path = tests.util_test.get_work_path()
+        tests.util_test.clean_work_dir()
+        self.file_name = os.path.join(self.work_path, "data.bin")
+        self.data = os.urandom(1000 * 1024)
+        with open(self.file_name, "wb") as f:
+            f.write(self.data)
+
+    def  tearDown(self):
+        tests.util_test.clean_work_dir()
+
+    def create_calc(self, fail_offsets):
+        calc = FailingFileHashCalc(fail_offsets)
+        calc.file_name = self.file_name
+        calc.hash_strs = ("sha1", "md5")
+        calc.suppress_console_reporting_output = True
+        calc.retry_pause_on_data_read_error = 0
+        calc.file_chunk_size = 10 * 1024
+        calc.checkpoint_interval = 100 * 1024
+        return calc
+
+    def test_resume_from_checkpoint(self):
+        calc = self.create_calc([550 * 1024, 930 * 1024])
+        self.assertEqual(calc.run(), hash_calc.FileHashCalc.ReturnCode.OK)
+        self.assertEqual(calc.results, {"sha1": hashlib.sha1(self.data).hexdigest(), "md5": hashlib.md5(self.data).hexdigest()})
+        self.assertEqual(calc.retry_count, 2)
+        # Second try resumes from 500 KiB, third one from 900 KiB
+        self.assertEqual(calc.resumed_size, 1400 * 1024)
+        self.assertEqual(calc.bytes_read, 550 * 1024 + 430 * 1024 + 100 * 1024)
+
+        # File is changed after error, so it is read from the start
+        calc = self.create_calc([550 * 1024])
+        original_open_file = calc._open_file
+        def open_file_and_change():
+            if not calc.fail_offsets:
+                with open(self.file_name, "ab") as f:
+                    f.write(b"appended")
+            return original_open_file()
+        calc._open_file = open_file_and_change
+        self.assertEqual(calc.run(), hash_calc.FileHashCalc.ReturnCode.OK)
+        self.assertEqual(calc.result, hashlib.sha1(self.data + b"appended").hexdigest())
+        self.assertEqual(calc.resumed_size, 0)
+
+        calc = self.create_calc([100] * 3)
+        calc.retry_count_on_data_read_error = 3
+        self.assertEqual(calc.run(), hash_calc.FileHashCalc.ReturnCode.DATA_READ_ERROR)
+
+    def test_copy(self):
+        copy_file_name = os.path.join(self.work_path, "copy.bin")
+        with open(copy_file_name, "wb") as f:
+            f.write(b"old data")
+        # Copy is resumed from the checkpoint on retry also
+        calc = self.create_calc([550 * 1024])
+        calc.copy_to_file_name = copy_file_name
+        self.assertEqual(calc.run(), hash_calc.FileHashCalc.ReturnCode.OK)
+        self.assertEqual(calc.result, hashlib.sha1(self.data).hexdigest())
+        self.assertEqual(calc.resumed_size, 500 * 1024)
+        with open(copy_file_name, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(os.stat(copy_file_name).st_mtime_ns, os.stat(self.file_name).st_mtime_ns)
+
+        # Copy is not changed if the hash can't be calculated, temporary file is removed
+        calc = self.create_calc([100] * 2)
+        calc.retry_count_on_data_read_error = 2
+        calc.copy_to_file_name = copy_file_name
+        with open(self.file_name, "ab") as f:
+            f.write(b"appended")
+        self.assertEqual(calc.run(), hash_calc.FileHashCalc.ReturnCode.DATA_READ_ERROR)
+        with open(copy_file_name, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(sorted(os.listdir(self.work_path)), ["copy.bin", "data.bin"])
+
+    def test_chunking(self):
+        # Chunks read again after error are not counted twice
+        chunk_indexes = []
+        for fail_offsets in [[], [550 * 1024, 930 * 1024]]:
+            calc = self.create_calc(fail_offsets)
+            calc.chunk_index = chunking.ChunkIndex()
+            calc.chunk_average_size = 4096
+            self.assertEqual(calc.run(), hash_calc.FileHashCalc.ReturnCode.OK)
+            chunk_indexes.append(calc.chunk_index)
+        self.assertEqual(chunk_indexes[0].total_size, len(self.data))
+        self.assertEqual(chunk_indexes[0].unique_size, len(self.data))
+        self.assertEqual(vars(chunk_indexes[1]), vars(chunk_indexes[0]))
+
+        # Chunks of the file which can't be read are not counted, also the ones before checkpoints
+        calc = self.create_calc([550 * 1024] * (calc.retry_count_on_data_read_error + 1))
+        calc.chunk_index = chunking.ChunkIndex()
+        calc.chunk_average_size = 4096
+        self.assertEqual(calc.run(), hash_calc.FileHashCalc.ReturnCode.DATA_READ_ERROR)
+        self.assertEqual((calc.chunk_index.total_count, calc.chunk_index.total_size), (0, 0))
+
+        # The same data is deduplicated in all paths of reading
+        calc = self.create_calc([])
+        calc.chunk_index = chunk_indexes[0]
+        calc.chunk_average_size = 4096
+        self.assertEqual(calc.run_small_file(), hash_calc.FileHashCalc.ReturnCode.OK)
+        with open(self.file_name, "rb") as f:
+            self.assertEqual(calc.run_stream(f), hash_calc.FileHashCalc.ReturnCode.OK)
+        self.assertEqual(chunk_indexes[0].total_size, 3 * len(self.data))
+        self.assertEqual(chunk_indexes[0].unique_size, len(self.data))
+
+if __name__ == '__main__':
+    unittest.main()
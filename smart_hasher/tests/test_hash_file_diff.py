@@ -0,0 +1,112 @@
+import unittest
+import os
+import shutil
+import hashlib
+import io
+import contextlib
+import tests.util_test
+import cmd_line
+import hash_file_diff
+import util
+
+class HashFilesComparisonTestCase(unittest.TestCase):
+
+    def  setUp(self):
+        self.data_path = tests.util_test.get_data_path()
+        self.work_path = tests.util_test.get_work_path()
+        tests.util_test.clean_work_dir()
+
+    def  tearDown(self):
+        tests.util_test.clean_work_dir()
+
+    def get_file_hash(self, file_name):
+        with open(file_name, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def test_compare(self):
+        data_folder = os.path.join(self.work_path, "data")
+        os.mkdir(data_folder)
+        for i in range(1, 4):
+            shutil.copyfile(os.path.join(self.data_path, f"file{i}.txt"), os.path.join(data_folder, f"file{i}.txt"))
+        with open(os.path.join(data_folder, "unchanged.txt"), "w") as f:
+            f.write("unchanged")
+
+        storage_keys = {"text": ("--single-hash-file-name-base", ".sha1"), "json": ("--single-hash-file-name-base-json", ".sha1.json"),
+                        "binary": ("--single-hash-file-name-base-binary", ".sha1.shcat")}
+        for name, (storage_key, postfix) in storage_keys.items():
+            cl = f"--input-folder {data_folder} {storage_key} {self.work_path}/old_{name} --suppress-console-reporting-output"
+            self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+
+        file1_hash = self.get_file_hash(os.path.join(data_folder, "file1.txt"))
+        file2_old_hash = self.get_file_hash(os.path.join(data_folder, "file2.txt"))
+        file3_hash = self.get_file_hash(os.path.join(data_folder, "file3.txt"))
+        os.rename(os.path.join(data_folder, "file1.txt"), os.path.join(data_folder, "renamed1.txt"))
+        with open(os.path.join(data_folder, "file2.txt"), "a") as f:
+            f.write("modified")
+        file2_new_hash = self.get_file_hash(os.path.join(data_folder, "file2.txt"))
+        os.remove(os.path.join(data_folder, "file3.txt"))
+        shutil.copyfile(os.path.join(self.data_path, "file4.txt"), os.path.join(data_folder, "file4.txt"))
+        file4_hash = self.get_file_hash(os.path.join(data_folder, "file4.txt"))
+
+        expected = [f"modified {file2_old_hash} -> {file2_new_hash} *{os.path.join('data', 'file2.txt')}",
+                    f"removed {file3_hash} *{os.path.join('data', 'file3.txt')}",
+                    f"added {file4_hash} *{os.path.join('data', 'file4.txt')}",
+                    f"renamed {file1_hash} *{os.path.join('data', 'file1.txt')} -> *{os.path.join('data', 'renamed1.txt')}"]
+        for name, (storage_key, postfix) in storage_keys.items():
+            cl = f"--input-folder {data_folder} {storage_key} {self.work_path}/new_{name} --suppress-console-reporting-output"
+            self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+
+            comparison = hash_file_diff.HashFilesComparison(os.path.join(self.work_path, f"old_{name}{postfix}"), os.path.join(self.work_path, f"new_{name}{postfix}"))
+            diff_records = [str(record) for record in comparison.iter_differences()]
+            self.assertEqual(diff_records, expected, name)
+            self.assertEqual(comparison.counts[hash_file_diff.DiffStatus.UNCHANGED], 1)
+
+        # Without detection of renames all records are reported during merge in order of file names
+        expected_no_renames = [f"removed {file1_hash} *{os.path.join('data', 'file1.txt')}", expected[0], expected[1], expected[2],
+                               f"added {file1_hash} *{os.path.join('data', 'renamed1.txt')}"]
+        comparison = hash_file_diff.HashFilesComparison(os.path.join(self.work_path, "old_text.sha1"), os.path.join(self.work_path, "new_text.sha1"))
+        comparison.detect_renames = False
+        self.assertEqual([str(record) for record in comparison.iter_differences()], expected_no_renames)
+        cl = f"--compare-hash-files {self.work_path}/old_text.sha1 {self.work_path}/new_text.sha1 --compare-no-rename-detection --suppress-console-reporting-output"
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        self.assertEqual(output.getvalue().splitlines()[:len(expected_no_renames)], expected_no_renames)
+        cl = f"--input-folder {data_folder} --compare-no-rename-detection"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+
+        # Text and JSON hash files are compared with each other
+        comparison = hash_file_diff.HashFilesComparison(os.path.join(self.work_path, "old_text.sha1"), os.path.join(self.work_path, "new_json.sha1.json"))
+        self.assertEqual([str(record) for record in comparison.iter_differences()], expected)
+
+        cl = f"--compare-hash-files {self.work_path}/old_text.sha1 {self.work_path}/new_json.sha1.json --suppress-console-reporting-output"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        cl = f"--compare-hash-files {self.work_path}/old_text.sha1 {self.work_path}/new_binary.sha1.shcat"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.APP_USAGE_ERROR)
+
+        # Hash file sorted by hash values can't be compared
+        cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/by_hash --sort-by-hash-value --suppress-console-reporting-output"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        comparison = hash_file_diff.HashFilesComparison(os.path.join(self.work_path, "old_text.sha1"), os.path.join(self.work_path, "by_hash.sha1"))
+        with self.assertRaises(util.AppUsageError):
+            list(comparison.iter_differences())
+
+    def test_iter_json_hash_file(self):
+        json_file_name = os.path.join(self.work_path, "hashes.json")
+        with open(json_file_name, "w", encoding="utf-8") as f:
+            f.write('{"_comment": ["data", {"nested": [1, 2]}], "data": [{"file_name": "a.txt", "hash": "AB"},\n {"hash": "cd", "file_name": "b.txt"}], "extra": 12345}')
+        # Small chunks check decoding of values cut at the end of the buffer
+        chunk_size = hash_file_diff._JsonStreamReader.chunk_size
+        hash_file_diff._JsonStreamReader.chunk_size = 7
+        try:
+            self.assertEqual(list(hash_file_diff.iter_json_hash_file(json_file_name)), [("a.txt", "ab"), ("b.txt", "cd")])
+        finally:
+            hash_file_diff._JsonStreamReader.chunk_size = chunk_size
+
+        with open(json_file_name, "w", encoding="utf-8") as f:
+            f.write('{"data": [{"file_name": "a.txt", "hash": "ab"} {"file_name": "b.txt"}]}')
+        with self.assertRaises(util.AppUsageError):
+            list(hash_file_diff.iter_json_hash_file(json_file_name))
+
+if __name__ == '__main__':
+    unittest.main()
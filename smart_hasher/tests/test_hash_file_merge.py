@@ -0,0 +1,75 @@
+import unittest
+import os
+import shutil
+import json
+import tests.util_test
+import cmd_line
+import hash_file_diff
+
+class HashFilesMergeTestCase(unittest.TestCase):
+
+    def  setUp(self):
+        self.data_path = tests.util_test.get_data_path()
+        self.work_path = tests.util_test.get_work_path()
+        tests.util_test.clean_work_dir()
+
+    def  tearDown(self):
+        tests.util_test.clean_work_dir()
+
+    def test_shard_and_merge(self):
+        data_folder = os.path.join(self.work_path, "data")
+        os.makedirs(os.path.join(data_folder, "sub"))
+        for i in range(1, 5):
+            shutil.copyfile(os.path.join(self.data_path, f"file{i}.txt"), os.path.join(data_folder, f"file{i}.txt"))
+            shutil.copyfile(os.path.join(self.data_path, f"file{i}.txt"), os.path.join(data_folder, "sub", f"file{i}.txt"))
+
+        cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/all --suppress-console-reporting-output"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        all_records = list(hash_file_diff.iter_text_hash_file(os.path.join(self.work_path, "all.sha1")))
+        self.assertEqual(len(all_records), 8)
+
+        # Shards are disjoint and cover all files
+        shard_records = []
+        for shard_index in range(1, 4):
+            cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/shard{shard_index} --shard {shard_index}/3 " \
+                 "--suppress-console-reporting-output"
+            self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+            shard_records += hash_file_diff.iter_text_hash_file(os.path.join(self.work_path, f"shard{shard_index}.sha1"))
+        self.assertEqual(sorted(shard_records), sorted(all_records))
+
+        shard_file_names = " ".join(f"{self.work_path}/shard{shard_index}.sha1" for shard_index in range(1, 4))
+        # The same file in several hash files is merged into one record
+        cl = f"--merge-hash-files {self.work_path}/merged.sha1 {shard_file_names} {self.work_path}/shard1.sha1 --suppress-console-reporting-output"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        self.assertEqual(list(hash_file_diff.iter_text_hash_file(os.path.join(self.work_path, "merged.sha1"))), all_records)
+
+        cl = f"--merge-hash-files {self.work_path}/merged.json {shard_file_names} --suppress-console-reporting-output"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        with open(os.path.join(self.work_path, "merged.json"), encoding="utf-8") as f:
+            json_data = json.load(f)
+        self.assertEqual([(record["file_name"], record["hash"]) for record in json_data["data"]], all_records)
+
+        # Merged hash file is loaded by storage
+        cl = f"--input-folder {data_folder} --single-hash-file-name-base-json {self.work_path}/merged --suppress-console-reporting-output"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+
+        # Different hashes of the same file can't be merged
+        with open(os.path.join(self.work_path, "conflict.sha1"), "w") as f:
+            f.write(f"0123 *{all_records[0][0]}\n")
+        cl = f"--merge-hash-files {self.work_path}/merged.sha1 {self.work_path}/all.sha1 {self.work_path}/conflict.sha1"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.APP_USAGE_ERROR)
+
+        # Relative file names of hash file in other folder can't be merged
+        os.mkdir(os.path.join(self.work_path, "merged"))
+        cl = f"--merge-hash-files {self.work_path}/merged/merged.sha1 {self.work_path}/all.sha1"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.APP_USAGE_ERROR)
+
+        cl = f"--merge-hash-files {self.work_path}/merged.sha1"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+        cl = f"--input-folder {data_folder} --shard 4/3"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+        cl = f"--input-folder {data_folder} --single-hash-file-name-base {self.work_path}/shard1 --shard 1/3 --folder-hashes"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,8 @@ import tests.util_test
 import hash_storages
 import filecmp
 import cmd_line
+import hashlib
+import time
 
 class SingleFileHashesStorageTestCase(unittest.TestCase):
 
@@ -206,6 +208,131 @@ class SingleFileHashesStorageTestCase(unittest.TestCase):
 
             self.assertTrue(tests.util_test.json_files_equal(work_hash_storage_file, data_hash_storage_file_excepted), f"Wrong output in '{work_hash_storage_file}'")
 
+    def test_compressed_hash_storages(self):
+        data_folder = os.path.join(self.work_path, "data")
+        os.mkdir(data_folder)
+        for i in range(1, 4):
+            shutil.copyfile(os.path.join(self.data_path, f"file{i}.txt"), os.path.join(data_folder, f"file{i}.txt"))
+
+        for json_key in ["--single-hash-file-name-base", "--single-hash-file-name-base-json"]:
+            plain_hash_file_base = os.path.join(self.work_path, "plain")
+            cl = f"--input-folder {data_folder} {json_key} {plain_hash_file_base} --suppress-output-file-comments"
+            self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+            plain_hash_file_name = plain_hash_file_base + (".sha1.json" if json_key.endswith("json") else ".sha1")
+            with open(plain_hash_file_name, "r", encoding="utf-8") as f:
+                plain_content = f.read()
+
+            for compression, (extension, magic, open_func, _) in hash_storages.compression_formats.items():
+                hash_file_base = os.path.join(self.work_path, f"compressed_{compression}")
+                hash_file_name = hash_file_base + plain_hash_file_name[len(plain_hash_file_base):] + extension
+                cl = f"--input-folder {data_folder} {json_key} {hash_file_base} --suppress-output-file-comments --hash-file-compression {compression}"
+                self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+                with open(hash_file_name, "rb") as f:
+                    self.assertTrue(f.read().startswith(magic))
+                with open_func(hash_file_name, "rt", encoding="utf-8") as f:
+                    self.assertEqual(f.read(), plain_content)
+
+                # Compressed file is loaded, so hashes are not calculated again
+                hash_storage = hash_storages.SingleFileHashesStorage()
+                hash_storage.single_hash_file_name_base = hash_file_name
+                hash_storage.json_format = json_key.endswith("json")
+                hash_storage.load_hashes_info()
+                self.assertEqual(len(hash_storage.hash_data), 3)
+
+    def test_background_autosave(self):
+        data_file_names = [os.path.join(self.work_path, f"file{i}.txt") for i in range(100)]
+        for data_file_name in data_file_names:
+            with open(data_file_name, "w") as f:
+                f.write(data_file_name)
+        hash_storage = hash_storages.SingleFileHashesStorage()
+        hash_storage.single_hash_file_name_base = os.path.join(self.work_path, "hashes.sha1")
+        hash_storage.suppress_hash_file_comments = True
+        hash_storage.autosave_timeout = 1
+        hash_storage.load_hashes_info()
+        for i, data_file_name in enumerate(data_file_names):
+            hash_storage.set_hash(data_file_name, f"{i:040x}")
+            if i == 49:
+                # Autosave is started in background with the first half of hashes, the next ones are saved on the final save
+                hash_storage.last_time_load_save = time.time() - 2
+        hash_storage.save_hashes_info()
+
+        hash_storage = hash_storages.SingleFileHashesStorage()
+        hash_storage.single_hash_file_name_base = os.path.join(self.work_path, "hashes.sha1")
+        hash_storage.load_hashes_info()
+        self.assertEqual({fn: hash_info[0] for fn, hash_info in hash_storage.hash_data.items()},
+                         {data_file_name: f"{i:040x}" for i, data_file_name in enumerate(data_file_names)})
+
+        # Error of background save is reported by the next autosave
+        hash_storage.single_hash_file_name_base = os.path.join(self.work_path, "missing_folder", "hashes.sha1")
+        hash_storage.autosave_timeout = 0.1
+        hash_storage.last_time_load_save = time.time() - 1
+        hash_storage.set_hash(data_file_names[0], "0" * 40)
+        with self.assertRaises(Exception):
+            for _ in range(100):
+                time.sleep(0.05)
+                hash_storage.autosave_if_needed()
+
+
+class PerDirectoryHashesStorageTestCase(unittest.TestCase):
+
+    def  setUp(self):
+        self.data_path = tests.util_test.get_data_path()
+        self.work_path = tests.util_test.get_work_path()
+        tests.util_test.clean_work_dir()
+
+    def  tearDown(self):
+        tests.util_test.clean_work_dir()
+
+    def read_shard(self, folder):
+        with open(os.path.join(folder, "hashes.sha1"), "r", encoding="utf-8") as f:
+            return dict(reversed(line.rstrip("\n").split(" *", 1)) for line in f if not line.startswith("#"))
+
+    def test_cli_per_directory_hash_storage(self):
+        data_folder = os.path.join(self.work_path, "data")
+        sub_folder = os.path.join(data_folder, "sub")
+        os.makedirs(sub_folder)
+        shutil.copyfile(os.path.join(self.data_path, "file1.txt"), os.path.join(data_folder, "file1.txt"))
+        shutil.copyfile(os.path.join(self.data_path, "file2.txt"), os.path.join(data_folder, "file2.txt"))
+        shutil.copyfile(os.path.join(self.data_path, "file3.txt"), os.path.join(sub_folder, "file3.txt"))
+        file_hashes = {}
+        for file_name in ["file1.txt", "file2.txt", "file3.txt"]:
+            with open(os.path.join(self.data_path, file_name), "rb") as f:
+                file_hashes[file_name] = hashlib.sha1(f.read()).hexdigest()
+
+        cl = f"--input-folder {data_folder} --per-directory-hash-file-name-base hashes --suppress-output-file-comments"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        self.assertEqual(self.read_shard(data_folder), {"file1.txt": file_hashes["file1.txt"], "file2.txt": file_hashes["file2.txt"]})
+        self.assertEqual(self.read_shard(sub_folder), {"file3.txt": file_hashes["file3.txt"]})
+
+        # Hash files are not handled as data files, unchanged hash files are not saved
+        shard_mtime = os.stat(os.path.join(sub_folder, "hashes.sha1")).st_mtime_ns
+        os.remove(os.path.join(data_folder, "file2.txt"))
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        self.assertEqual(self.read_shard(data_folder), {"file1.txt": file_hashes["file1.txt"]})
+        self.assertEqual(os.stat(os.path.join(sub_folder, "hashes.sha1")).st_mtime_ns, shard_mtime)
+
+    def test_per_directory_hash_storage_unload_shards(self):
+        folders = [os.path.join(self.work_path, f"dir{i}") for i in range(5)]
+        hash_storage = hash_storages.PerDirectoryHashesStorage()
+        hash_storage.per_directory_hash_file_name_base = "hashes"
+        hash_storage.hash_file_name_postfix = ".sha1"
+        hash_storage.suppress_hash_file_comments = True
+        hash_storage.max_loaded_shards = 2
+        with hash_storage:
+            for i, folder in enumerate(folders):
+                os.mkdir(folder)
+                for j in range(3):
+                    data_file_name = os.path.join(folder, f"file{j}.txt")
+                    with open(data_file_name, "w") as f:
+                        f.write(f"{i} {j}")
+                    hash_storage.set_hash(data_file_name, f"{i:02d}{j:02d}")
+            # Unloaded shards are saved already
+            self.assertEqual(self.read_shard(folders[0]), {f"file{j}.txt": f"00{j:02d}" for j in range(3)})
+            self.assertTrue(hash_storage.has_hash(os.path.join(folders[1], "file2.txt")))
+            self.assertFalse(hash_storage.has_hash(os.path.join(folders[1], "file3.txt")))
+            hash_storage.remove_hash(os.path.join(folders[4], "file0.txt"))
+        self.assertEqual(self.read_shard(folders[4]), {"file1.txt": "0401", "file2.txt": "0402"})
+
 
 if __name__ == '__main__':
     run_single_test = True
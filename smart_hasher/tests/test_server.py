@@ -0,0 +1,87 @@
+import unittest
+import os
+import shutil
+import socket
+import hashlib
+import threading
+import time
+import tests.util_test
+import cmd_line
+import server
+import util
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "Unix domain sockets are not supported")
+class HashLookupServerTestCase(unittest.TestCase):
+
+    def  setUp(self):
+        self.data_path = tests.util_test.get_data_path()
+        self.work_path = tests.util_test.get_work_path()
+        tests.util_test.clean_work_dir()
+
+    def  tearDown(self):
+        tests.util_test.clean_work_dir()
+
+    def test_serve(self):
+        data_folder = os.path.join(self.work_path, "data")
+        os.mkdir(data_folder)
+        file_hashes = {}
+        for i in range(1, 4):
+            file_name = os.path.join(data_folder, f"file{i}.txt")
+            shutil.copyfile(f'{self.data_path}/file{i}.txt', file_name)
+            with open(file_name, "rb") as f:
+                file_hashes[file_name] = hashlib.sha1(f.read()).hexdigest()
+        file_names = sorted(file_hashes)
+        missing_file_name = os.path.join(data_folder, "missing.txt")
+
+        # Hash file contains the first file only
+        hash_file_base = os.path.join(self.work_path, "hash_storage")
+        exit_code = cmd_line.CommandLineAdapter().run_cmd_line(f"--input-file {file_names[0]} --single-hash-file-name-base {hash_file_base} --suppress-console-reporting-output")
+        self.assertEqual(exit_code, cmd_line.ExitCode.OK)
+
+        socket_path = os.path.join(self.work_path, "hasher.sock")
+        client_results = {}
+        def run_client():
+            try:
+                for _ in range(200):
+                    if os.path.exists(socket_path):
+                        break
+                    time.sleep(0.05)
+                with server.HashLookupClient(socket_path, timeout=10) as client:
+                    client_results["ping"] = client.request("ping")
+                    client_results["lookup"] = client.request("lookup", file_names)
+                    client_results["has_hash"] = client.request("has_hash", file_names)
+                    client_results["compute"] = client.request("compute", file_names + [missing_file_name])
+                    client_results["lookup_computed"] = client.request("lookup", file_names)
+                    with self.assertRaises(RuntimeError):
+                        client.request("unknown", file_names)
+                    # Hash of the hash file itself can't be stored
+                    with self.assertRaises(RuntimeError):
+                        client.request("compute", [hash_file_base + ".sha1"], force=True)
+                    # Connection works after error
+                    client_results["lookup_after_error"] = client.request("lookup", file_names[:1])
+            finally:
+                util.request_program_interruption()
+
+        client_thread = threading.Thread(target=run_client)
+        client_thread.start()
+        exit_code = cmd_line.CommandLineAdapter().run_cmd_line(f"--serve {socket_path} --single-hash-file-name-base {hash_file_base} --suppress-console-reporting-output")
+        client_thread.join()
+        self.assertEqual(exit_code, cmd_line.ExitCode.OK)
+        self.assertFalse(os.path.exists(socket_path))
+
+        self.assertEqual(client_results["ping"], [])
+        self.assertEqual(client_results["lookup"], [{"path": fn, "hash": file_hashes[fn] if fn == file_names[0] else None} for fn in file_names])
+        self.assertEqual([res["has_hash"] for res in client_results["has_hash"]], [True, False, False])
+        self.assertEqual([(res["hash"], res["computed"]) for res in client_results["compute"][:3]],
+                         [(file_hashes[fn], fn != file_names[0]) for fn in file_names])
+        self.assertIsNotNone(client_results["compute"][3]["error"])
+        self.assertEqual([res["hash"] for res in client_results["lookup_computed"]], [file_hashes[fn] for fn in file_names])
+        self.assertEqual(client_results["lookup_after_error"][0]["hash"], file_hashes[file_names[0]])
+
+        # Computed hashes are saved on exit
+        with open(hash_file_base + ".sha1", "r", encoding="utf-8") as f:
+            hash_file_lines = [line for line in f if not line.startswith("#")]
+        self.assertEqual(len(hash_file_lines), 3)
+
+if __name__ == '__main__':
+    unittest.main()
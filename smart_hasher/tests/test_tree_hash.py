@@ -0,0 +1,132 @@
+import unittest
+import os
+import shutil
+import hashlib
+import tests.util_test
+import cmd_line
+import hash_file_diff
+import hash_storages
+import tree_hash
+
+class TreeHashTestCase(unittest.TestCase):
+
+    def  setUp(self):
+        self.data_path = tests.util_test.get_data_path()
+        self.work_path = tests.util_test.get_work_path()
+        tests.util_test.clean_work_dir()
+
+    def  tearDown(self):
+        tests.util_test.clean_work_dir()
+
+    def create_replica(self, folder_name):
+        os.makedirs(os.path.join(folder_name, "sub", "deep"))
+        os.makedirs(os.path.join(folder_name, "other"))
+        os.makedirs(os.path.join(folder_name, "empty"))
+        shutil.copyfile(os.path.join(self.data_path, "file1.txt"), os.path.join(folder_name, "file1.txt"))
+        shutil.copyfile(os.path.join(self.data_path, "file2.txt"), os.path.join(folder_name, "sub", "file2.txt"))
+        shutil.copyfile(os.path.join(self.data_path, "file3.txt"), os.path.join(folder_name, "sub", "deep", "file3.txt"))
+        shutil.copyfile(os.path.join(self.data_path, "file4.txt"), os.path.join(folder_name, "other", "file4.txt"))
+
+    def read_hash_file(self, file_name):
+        return dict(hash_file_diff.iter_text_hash_file(file_name))
+
+    def test_get_folder_hashes(self):
+        file_hashes = [(os.path.join(os.sep, "root", "a.txt"), "aa"), (os.path.join(os.sep, "root", "sub", "b.txt"), "bb"),
+                       (os.path.join(os.sep, "outside", "c.txt"), "cc")]
+        folder_hashes = tree_hash.get_folder_hashes(reversed(file_hashes), [os.path.join(os.sep, "root")], "sha1")
+        sub_hash = hashlib.sha1(b"f bb b.txt\n").hexdigest()
+        root_hash = hashlib.sha1(f"f aa a.txt\nd {sub_hash} sub\n".encode()).hexdigest()
+        self.assertEqual(folder_hashes, {os.path.join(os.sep, "root"): root_hash, os.path.join(os.sep, "root", "sub"): sub_hash})
+
+    def write_hash_file(self, file_name, hashes):
+        with open(file_name, "w", encoding="utf-8") as f:
+            for name in sorted(hashes, key=hash_storages.file_name_sort_key):
+                f.write(f"{hashes[name]} *{name}\n")
+
+    def get_differences(self, old_file_name, new_file_name):
+        comparison = hash_file_diff.HashFilesComparison(old_file_name, new_file_name)
+        comparison.detect_renames = False
+        return sorted((record.status.value, record.file_name) for record in comparison.iter_differences())
+
+    def test_compare_equal_folders(self):
+        sep = os.sep
+        old_hashes = {f"a{sep}": "1", f"a{sep}x.txt": "2", f"a{sep}y.txt": "3", f"b{sep}": "4", f"b{sep}z.txt": "5", f"b{sep}w.txt": "6", "c.txt": "7"}
+        new_hashes = {f"a{sep}": "1", f"a{sep}x.txt": "0", f"b{sep}": "8", f"b{sep}z.txt": "9", f"b{sep}w.txt": "6", "d.txt": "a0"}
+        old_file_name = os.path.join(self.work_path, "old.sha1")
+        new_file_name = os.path.join(self.work_path, "new.sha1")
+        self.write_hash_file(old_file_name, old_hashes)
+        self.write_hash_file(new_file_name, new_hashes)
+        # Content of the folder "a" is not compared, because hashes of the folder are equal
+        self.assertEqual(self.get_differences(old_file_name, new_file_name),
+                         [("added", "d.txt"), ("modified", f"b{sep}"), ("modified", f"b{sep}z.txt"), ("removed", "c.txt")])
+
+    def test_compare_equal_root_folders(self):
+        sep = os.sep
+        old_hashes = {f".{sep}": "1", "a.txt": "2", f"sub{sep}": "3", f"sub{sep}b.txt": "4", f"..{sep}outside.txt": "5"}
+        new_hashes = {f".{sep}": "1", "a.txt": "0", f"sub{sep}b.txt": "0", f"..{sep}outside.txt": "6", f"..{sep}other.txt": "7"}
+        old_file_name = os.path.join(self.work_path, "old.sha1")
+        new_file_name = os.path.join(self.work_path, "new.sha1")
+        self.write_hash_file(old_file_name, old_hashes)
+        self.write_hash_file(new_file_name, new_hashes)
+        # Records below the folder of the hash file are not compared, because hashes of the folder are equal. Records outside of it are compared
+        comparison = hash_file_diff.HashFilesComparison(old_file_name, new_file_name)
+        self.assertEqual([(record.status.value, record.file_name) for record in comparison.iter_differences()],
+                         [("modified", f"..{sep}outside.txt"), ("added", f"..{sep}other.txt")])
+        self.assertEqual(comparison.counts[hash_file_diff.DiffStatus.UNCHANGED], 3)
+
+    def test_iter_parent_folder_records(self):
+        sep = os.sep
+        self.assertEqual(list(tree_hash.iter_parent_folder_records(f"a{sep}b{sep}c.txt")), [f".{sep}", f"a{sep}", f"a{sep}b{sep}"])
+        self.assertEqual(list(tree_hash.iter_parent_folder_records(f"a{sep}b{sep}")), [f".{sep}", f"a{sep}"])
+        self.assertEqual(list(tree_hash.iter_parent_folder_records("c.txt")), [f".{sep}"])
+        self.assertEqual(list(tree_hash.iter_parent_folder_records("..c.txt")), [f".{sep}"])
+        self.assertEqual(list(tree_hash.iter_parent_folder_records(f".{sep}")), [])
+        self.assertEqual(list(tree_hash.iter_parent_folder_records(f"..{sep}c.txt")), [f"..{sep}"])
+        self.assertEqual(list(tree_hash.iter_parent_folder_records(os.path.join(os.path.abspath(os.sep), "a", "c.txt"))),
+                         [os.path.abspath(os.sep), os.path.join(os.path.abspath(os.sep), "a", "")])
+
+    def test_folder_hashes(self):
+        for replica_name in ["replica1", "replica2"]:
+            self.create_replica(os.path.join(self.work_path, replica_name))
+            cl = f"--input-folder {self.work_path}/{replica_name} --single-hash-file-name-base {self.work_path}/{replica_name} --folder-hashes " \
+                 "--suppress-console-reporting-output --suppress-output-file-comments"
+            self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+
+        hashes1 = self.read_hash_file(os.path.join(self.work_path, "replica1.sha1"))
+        hashes2 = self.read_hash_file(os.path.join(self.work_path, "replica2.sha1"))
+        folder_names = [os.path.join(*parts, "") for parts in [("replica1",), ("replica1", "other"), ("replica1", "sub"), ("replica1", "sub", "deep")]]
+        self.assertEqual(sorted(name for name in hashes1 if tree_hash.is_folder_record(name)), folder_names)
+        # Replicas in different folders have equal folder hashes
+        self.assertEqual(hashes1[os.path.join("replica1", "")], hashes2[os.path.join("replica2", "")])
+
+        # Folder records are loaded and replaced with the new ones
+        shutil.copyfile(os.path.join(self.work_path, "replica2.sha1"), os.path.join(self.work_path, "old_replica2.sha1"))
+        shutil.copyfile(os.path.join(self.data_path, "file1.txt"), os.path.join(self.work_path, "replica2", "sub", "deep", "file3.txt"))
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl + " --force-calc-hash"), cmd_line.ExitCode.OK)
+        new_hashes2 = self.read_hash_file(os.path.join(self.work_path, "replica2.sha1"))
+        self.assertEqual(len(new_hashes2), len(hashes2))
+        differences = self.get_differences(os.path.join(self.work_path, "old_replica2.sha1"), os.path.join(self.work_path, "replica2.sha1"))
+        self.assertEqual(differences, [("modified", os.path.join(*parts)) for parts in [("replica2", ""), ("replica2", "sub", ""), ("replica2", "sub", "deep", ""),
+                                                                                         ("replica2", "sub", "deep", "file3.txt")]])
+
+        # Folder of the hash file is stored as "./"
+        cl = f"--input-folder {self.work_path}/replica1 --single-hash-file-name-base {self.work_path}/replica1/hashes --folder-hashes " \
+             "--input-folder-file-mask-exclude hashes.sha1 --suppress-console-reporting-output --suppress-output-file-comments"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        hashes = self.read_hash_file(os.path.join(self.work_path, "replica1", "hashes.sha1"))
+        self.assertEqual(hashes[os.path.join(os.curdir, "")], hashes1[os.path.join("replica1", "")])
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.OK)
+        self.assertEqual(self.read_hash_file(os.path.join(self.work_path, "replica1", "hashes.sha1")), hashes)
+
+        # Folder hashes are not calculated from partial set of files, previous folder records are removed
+        cl = f"--input-folder {self.work_path}/replica1 --input-file {self.work_path}/missing.txt --single-hash-file-name-base {self.work_path}/replica1 " \
+             "--folder-hashes --preserve-unused-hash-records --suppress-console-reporting-output --suppress-output-file-comments"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.DATA_READ_ERROR)
+        hashes = self.read_hash_file(os.path.join(self.work_path, "replica1.sha1"))
+        self.assertEqual({name: hash_value for name, hash_value in hashes1.items() if not tree_hash.is_folder_record(name)}, hashes)
+
+        cl = f"--input-folder {self.work_path}/replica1 --per-directory-hash-file-name-base hashes --folder-hashes"
+        self.assertEqual(cmd_line.CommandLineAdapter().run_cmd_line(cl), cmd_line.ExitCode.INVALID_COMMAND_LINE_PARAMETERS)
+
+if __name__ == '__main__':
+    unittest.main()
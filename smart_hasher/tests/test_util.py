@@ -1,5 +1,11 @@
+import io
 import math
+import os
+import signal
+import stat
+import threading
 import unittest
+import tests.util_test
 #import smart_hasher
 #import hash_calc
 import util
@@ -49,6 +55,188 @@ class UtilTestCase(unittest.TestCase):
         actual_result = util.convert_size_to_display(-math.inf)
         self.assertEqual(actual_result, "-infinity")
 
+    def test_parse_size(self):
+        self.assertEqual(util.parse_size("0"), 0)
+        self.assertEqual(util.parse_size("1023"), 1023)
+        self.assertEqual(util.parse_size("64K"), 64 * 1024)
+        self.assertEqual(util.parse_size("64KiB"), 64 * 1024)
+        self.assertEqual(util.parse_size("10 MiB"), 10 * 1024 * 1024)
+        self.assertEqual(util.parse_size("1.5g"), 1536 * 1024 * 1024)
+        self.assertEqual(util.parse_size("2T"), 2 * 1024 ** 4)
+
+        for size_str in ["", "K", "-1", "10X", "1,5M"]:
+            with self.subTest(size_str = size_str):
+                with self.assertRaises(ValueError):
+                    util.parse_size(size_str)
+
+    def test_parse_shard(self):
+        self.assertEqual(util.parse_shard("1/1"), (1, 1))
+        self.assertEqual(util.parse_shard(" 3 / 20 "), (3, 20))
+
+        for shard_str in ["", "1", "0/2", "3/2", "1/0", "-1/2", "a/b"]:
+            with self.subTest(shard_str = shard_str):
+                with self.assertRaises(ValueError):
+                    util.parse_shard(shard_str)
+
+        # Files are spread over all shards evenly
+        counts = [0] * 4
+        for i in range(4000):
+            counts[util.get_shard_index(f"folder/file{i}.txt", 4) - 1] += 1
+        self.assertTrue(all(900 < count < 1100 for count in counts), counts)
+        self.assertEqual(util.get_shard_index("folder/file.txt", 4), util.get_shard_index("folder/file.txt", 4))
+
+    def test_token_bucket(self):
+        cur_time = [100.0]
+        sleeps = []
+
+        def sleep_func(duration):
+            sleeps.append(duration)
+            cur_time[0] += duration
+
+        bucket = util.TokenBucket(1000)
+        bucket.time_func = lambda: cur_time[0]
+        bucket.sleep_func = sleep_func
+        bucket.last_time = cur_time[0]
+
+        # Initial burst is available without sleep
+        self.assertEqual(bucket.consume(1000), 0)
+        self.assertEqual(sleeps, [])
+
+        # Bucket is empty, so the consumer should wait until tokens are refilled
+        self.assertAlmostEqual(bucket.consume(500), 0.5)
+
+        # Time passed, but the bucket is not refilled above capacity
+        cur_time[0] += 10
+        self.assertEqual(bucket.consume(1000), 0)
+        self.assertAlmostEqual(bucket.consume(3000), 3)
+
+        self.assertAlmostEqual(sum(sleeps), 3.5)
+
+        # Bucket shared by threads accounts all amounts, time is frozen so the tokens are not refilled
+        bucket = util.TokenBucket(1000)
+        bucket.time_func = lambda: 100.0
+        bucket.sleep_func = lambda duration: None
+        bucket.last_time = 100.0
+        def consume_many():
+            for _ in range(1000):
+                bucket.consume(1)
+        threads = [threading.Thread(target=consume_many) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(bucket.tokens, 1000 - 8 * 1000)
+
+    def test_signal_interruption(self):
+        self.assertFalse(util.is_program_interrupted_by_user())
+
+        with util.SignalInterruptionHandler():
+            self.assertFalse(util.is_program_interrupted_by_user())
+            # Ref: https://docs.python.org/3/library/signal.html#signal.raise_signal
+            signal.raise_signal(signal.SIGINT)
+            self.assertTrue(util.is_program_interrupted_by_user())
+            self.assertFalse(util.pause(1))
+
+            # Second signal interrupts immediately
+            with self.assertRaises(KeyboardInterrupt):
+                signal.raise_signal(signal.SIGINT)
+
+        # Previous handler is restored and the flag is reset
+        self.assertIs(signal.getsignal(signal.SIGINT), signal.default_int_handler)
+        self.assertFalse(util.is_program_interrupted_by_user())
+
+        # Handler of other thread doesn't reset the flag of the outer handler, signal handlers aren't changed in other threads
+        with util.SignalInterruptionHandler():
+            util.request_program_interruption()
+            def run_nested():
+                with util.SignalInterruptionHandler():
+                    pass
+            thread = threading.Thread(target=run_nested)
+            thread.start()
+            thread.join()
+            self.assertTrue(util.is_program_interrupted_by_user())
+            self.assertIsNot(signal.getsignal(signal.SIGINT), signal.default_int_handler)
+        self.assertFalse(util.is_program_interrupted_by_user())
+
+    def test_atomic_file_write(self):
+        tests.util_test.clean_work_dir()
+        work_path = tests.util_test.get_work_path()
+        file_name = os.path.join(work_path, "atomic.txt")
+        try:
+            for fsync_policy in util.fsync_policies:
+                with util.atomic_file_write(file_name, fsync_policy) as tmp_file_name:
+                    self.assertNotEqual(tmp_file_name, file_name)
+                    with open(tmp_file_name, "w") as f:
+                        f.write(fsync_policy)
+                with open(file_name) as f:
+                    self.assertEqual(f.read(), fsync_policy)
+            os.chmod(file_name, 0o640)
+
+            # File is not changed on exception and temporary file is removed
+            with self.assertRaises(RuntimeError):
+                with util.atomic_file_write(file_name) as tmp_file_name:
+                    with open(tmp_file_name, "w") as f:
+                        f.write("partial")
+                    raise RuntimeError("Interrupted")
+            with open(file_name) as f:
+                self.assertEqual(f.read(), util.fsync_policies[-1])
+            self.assertEqual(sorted(os.listdir(work_path)), ["atomic.txt"])
+
+            # Permissions of the replaced file are preserved
+            with util.atomic_file_write(file_name) as tmp_file_name:
+                with open(tmp_file_name, "w") as f:
+                    f.write("new")
+            if os.name == "posix":
+                self.assertEqual(stat.S_IMODE(os.stat(file_name).st_mode), 0o640)
+        finally:
+            tests.util_test.clean_work_dir()
+
+    def test_iter_file_list(self):
+        data = b"a.txt\r\nfolder/b c.txt\n\nlast.txt"
+        for chunk_size in [1, 3, 1024]:
+            self.assertEqual(list(util.iter_file_list(io.BytesIO(data), chunk_size=chunk_size)), ["a.txt", "folder/b c.txt", "last.txt"])
+            self.assertEqual(list(util.iter_file_list(io.BytesIO(b"a\nb.txt\0c.txt\0"), b"\0", chunk_size)), ["a\nb.txt", "c.txt"])
+
+    def test_throughput_time_estimator(self):
+        small_size, big_size = 4 * 1024, 1024 * 1024 * 1024
+        estimator = util.ThroughputTimeEstimator()
+        for _ in range(1000):
+            estimator.add_file("a", small_size)
+        for _ in range(10):
+            estimator.add_file("a", big_size)
+        estimator.add_file("b", big_size)
+        self.assertIsNone(estimator.get_estimated_duration_remains())
+
+        # Small files take 10 ms each, big files are read at about 100 MiB/sec
+        for _ in range(400):
+            estimator.add_handled_file("a", small_size, 0.01)
+        for _ in range(100):
+            estimator.skip_file("a", small_size)
+        for _ in range(2):
+            estimator.add_handled_file("a", big_size, 10.01)
+        # 500 small files, 8 big files on device "a" and 1 big file on device "b" which is estimated with the model of all devices
+        self.assertAlmostEqual(estimator.get_estimated_duration_remains(), 500 * 0.01 + 9 * 10.0, delta=0.5)
+        result = estimator.get_result()
+        self.assertAlmostEqual(result.estimated_duration_remains.total_seconds(), 95.0, delta=0.5)
+        self.assertIn("Estimated duration to completion", result.get_str())
+
+        tests.util_test.clean_work_dir()
+        history_file_name = os.path.join(tests.util_test.get_work_path(), "throughput.json")
+        try:
+            estimator.save_history(history_file_name)
+            # Estimation is available from the start with history
+            seeded_estimator = util.ThroughputTimeEstimator()
+            seeded_estimator.add_file("a", big_size)
+            seeded_estimator.load_history(history_file_name)
+            self.assertAlmostEqual(seeded_estimator.get_estimated_duration_remains(), 10.0, delta=0.1)
+
+            with open(history_file_name, "w") as f:
+                f.write("[]")
+            with self.assertRaises(util.AppUsageError):
+                seeded_estimator.load_history(history_file_name)
+        finally:
+            tests.util_test.clean_work_dir()
+
 if __name__ == '__main__':
     run_single_test = True
     if run_single_test:
@@ -0,0 +1,77 @@
+import unittest
+import os
+import time
+import tests.util_test
+import watcher
+
+class WatcherTestCase(unittest.TestCase):
+
+    def  setUp(self):
+        self.work_path = tests.util_test.get_work_path()
+        self.data_folder = os.path.join(self.work_path, "data")
+        self.create_folders()
+
+    def  tearDown(self):
+        tests.util_test.clean_work_dir()
+
+    def create_folders(self):
+        tests.util_test.clean_work_dir()
+        for rel_dir_name in ["src", os.path.join("src", "node_modules"), "node_modules"]:
+            os.makedirs(os.path.join(self.data_folder, rel_dir_name))
+
+    @staticmethod
+    def dir_filter(dir_name, top_level):
+        return dir_name != "node_modules"
+
+    def wait_changed_files(self, folder_watcher, expected_count):
+        changed_files = set()
+        for _ in range(20):
+            changed_files.update(path for kind, path in folder_watcher.wait_events(0.1) if kind == watcher.WatchEventKind.FILE_CHANGED)
+            if len(changed_files) >= expected_count:
+                # Unexpected changes may follow
+                changed_files.update(path for kind, path in folder_watcher.wait_events(0.1) if kind == watcher.WatchEventKind.FILE_CHANGED)
+                break
+        return sorted(changed_files)
+
+    def test_dir_filter(self):
+        watchers = [watcher.PollingWatcher([self.data_folder], 0.05, self.dir_filter)]
+        if watcher.InotifyWatcher.is_supported():
+            watchers.append(watcher.InotifyWatcher([self.data_folder], self.dir_filter))
+        for folder_watcher in watchers:
+            with self.subTest(watcher = type(folder_watcher).__name__):
+                self.create_folders()
+                with folder_watcher:
+                    # Excluded subfolder is not watched, also if it is created after start
+                    os.makedirs(os.path.join(self.data_folder, "src", "lib", "node_modules"))
+                    time.sleep(0.1)
+                    for rel_dir_name in ["", "src", os.path.join("src", "node_modules"), "node_modules", os.path.join("src", "lib", "node_modules")]:
+                        with open(os.path.join(self.data_folder, rel_dir_name, "file.txt"), "w") as f:
+                            f.write(rel_dir_name)
+                    self.assertEqual(self.wait_changed_files(folder_watcher, 2),
+                                     [os.path.join(self.data_folder, "file.txt"), os.path.join(self.data_folder, "src", "file.txt")])
+
+    def test_fallback_to_polling(self):
+        if not watcher.InotifyWatcher.is_supported():
+            self.skipTest("inotify is not supported")
+        messages = []
+        # Empty mask is invalid, so inotify watch can't be added, like when the limit of watches is reached
+        watch_mask = watcher.InotifyWatcher.watch_mask
+        watcher.InotifyWatcher.watch_mask = 0
+        try:
+            folder_watcher = watcher.create_watcher([self.data_folder], 0.05, report_func=messages.append)
+        finally:
+            watcher.InotifyWatcher.watch_mask = watch_mask
+        self.assertIsInstance(folder_watcher, watcher.PollingWatcher)
+        self.assertEqual(len(messages), 1)
+        with folder_watcher:
+            with open(os.path.join(self.data_folder, "file.txt"), "w") as f:
+                f.write("data")
+            self.assertEqual(self.wait_changed_files(folder_watcher, 1), [os.path.join(self.data_folder, "file.txt")])
+
+        folder_watcher = watcher.create_watcher([self.data_folder], 0.05, report_func=messages.append)
+        with folder_watcher:
+            self.assertIsInstance(folder_watcher, watcher.InotifyWatcher)
+        self.assertEqual(len(messages), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Hashes of folder trees, which are aggregated from hashes of files, so data is not read again.
+
+Hash of the folder is calculated over lines "<kind> <hash> <name>\\n" for all children of the folder sorted by names,
+where kind is "f" for file and "d" for subfolder, and name is the base name. So the hash depends on names and content of files in the tree,
+but not on the location of the tree, and replicas of the tree in different places have equal hashes.
+Only files known to the storage are accounted, so empty folders don't change the hash.
+
+Folder records are stored in hash files along with file records, folder name has separator at the end, e.g. "data/photos/".
+Two hash files with folder records are compared top-down, records below folders with equal hashes are skipped, see `hash_file_diff.HashFilesComparison`.
+
+Ref: https://en.wikipedia.org/wiki/Merkle_tree
+"""
+import hashlib
+import os
+
+# Separators of the platform, "\\" is valid character of file names on Linux
+folder_record_suffixes = tuple(sep for sep in (os.sep, os.altsep) if sep)
+
+# Record of the folder of the hash file, names of other records in this folder are relative to it, see `hash_storages`
+root_folder_record = os.path.join(os.curdir, "")
+
+def is_folder_record(file_name):
+    return file_name.endswith(folder_record_suffixes)
+
+def iter_parent_folder_records(file_name):
+    """
+    Iterate over names of folder records for the folders on the path of the record, e.g. "data/" and "data/sub/" for "data/sub/file.txt".
+    Relative names of the records below the folder of the hash file start with the record of this folder "./"
+    """
+    if file_name != root_folder_record and not os.path.isabs(file_name) and \
+       not (file_name == os.pardir or file_name.startswith(tuple(os.pardir + sep for sep in folder_record_suffixes))):
+        yield root_folder_record
+    for index, ch in enumerate(file_name[:-1]):
+        if ch in folder_record_suffixes:
+            yield file_name[:index + 1]
+
+def get_folder_hash(children, hash_algo):
+    """
+    Calculate hash of the folder from triples (kind, hash, base name) of its children, kind is "f" for file and "d" for folder
+    """
+    hasher = hashlib.new(hash_algo)
+    for kind, hash_value, name in sorted(children, key=lambda child: child[2]):
+        hasher.update(f"{kind} {hash_value} {name}\n".encode("utf-8", "surrogateescape"))
+    return hasher.hexdigest()
+
+def get_folder_hashes(file_hashes, root_folders, hash_algo):
+    """
+    Calculate hashes of `root_folders` and all their subfolders with files from pairs (absolute file name, hash).
+    Files outside of root folders are ignored. Return dictionary absolute folder name -> hash
+    """
+    root_folders = sorted(set(os.path.abspath(folder) for folder in root_folders), key=len)
+    children = {} # Folder -> list of (kind, hash, base name)
+    for file_name, hash_value in file_hashes:
+        # The outermost root is taken, so nested root folders are accounted in the outer trees
+        root_folder = next((folder for folder in root_folders if file_name.startswith(os.path.join(folder, ""))), None)
+        if root_folder is None:
+            continue
+        folder_name, base_name = os.path.split(file_name)
+        children.setdefault(folder_name, []).append(("f", hash_value, base_name))
+        # Parent folders are registered up to the root, so the folders without files but with subfolders are accounted
+        while folder_name != root_folder:
+            folder_name = os.path.dirname(folder_name)
+            if folder_name in children:
+                break
+            children[folder_name] = []
+    for root_folder in root_folders:
+        children.setdefault(root_folder, [])
+
+    ret = {}
+    # Subfolders are handled before their parents, because they have longer names
+    for folder_name in sorted(children, key=len, reverse=True):
+        folder_hash = get_folder_hash(children[folder_name], hash_algo)
+        ret[folder_name] = folder_hash
+        parent_folder_name, base_name = os.path.split(folder_name)
+        # Parent of the outermost root folder is not registered, so it is not calculated. Empty root folders are not accounted in the parents
+        if parent_folder_name in children and base_name and children[folder_name]:
+            children[parent_folder_name].append(("d", folder_hash, base_name))
+    return ret
@@ -1,8 +1,25 @@
-import msvcrt
 import math
 import time
 import os
+import sys
+import signal
+import threading
+import re
+import ctypes
+import platform
 import datetime
+import shutil
+import uuid
+import contextlib
+import struct
+import json
+import fnmatch
+import hashlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows
 
 # Ref: https://en.wikipedia.org/wiki/Megabyte
 size_names = ("B", "KiB", "MiB", "GiB", "TiB", "PiB", "EiB", "ZiB", "YiB")
@@ -33,25 +50,118 @@ def convert_size_to_display(size_bytes: float) -> str:
     s = round(size_bytes / p, 2)
     return f"{sign}{s} {size_names[i]}"
 
+def parse_size(size_str: str) -> int:
+    """
+    Convert size from human readable presentation to bytes, e.g. "512", "64K", "10MiB", "1.5G".
+    Suffixes are powers of 1024, the same as in `convert_size_to_display()`.
+
+    Raises ValueError on wrong format, so the function can be used as `type` for argparse arguments.
+    """
+    match = re.fullmatch(r"\s*(?P<value>[0-9]+(\.[0-9]*)?)\s*(?P<unit>[KMGTPEZY]?)(i?B)?\s*", size_str, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size: '{size_str}'")
+    unit = match.group("unit").upper()
+    power = size_names.index(unit + "iB") if unit else 0
+    ret = int(float(match.group("value")) * math.pow(1024, power))
+    return ret
+
+def parse_shard(shard_str: str):
+    """
+    Convert shard specification "I/N" to pair (I, N), where shard index I is from 1 to N.
+
+    Raises ValueError on wrong format, so the function can be used as `type` for argparse arguments.
+    """
+    match = re.fullmatch(r"\s*(?P<index>[0-9]+)\s*/\s*(?P<count>[0-9]+)\s*", shard_str)
+    if match is None or not 1 <= int(match.group("index")) <= int(match.group("count")):
+        raise ValueError(f"Invalid shard: '{shard_str}'")
+    return int(match.group("index")), int(match.group("count"))
+
+def get_shard_index(file_key: str, shard_count: int) -> int:
+    """
+    Shard index from 1 to `shard_count` for the file. It depends on the key only, so it is the same on all nodes and runs.
+    Cryptographic hash spreads similar keys evenly, built-in `hash()` of strings is randomized per process
+
+    Ref: https://docs.python.org/3/reference/datamodel.html#object.__hash__
+    """
+    digest = hashlib.md5(file_key.encode("utf-8", "surrogateescape")).digest()
+    return int.from_bytes(digest[:8], "little") % shard_count + 1
+
+# Flag is set by signal handler, see `SignalInterruptionHandler`. It is cheap to check it, so this is done for every data chunk
+program_interrupted = False
+
 def is_program_interrupted_by_user():
+    return program_interrupted
+
+def request_program_interruption():
+    """
+    Request graceful interruption of the program, the same way as on Ctrl+C
     """
-    Ref: https://stackoverflow.com/questions/24072790/detect-key-press-in-python
+    global program_interrupted
+    program_interrupted = True
+
+def reset_program_interruption():
+    """
+    Forget the request of interruption, e.g. when the interrupted operation is finished, so the next operation is not interrupted
     """
-    if msvcrt.kbhit():
-        key = msvcrt.getch()
-        if key == b'\x1b':
-            print("\nExit program? (Press 'y' to exit or other key to continue)\n", end="")
-            key = msvcrt.getch()
-            if (key == b'y'):
-                print("{0}\nProgram interrupted by user".format(str(key)))
-                return True
-    return False
+    global program_interrupted
+    program_interrupted = False
+
+class SignalInterruptionHandler(object):
+    """
+    This is a context manager which installs handlers for SIGINT (Ctrl+C), SIGTERM (e.g. on stop of systemd service) and SIGBREAK (Ctrl+Break on Windows).
+    Handlers request graceful interruption: the program stops after the current data chunk and saves calculated hashes.
+    Second signal interrupts the program immediately with KeyboardInterrupt.
+
+    Signal handlers can be installed in the main thread only. Handlers may be nested or entered in several threads, e.g. for several runs in one process,
+    interruption flag is reset only on enter of the outermost handler and on its exit, so interruption requested for the running code isn't lost.
 
-def pause(pause_duration = 30):
+    Ref: https://docs.python.org/3/library/signal.html
+    """
+
+    __depth = 0 # Count of entered handlers in all threads
+    __depth_lock = threading.Lock()
+
+    def __init__(self):
+        self.__prev_handlers = {}
+
+    @staticmethod
+    def _handle_signal(signum, _):
+        if program_interrupted:
+            raise KeyboardInterrupt()
+        request_program_interruption()
+        print(f"\nProgram interrupted by signal {signal.Signals(signum).name}. Press Ctrl+C again to exit immediately, "
+              "in this case calculated hashes may be lost", file=sys.stderr)
+
+    def __enter__(self):
+        global program_interrupted
+        with SignalInterruptionHandler.__depth_lock:
+            if SignalInterruptionHandler.__depth == 0:
+                program_interrupted = False
+            SignalInterruptionHandler.__depth += 1
+        if threading.current_thread() is threading.main_thread():
+            for sig_name in ("SIGINT", "SIGTERM", "SIGBREAK"):
+                sig = getattr(signal, sig_name, None)
+                if sig is not None:
+                    self.__prev_handlers[sig] = signal.signal(sig, self._handle_signal)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global program_interrupted
+        for sig, prev_handler in self.__prev_handlers.items():
+            signal.signal(sig, prev_handler)
+        self.__prev_handlers = {}
+        with SignalInterruptionHandler.__depth_lock:
+            SignalInterruptionHandler.__depth -= 1
+            if SignalInterruptionHandler.__depth == 0:
+                program_interrupted = False
+        return False
+
+def pause(pause_duration = 30, report = True):
     """
     Pause with support of interruption by user
 
     pause_duration - duration of pause, seconds.
+    report - show countdown on console.
     Returns:
         True if pause worked fine
         False if program interruped
@@ -60,14 +170,14 @@ def pause(pause_duration = 30):
     Ref: https://stackoverflow.com/questions/44834493/a-single-python-loop-from-zero-to-n-to-zero
     """
     for s in range(pause_duration, 0, -1):
-        print(f"Pause {s} seconds before continue program execution... Press ESC to exit program\r", end="")
+        if report:
+            print(f"Pause {s} seconds before continue program execution... Press Ctrl+C to exit program\r", end="")
         # Ref: https://www.journaldev.com/15797/python-time-sleep
         time.sleep(1)
-        # Ref: https://stackoverflow.com/questions/24072790/detect-key-press-in-python
         pi = is_program_interrupted_by_user()
         if pi:
             return False
-    if pause_duration > 0:
+    if pause_duration > 0 and report:
         print(" " * 60)
     return True
 
@@ -138,10 +248,90 @@ def drive_normcase(path):
     Note this is not the same as `normcase()` for path.
     """
     drive, tail = os.path.splitdrive(path)
+    if not drive:
+        return path
     drive = drive.upper()
     ret = os.path.join(drive, tail)
     return ret
 
+# "none" - data is not flushed to disk explicitly, "file" - new file is flushed to disk before it replaces the old one,
+# "file-and-folder" - folder is flushed also, so the replacement itself is durable
+fsync_policies = ("none", "file", "file-and-folder")
+
+def fsync_file(file_name):
+    """
+    Ref: https://docs.python.org/3/library/os.html#os.fsync
+    """
+    # Windows requires file opened for writing to flush it
+    fd = os.open(file_name, os.O_RDWR | getattr(os, "O_BINARY", 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def fsync_folder(folder_name):
+    """
+    Flush folder entries, e.g. after file is renamed in it. Folders can't be opened on Windows, there rename is flushed with the file
+
+    Ref: https://lwn.net/Articles/457667/
+    """
+    if os.name != "posix":
+        return
+    fd = os.open(folder_name, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def replace_file(src_file_name, dst_file_name, fsync_policy = "file"):
+    """
+    Replace file atomically with the other one in the same folder. Permissions of the replaced file are preserved
+
+    Ref: https://docs.python.org/3/library/os.html#os.replace
+    """
+    if fsync_policy not in fsync_policies:
+        raise ValueError(f"Unknown fsync policy: {fsync_policy}")
+    if fsync_policy != "none":
+        fsync_file(src_file_name)
+    if os.path.exists(dst_file_name):
+        shutil.copymode(dst_file_name, src_file_name)
+    os.replace(src_file_name, dst_file_name)
+    if fsync_policy == "file-and-folder":
+        fsync_folder(os.path.dirname(os.path.abspath(dst_file_name)))
+
+def drop_file_cache(file_name):
+    """
+    Ask the operating system to drop cached data of the file, so the next reading is done from the disk. Data should be flushed before, see `fsync_file()`.
+    This is supported on posix systems with `posix_fadvise` only, otherwise it does nothing
+
+    Ref: https://man7.org/linux/man-pages/man2/posix_fadvise.2.html
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(file_name, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+@contextlib.contextmanager
+def atomic_file_write(file_name, fsync_policy = "file"):
+    """
+    Context manager to write file atomically. It returns name of the temporary file in the same folder, which should be written in the block.
+    The temporary file replaces `file_name` when the block is finished without exception, otherwise it is removed.
+    So the file contains either old or new data completely, even if the program is interrupted while writing.
+
+    Ref: https://docs.python.org/3/library/contextlib.html#contextlib.contextmanager
+    """
+    tmp_file_name = f"{file_name}.tmp.{uuid.uuid1()}"
+    try:
+        yield tmp_file_name
+        replace_file(tmp_file_name, file_name, fsync_policy)
+    except BaseException:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
+
 def get_datetime_str(dt: datetime) -> str:
     if dt is None:
         return "-"
@@ -216,4 +406,297 @@ class ProcessingTimeEstimator(object):
         ret.elapsed_duration = passed_duration
         ret.estimated_duration_remains = passed_duration * (remained_size / self.handled_size)
         ret.estimated_end_time = cur_time + ret.estimated_duration_remains
-        return ret
\ No newline at end of file
+        return ret
+
+def iter_file_list(f, separator = b"\n", chunk_size = 64 * 1024):
+    """
+    Iterate over file names read lazily from binary file object `f`, names are separated with `separator`.
+    Empty names are skipped, carriage return at the end of the line is removed if names are separated with new line.
+    Names are decoded as file system names, so the names which are not valid in the file system encoding are passed as is
+
+    Ref: https://docs.python.org/3/library/os.html#os.fsdecode
+    """
+    rest = b""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        names = (rest + chunk).split(separator)
+        rest = names.pop()
+        for name in names:
+            if separator == b"\n" and name.endswith(b"\r"):
+                name = name[:-1]
+            if name:
+                yield os.fsdecode(name)
+    if separator == b"\n" and rest.endswith(b"\r"):
+        rest = rest[:-1]
+    if rest:
+        yield os.fsdecode(rest)
+
+def compile_file_masks(masks):
+    """
+    Compile file masks separated with semicolon (;) into one regular expression, or return None if masks are not specified.
+    Masks are matched as with `fnmatch.fnmatch()`, so name should be normalized with `os.path.normcase()` before matching with `fullmatch()`
+
+    Ref: https://docs.python.org/3/library/fnmatch.html#fnmatch.translate
+    """
+    if not masks:
+        return None
+    return re.compile("|".join(fnmatch.translate(os.path.normcase(mask)) for mask in masks.split(";")))
+
+class ThroughputTimeEstimator(object):
+    """
+    Estimation of processing time which models time of file handling as per-file overhead plus size / throughput.
+    So the estimation does not swing when millions of small files are mixed with a few huge ones, as with linear extrapolation by size.
+
+    Model is kept for every device, because disks differ in throughput and seek time. Both parameters are smoothed with EWMA:
+    per-file overhead is updated by files not larger than `overhead_size_threshold` with weight of every file as `overhead_smoothing_count` files,
+    throughput is updated by larger files with weight proportional to their size relative to `throughput_smoothing_size`.
+    Skipped files, e.g. which hashes exist, are removed from the remaining work and are not used to update the model.
+    Model may be seeded from the history file saved by the previous runs.
+
+    Ref: https://en.wikipedia.org/wiki/Moving_average#Exponential_moving_average
+    """
+
+    Result = ProcessingTimeEstimator.Result
+
+    overhead_size_threshold = 64 * 1024
+    overhead_smoothing_count = 100
+    throughput_smoothing_size = 256 * 1024 * 1024
+
+    class DeviceModel(object):
+        def __init__(self, per_file_overhead = None, throughput = None):
+            self.per_file_overhead = per_file_overhead # In seconds
+            self.throughput = throughput # In bytes per second
+
+    def __init__(self):
+        self.start_time = datetime.datetime.now()
+        self.models = {} # Device -> DeviceModel, device None is for the model of all devices
+        self.remaining = {} # Device -> [count of files, size]
+        self.handled_size = 0
+        self.handled_duration = 0.0
+
+    def add_file(self, device, size):
+        remaining = self.remaining.setdefault(device, [0, 0])
+        remaining[0] += 1
+        remaining[1] += size
+
+    def skip_file(self, device, size):
+        remaining = self.remaining[device]
+        remaining[0] -= 1
+        remaining[1] -= size
+
+    def add_handled_file(self, device, size, duration):
+        """
+        Remove the file from the remaining work and update the model of the device with the time of the file handling
+        """
+        self.skip_file(device, size)
+        self.handled_size += size
+        self.handled_duration += duration
+        for model_device in [device, None]:
+            model = self.models.get(model_device)
+            if model is None:
+                model = self.models[model_device] = self.DeviceModel()
+            self.__update_model(model, size, duration)
+
+    def __update_model(self, model: DeviceModel, size, duration):
+        if size <= self.overhead_size_threshold:
+            value = max(duration - (size / model.throughput if model.throughput else 0.0), 0.0)
+            weight = 1.0 - math.exp(-1.0 / self.overhead_smoothing_count)
+            model.per_file_overhead = value if model.per_file_overhead is None else model.per_file_overhead + weight * (value - model.per_file_overhead)
+        else:
+            # Overhead estimated by small files may be too large for this file, so at least some part of the duration is accounted for reading
+            read_duration = max(duration - (model.per_file_overhead or 0.0), duration * 0.1)
+            if read_duration <= 0.0:
+                return
+            value = size / read_duration
+            weight = 1.0 - math.exp(-size / self.throughput_smoothing_size)
+            model.throughput = value if model.throughput is None else model.throughput + weight * (value - model.throughput)
+
+    def __get_model_value(self, device, name):
+        for model_device in [device, None]:
+            model = self.models.get(model_device)
+            if model is not None and getattr(model, name) is not None:
+                return getattr(model, name)
+        return None
+
+    def get_estimated_duration_remains(self):
+        """
+        Return estimated remaining duration in seconds, or None if there is no data for the estimation
+        """
+        ret = 0.0
+        for device, (file_count, size) in self.remaining.items():
+            if file_count <= 0:
+                continue
+            per_file_overhead = self.__get_model_value(device, "per_file_overhead")
+            throughput = self.__get_model_value(device, "throughput")
+            if throughput is None and self.handled_duration > 0.0:
+                # Only small files are handled, so average throughput with overhead is the best known value
+                throughput = self.handled_size / self.handled_duration
+            if per_file_overhead is None and throughput is None:
+                return None
+            ret += file_count * (per_file_overhead or 0.0) + (size / throughput if throughput else 0.0)
+        return ret
+
+    def get_result(self, cur_time = None):
+        if cur_time is None:
+            cur_time = datetime.datetime.now()
+        ret = self.Result()
+        duration_remains = self.get_estimated_duration_remains()
+        if duration_remains is None:
+            return ret
+        ret.elapsed_duration = cur_time - self.start_time
+        ret.estimated_duration_remains = datetime.timedelta(seconds=duration_remains)
+        ret.estimated_end_time = cur_time + ret.estimated_duration_remains
+        return ret
+
+    def load_history(self, file_name):
+        """
+        Seed models of the devices with the values saved by `save_history()`. File may not exist
+        """
+        if not os.path.isfile(file_name):
+            return
+        try:
+            with open(file_name, "r", encoding="utf-8") as f:
+                history = json.load(f)
+            for device, values in history["devices"].items():
+                self.models[device] = self.DeviceModel(values.get("per_file_overhead"), values.get("throughput"))
+        except (ValueError, KeyError, TypeError, AttributeError) as err:
+            raise AppUsageError(f"Throughput history file has wrong format: '{file_name}'") from err
+
+    def save_history(self, file_name, fsync_policy = "file"):
+        """
+        Save models of the devices to JSON file. Devices are identified by strings, see `get_device_id()`
+        """
+        devices = {}
+        for device, model in self.models.items():
+            if device is None:
+                continue
+            values = {}
+            if model.per_file_overhead is not None:
+                values["per_file_overhead"] = model.per_file_overhead
+            if model.throughput is not None:
+                values["throughput"] = model.throughput
+            devices[device] = values
+        with atomic_file_write(file_name, fsync_policy) as tmp_file_name:
+            with open(tmp_file_name, "w", encoding="utf-8") as f:
+                json.dump({"devices": devices}, f, indent=4, sort_keys=True)
+
+    @staticmethod
+    def get_device_id(file_stat: os.stat_result):
+        """
+        Device of the file as string, it is key of the model in the history file
+        """
+        return str(file_stat.st_dev)
+
+class TokenBucket(object):
+    """
+    Token bucket to limit the rate of some resource consumption, e.g. count of bytes read per second.
+    Bucket is filled with `rate` tokens per second up to `capacity`. If there are not enough tokens then `consume()` sleeps.
+
+    Ref: https://en.wikipedia.org/wiki/Token_bucket
+    """
+
+    def __init__(self, rate, capacity = None):
+        if rate <= 0:
+            raise ValueError("Rate should be positive")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate # Burst of one second by default
+        self.tokens = self.capacity
+        # Time functions are members to substitute them in tests
+        self.time_func = time.monotonic
+        self.sleep_func = time.sleep
+        self.last_time = self.time_func()
+        self.__lock = threading.Lock() # Bucket may be shared by threads, e.g. workers of hash API and compute threads of the server
+
+    def consume(self, amount):
+        """
+        Take `amount` tokens from the bucket. If there are not enough tokens, then sleep until they are refilled.
+        `amount` may exceed `capacity`, in this case the sleep is proportionally longer.
+        Returns duration of sleep in seconds.
+        """
+        with self.__lock:
+            cur_time = self.time_func()
+            self.tokens = min(self.capacity, self.tokens + (cur_time - self.last_time) * self.rate)
+            self.last_time = cur_time
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0
+            # Tokens are negative now, they are refilled during the sleep and accounted on the next call.
+            # Every thread sleeps for the debt including the amounts of other threads, so the total rate is kept
+            duration = -self.tokens / self.rate
+
+        # Sleep is outside of the lock, so other threads are not blocked on it
+        self.sleep_func(duration)
+        return duration
+
+# Ref: https://man7.org/linux/man-pages/man2/ioprio_set.2.html
+io_priority_classes = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+# Numbers of ioprio_set system call, which are not exposed by Python. Ref: https://github.com/torvalds/linux/tree/master/arch
+ioprio_set_syscall_numbers = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314, "ppc64le": 273, "ppc64": 273, "s390x": 282, "riscv64": 30}
+
+def set_process_io_priority(io_class: str, level: int = 4):
+    """
+    Set I/O scheduling class and priority level (0 - highest, 7 - lowest) for the current process. This is supported on Linux only.
+
+    Ref: https://man7.org/linux/man-pages/man1/ionice.1.html
+    """
+    if not sys.platform.startswith("linux"):
+        raise AppUsageError("I/O priority can be set on Linux only")
+    syscall_number = ioprio_set_syscall_numbers.get(platform.machine())
+    if syscall_number is None:
+        raise AppUsageError(f"Setting of I/O priority is not supported on platform '{platform.machine()}'")
+    if level < 0 or level > 7:
+        raise AppUsageError(f"I/O priority level should be in range 0..7, {level} specified")
+
+    ioprio_who_process = 1
+    ioprio_class_shift = 13
+    ioprio = (io_priority_classes[io_class] << ioprio_class_shift) | level
+
+    # Ref: https://docs.python.org/3/library/ctypes.html#ctypes.get_errno
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(syscall_number, ioprio_who_process, 0, ioprio) != 0:
+        errno = ctypes.get_errno()
+        raise AppUsageError(f"Failed to set I/O priority '{io_class}' with level {level}: {os.strerror(errno)}")
+
+def set_process_cpu_niceness(niceness: int):
+    """
+    Set CPU niceness of the current process, from -20 (highest priority) to 19 (lowest priority)
+
+    Ref: https://docs.python.org/3/library/os.html#os.setpriority
+    """
+    if not hasattr(os, "setpriority"):
+        raise AppUsageError("CPU niceness can't be set on this platform")
+    try:
+        os.setpriority(os.PRIO_PROCESS, 0, niceness)
+    except OSError as err:
+        raise AppUsageError(f"Failed to set CPU niceness {niceness}: {err.strerror}") from err
+
+# FIEMAP ioctl to get physical location of file data on Linux. Ref: https://www.kernel.org/doc/html/latest/filesystems/fiemap.html
+# struct fiemap: fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, fm_reserved, followed by array of struct fiemap_extent
+fiemap_struct = struct.Struct("=QQIIII")
+# struct fiemap_extent: fe_logical, fe_physical, fe_length, fe_reserved64[2], fe_flags, fe_reserved[3]
+fiemap_extent_struct = struct.Struct("=QQQQQIIII")
+FS_IOC_FIEMAP = 0xC020660B # _IOWR('f', 11, struct fiemap)
+FIEMAP_MAX_OFFSET = 0xFFFFFFFFFFFFFFFF
+
+def get_file_physical_offset(file_name):
+    """
+    Return physical offset on the device of the first extent of the file data.
+    None is returned if it is not supported by the platform or the file system, or the file has no data extents, e.g. empty file
+
+    Ref: https://man7.org/linux/man-pages/man2/ioctl_fiemap.2.html
+    """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return None
+    request = bytearray(fiemap_struct.pack(0, FIEMAP_MAX_OFFSET, 0, 0, 1, 0) + bytes(fiemap_extent_struct.size))
+    try:
+        with open(file_name, "rb") as f:
+            fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request, True)
+    except OSError:
+        return None
+    mapped_extents = fiemap_struct.unpack_from(request)[3]
+    if mapped_extents == 0:
+        return None
+    return fiemap_extent_struct.unpack_from(request, fiemap_struct.size)[1]
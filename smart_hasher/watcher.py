@@ -0,0 +1,340 @@
+"""
+Watching of folders for changes of files, this is used to keep hash storage up to date without rescanning of the whole folders.
+
+On Linux inotify is used, it is called with ctypes so no external packages are needed. On other platforms and on file systems
+without inotify support (e.g. network file systems) folders are rescanned periodically. Folders are rescanned periodically also
+if inotify can't be started, e.g. when the limit of watches per user is reached.
+"""
+import abc
+import ctypes
+import ctypes.util
+import enum
+import os
+import select
+import struct
+import sys
+import time
+
+@enum.unique
+class WatchEventKind(enum.Enum):
+    FILE_CHANGED = 1 # File is created or modified
+    FILE_DELETED = 2 # File is deleted or moved out of watched folders
+    FOLDER_DELETED = 3 # Folder is deleted or moved out of watched folders, all files below it are deleted
+    RESCAN_NEEDED = 4 # Events are lost, e.g. due to overflow of the event queue, so watched folders should be rescanned
+
+class WatcherAbstract(abc.ABC):
+    """
+    This is a base class for watchers of folders.
+
+    `wait_events(timeout)` returns list of pairs (WatchEventKind, path) for changes since the previous call.
+    It returns empty list if there are no changes during `timeout` seconds.
+
+    `dir_filter(base_name, top_level)` is called for subfolders, the subfolder and its content are not watched if it returns False.
+    `top_level` is True for the subfolders of watched folders.
+    """
+
+    def __init__(self, folders, dir_filter = None):
+        self.folders = [os.path.abspath(folder) for folder in folders]
+        self.dir_filter = dir_filter
+
+    def _is_dir_included(self, parent_dir_name, base_name):
+        return self.dir_filter is None or self.dir_filter(base_name, parent_dir_name in self.folders)
+
+    def _walk(self, folder):
+        """
+        Walk the folder like `os.walk()`, subfolders rejected by `dir_filter` are pruned
+        """
+        for dir_name, dir_list, file_list in os.walk(folder):
+            dir_list[:] = [sub_dir_name for sub_dir_name in dir_list if self._is_dir_included(dir_name, sub_dir_name)]
+            yield dir_name, dir_list, file_list
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def wait_events(self, timeout):
+        """
+        Wait for changes in watched folders at most `timeout` seconds and return list of pairs (WatchEventKind, path)
+        """
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+class PollingWatcher(WatcherAbstract):
+    """
+    This watcher rescans folders every `polling_interval` seconds and compares size and modification time of the files with the previous scan
+    """
+
+    def __init__(self, folders, polling_interval = 10.0, dir_filter = None):
+        super().__init__(folders, dir_filter)
+        self.polling_interval = polling_interval
+        self.__files = None # File name -> (size, modification time in nanoseconds)
+        self.__last_scan_time = None
+
+    def __scan(self):
+        ret = {}
+        for folder in self.folders:
+            for dir_name, _, file_list in self._walk(folder):
+                for base_file_name in file_list:
+                    file_name = os.path.join(dir_name, base_file_name)
+                    try:
+                        st = os.stat(file_name)
+                    except OSError:
+                        continue # File is deleted during scan
+                    ret[file_name] = (st.st_size, st.st_mtime_ns)
+        self.__last_scan_time = time.monotonic()
+        return ret
+
+    def start(self):
+        self.__files = self.__scan()
+
+    def wait_events(self, timeout):
+        time_to_scan = self.__last_scan_time + self.polling_interval - time.monotonic()
+        if time_to_scan > timeout:
+            time.sleep(max(timeout, 0))
+            return []
+        if time_to_scan > 0:
+            time.sleep(time_to_scan)
+
+        files = self.__scan()
+        ret = [(WatchEventKind.FILE_CHANGED, file_name) for file_name, file_info in files.items() if self.__files.get(file_name) != file_info]
+        ret += [(WatchEventKind.FILE_DELETED, file_name) for file_name in self.__files if file_name not in files]
+        self.__files = files
+        return ret
+
+class InotifyWatcher(WatcherAbstract):
+    """
+    This watcher uses inotify on Linux. Watch is added for every folder below the watched folders, new folders are watched as they appear.
+
+    Ref: https://man7.org/linux/man-pages/man7/inotify.7.html
+    """
+
+    # Constants from <sys/inotify.h>
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    watch_mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+    # struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+    event_header = struct.Struct("iIII")
+
+    __libc = None
+
+    @classmethod
+    def _get_libc(cls):
+        if cls.__libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            # Ref: https://docs.python.org/3/library/ctypes.html#specifying-the-required-argument-types-function-prototypes
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            cls.__libc = libc
+        return cls.__libc
+
+    @classmethod
+    def is_supported(cls):
+        if not sys.platform.startswith("linux"):
+            return False
+        try:
+            return hasattr(cls._get_libc(), "inotify_init1")
+        except OSError:
+            return False
+
+    def __init__(self, folders, dir_filter = None):
+        super().__init__(folders, dir_filter)
+        self.__fd = None
+        self.__watch_folders = {} # Watch descriptor -> folder name
+        self.__folder_watches = {} # Folder name -> watch descriptor
+
+    def start(self):
+        if self.__fd is not None:
+            return # Started already, e.g. by `create_watcher()`
+        fd = self._get_libc().inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.__fd = fd
+        try:
+            for folder in self.folders:
+                self.__add_watches(folder)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+        self.__watch_folders = {}
+        self.__folder_watches = {}
+
+    def __add_watch(self, folder):
+        wd = self._get_libc().inotify_add_watch(self.__fd, os.fsencode(folder), self.watch_mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), folder)
+        self.__watch_folders[wd] = folder
+        self.__folder_watches[folder] = wd
+
+    def __add_watches(self, folder, events = None):
+        """
+        Watch folder and all its subfolders. If `events` is specified, then FILE_CHANGED events are added for the files found,
+        because they may be created before the watch is added
+        """
+        for dir_name, _, file_list in self._walk(folder):
+            try:
+                self.__add_watch(dir_name)
+            except FileNotFoundError:
+                continue # Folder is deleted already
+            if events is not None:
+                events += [(WatchEventKind.FILE_CHANGED, os.path.join(dir_name, base_file_name)) for base_file_name in file_list]
+
+    def __forget_folder(self, folder):
+        """
+        Forget watches for the folder and its subfolders. Kernel removes the watches itself when folder is deleted
+        """
+        prefix = os.path.join(folder, "")
+        for watched_folder in [f for f in self.__folder_watches if f == folder or f.startswith(prefix)]:
+            wd = self.__folder_watches.pop(watched_folder)
+            del self.__watch_folders[wd]
+            self._get_libc().inotify_rm_watch(self.__fd, wd) # Error is ignored, watch may be removed already
+
+    def __handle_event(self, wd, mask, name, events):
+        if mask & self.IN_Q_OVERFLOW:
+            events.append((WatchEventKind.RESCAN_NEEDED, None))
+            return
+
+        folder = self.__watch_folders.get(wd)
+        if folder is None:
+            return # Event for the watch which is removed already
+
+        if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+            if folder in self.folders:
+                # Root of watched folders is deleted, its files are reported deleted and it is not watched any more
+                self.__forget_folder(folder)
+                events.append((WatchEventKind.FOLDER_DELETED, folder))
+            return
+        if mask & self.IN_IGNORED or not name:
+            return
+
+        path = os.path.join(folder, os.fsdecode(name))
+        if mask & self.IN_ISDIR:
+            if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                if self._is_dir_included(folder, os.path.basename(path)):
+                    self.__add_watches(path, events)
+            elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                self.__forget_folder(path)
+                events.append((WatchEventKind.FOLDER_DELETED, path))
+            return
+
+        if mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+            events.append((WatchEventKind.FILE_DELETED, path))
+        elif mask & (self.IN_CREATE | self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+            events.append((WatchEventKind.FILE_CHANGED, path))
+
+    def wait_events(self, timeout):
+        # Ref: https://docs.python.org/3/library/select.html#select.select
+        readable, _, _ = select.select([self.__fd], [], [], max(timeout, 0))
+        if not readable:
+            return []
+
+        ret = []
+        while True:
+            try:
+                data = os.read(self.__fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_len = self.event_header.unpack_from(data, offset)
+                offset += self.event_header.size
+                name = data[offset:offset + name_len].rstrip(b"\0")
+                offset += name_len
+                self.__handle_event(wd, mask, name, ret)
+        return ret
+
+def create_watcher(folders, polling_interval = 10.0, use_polling = False, dir_filter = None, report_func = None):
+    """
+    Create inotify watcher if it is supported, otherwise polling watcher is created.
+    Inotify watcher is started here, polling watcher is created if it can't be started, e.g. due to limit of watches (ENOSPC),
+    limit of open files (EMFILE) or permissions (EACCES). The reason is passed to `report_func`
+    """
+    if not use_polling and InotifyWatcher.is_supported():
+        inotify_watcher = InotifyWatcher(folders, dir_filter)
+        try:
+            inotify_watcher.start()
+            return inotify_watcher
+        except OSError as err:
+            if report_func is not None:
+                report_func(f"Warning: inotify can't be used to watch folders, they are rescanned every {polling_interval} seconds. {err}")
+    return PollingWatcher(folders, polling_interval, dir_filter)
+
+class ChangeDebouncer(object):
+    """
+    This class delays handling of the changed files until they are not changed for `delay` seconds.
+    So the file which is being written is handled once when writing is finished
+    """
+
+    def __init__(self, delay = 2.0):
+        self.delay = delay
+        self.__changes = {} # File name -> moment of the last change
+        self.time_func = time.monotonic
+
+    def __len__(self):
+        return len(self.__changes)
+
+    def add(self, file_name):
+        # Order of items in dictionary is order of the first change, so the files are handled in order they appear
+        self.__changes[file_name] = self.time_func()
+
+    def discard(self, file_name):
+        self.__changes.pop(file_name, None)
+
+    def discard_folder(self, folder_name):
+        prefix = os.path.join(folder_name, "")
+        for file_name in [f for f in self.__changes if f.startswith(prefix)]:
+            del self.__changes[file_name]
+
+    def pop_ready(self):
+        """
+        Remove and return the files which are not changed for `delay` seconds
+        """
+        moment = self.time_func() - self.delay
+        ret = [file_name for file_name, change_moment in self.__changes.items() if change_moment <= moment]
+        for file_name in ret:
+            del self.__changes[file_name]
+        return ret
+
+    def pop_all(self):
+        ret = list(self.__changes)
+        self.__changes.clear()
+        return ret
+
+    def get_wait_timeout(self, max_timeout):
+        """
+        Get time to wait for events until some file is ready to be handled
+        """
+        if not self.__changes:
+            return max_timeout
+        first_moment = min(self.__changes.values())
+        return max(0.0, min(max_timeout, first_moment + self.delay - self.time_func()))